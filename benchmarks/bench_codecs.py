@@ -0,0 +1,181 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script measures, for each codec of trimmed reads, the wall time to
+write and to read back fastq files, and their size.
+
+Reads of tests/reads are repeated until the requested amount of data is
+reached, then written with each codec, level and number of threads, as
+the trimming rules do (see scripts/fastq_codecs.py). Each copy of the
+reads is shuffled and a few of its bases and qualities are changed:
+otherwise, codecs with large windows (zstd) would find the copies and
+report unrealistic ratios.
+
+Usage example:
+python3.8 ./bench_codecs.py --size-mb 500 --threads 1 4
+"""
+
+import argparse  # Parse command line
+import gzip  # Handle gzipped files
+import numpy  # Shuffle and mutate reads
+import os  # OS related activities
+import sys  # System related methods
+import tempfile  # Temporary directories
+import time  # Timers
+
+from pathlib import Path  # Paths related methods
+from typing import Any, List, Tuple  # Type hints
+
+script_path = os.sep.join(
+    [os.path.dirname(os.path.abspath(__file__)), "..", "scripts"]
+)
+sys.path.append(script_path)
+
+from common_script_ngs_cleaning import CustomFormatter
+from fastq_codecs import codec_suffix, open_input, open_output
+
+
+# Reads used to build the benchmark data
+READS = Path(__file__).resolve().parent.parent / "tests" / "reads"
+
+# Codecs and levels to benchmark
+CODEC_LEVELS = [
+    ("gzip", 1), ("gzip", 4), ("gzip", 6),
+    ("bgzf", 1), ("bgzf", 6),
+    ("zstd", 1), ("zstd", 3), ("zstd", 9),
+]
+
+# Size of the blocks written at once
+WRITE_SIZE = 4 * 1024 * 1024
+
+
+# Rate of bases and qualities changed in each copy of the reads
+MUTATION_RATE = 0.05
+
+
+def mutate(lines: List[bytes], rng: numpy.random.Generator) -> List[bytes]:
+    """
+    Replace a few characters of the given lines by characters drawn from
+    these lines, keeping their lengths
+    """
+    chars = numpy.frombuffer(b"\n".join(lines), dtype=numpy.uint8).copy()
+    valid = numpy.flatnonzero(chars != ord("\n"))
+    changed = valid[rng.random(len(valid)) < MUTATION_RATE]
+    chars[changed] = chars[rng.choice(valid, len(changed))]
+    return chars.tobytes().split(b"\n")
+
+
+def scaled_reads(size_mb: int, seed: int = 0) -> bytes:
+    """
+    Return reads of tests/reads, shuffled and mutated copies of them
+    being added until size_mb MB of fastq text
+    """
+    lines = b"".join(
+        gzip.decompress(path.read_bytes())
+        for path in sorted(READS.glob("*.fq.gz"))
+    ).splitlines()
+    headers, sequences, qualities = lines[0::4], lines[1::4], lines[3::4]
+    copies = max(1, (size_mb * 1024 * 1024) // sum(map(len, lines)))
+
+    rng = numpy.random.default_rng(seed)
+    reads = []
+    for copy in range(copies):
+        order = rng.permutation(len(headers))
+        copy_sequences = mutate([sequences[i] for i in order], rng)
+        copy_qualities = mutate([qualities[i] for i in order], rng)
+        reads.extend(
+            b"%s:%d\n%s\n+\n%s\n" % (headers[i], copy, sequence, quality)
+            for i, sequence, quality in zip(
+                order, copy_sequences, copy_qualities
+            )
+        )
+    return b"".join(reads)
+
+
+def time_codec(
+    data: bytes, path: Path, codec: str, level: int, threads: int
+) -> Tuple[float, float, int]:
+    """
+    Return the wall times to write and read back the data with a codec,
+    and the size of the written file
+    """
+    start = time.perf_counter()
+    with open_output(path, codec, level, threads) as output:
+        for offset in range(0, len(data), WRITE_SIZE):
+            output.write(data[offset:offset + WRITE_SIZE])
+    written = time.perf_counter()
+
+    read = 0
+    with open_input(path) as handle:
+        for block in iter(lambda: handle.read(WRITE_SIZE), b""):
+            read += len(block)
+    if read != len(data):
+        raise ValueError(f"{path} holds {read} bytes, not {len(data)}")
+    return written - start, time.perf_counter() - written, path.stat().st_size
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--size-mb",
+        help="Size of the uncompressed fastq data (default: %(default)s)",
+        type=int,
+        default=500,
+    )
+
+    main_parser.add_argument(
+        "--threads",
+        help="Numbers of compression threads, with bgzf and zstd "
+             "(default: %(default)s)",
+        type=int,
+        nargs="+",
+        default=[1, 4],
+    )
+
+    main_parser.add_argument(
+        "--root",
+        help="Directory in which files are written "
+             "(default: a temporary directory)",
+        type=str,
+        default=None,
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Time each codec and print the results as a TSV table
+    """
+    data = scaled_reads(args.size_mb)
+    print(
+        "codec\tlevel\tthreads\twrite_seconds\tread_seconds\tsize_mb\tratio"
+    )
+    with tempfile.TemporaryDirectory(dir=args.root) as tmp:
+        for codec, level in CODEC_LEVELS:
+            threads_list: List[int] = (
+                [1] if codec == "gzip" else args.threads
+            )
+            for threads in threads_list:
+                path = Path(tmp) / f"{codec}.{level}.{codec_suffix(codec)}"
+                write, read, size = time_codec(
+                    data, path, codec, level, threads
+                )
+                print(
+                    f"{codec}\t{level}\t{threads}\t{write:.2f}\t{read:.2f}"
+                    f"\t{size / 1024 ** 2:.1f}\t{len(data) / size:.2f}",
+                    flush=True
+                )
+                path.unlink()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,125 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script measures the time Snakemake spends parsing the Snakefile and
+building the DAG of this pipeline, on synthetic designs of increasing
+sizes.
+
+For each design size, a design of paired samples (with empty fastq
+files) is built, then a dry run is timed.
+
+Usage example:
+python3.8 ./bench_dag.py --samples 1000 10000 50000
+"""
+
+import argparse  # Parse command line
+import os  # OS related activities
+import subprocess  # Run Snakemake
+import sys  # System related methods
+import tempfile  # Temporary directories
+import time  # Timers
+
+from pathlib import Path  # Paths related methods
+from typing import Any  # Type hints
+
+script_path = os.sep.join(
+    [os.path.dirname(os.path.abspath(__file__)), "..", "scripts"]
+)
+sys.path.append(script_path)
+
+from common_script_ngs_cleaning import CustomFormatter
+
+
+# Path to the pipeline Snakefile
+SNAKEFILE = Path(__file__).resolve().parent.parent / "Snakefile"
+
+
+def build_design(root: Path, nb_samples: int) -> Path:
+    """
+    Write a design of nb_samples paired samples, with empty fastq files,
+    and a configuration file using it. Returns the configuration file.
+    """
+    reads = root / "reads"
+    reads.mkdir()
+    with (root / "design.tsv").open("w") as design:
+        design.write("Sample_id\tUpstream_file\tDownstream_file\n")
+        for sample in range(nb_samples):
+            mates = [reads / f"S{sample}_R{mate}.fq.gz" for mate in [1, 2]]
+            for mate in mates:
+                mate.touch()
+            design.write(f"S{sample}\t{mates[0]}\t{mates[1]}\n")
+
+    config = root / "config.yaml"
+    config.write_text(
+        f"design: {root / 'design.tsv'}\n"
+        f"workdir: {root}\n"
+        "threads: 1\n"
+        "singularity_docker_image: docker://continuumio/miniconda3:4.4.10\n"
+        "cold_storage: [' ']\n"
+        "run_fqscreen: false\n"
+        "params:\n"
+        "  fastp_extra: --overrepresentation_analysis\n"
+    )
+    return config
+
+
+def dry_run(root: Path, config: Path) -> float:
+    """
+    Return the wall time of a Snakemake dry run
+    """
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            "snakemake", "--dry-run", "--quiet", "--cores", "1",
+            "--snakefile", str(SNAKEFILE), "--configfile", str(config),
+            "--directory", str(root)
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL
+    )
+    return time.perf_counter() - start
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--samples",
+        help="Design sizes to benchmark (default: %(default)s)",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+    )
+
+    main_parser.add_argument(
+        "--root",
+        help="Directory in which synthetic designs are built "
+             "(default: a temporary directory)",
+        type=str,
+        default=None,
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Time dry runs on each design size and print them as a TSV table
+    """
+    print("samples\tseconds")
+    for nb_samples in args.samples:
+        with tempfile.TemporaryDirectory(dir=args.root) as tmp:
+            root = Path(tmp)
+            config = build_design(root, nb_samples)
+            seconds = dry_run(root, config)
+            print(f"{nb_samples}\t{seconds:.2f}", flush=True)
+
+if __name__ == "__main__":
+    main(parse_args())
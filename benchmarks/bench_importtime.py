@@ -0,0 +1,128 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script measures the import time of the helper modules loaded each
+time Snakemake parses this pipeline, i.e. by each cluster job, with
+python -X importtime.
+
+It fails if a heavy module (pandas, pytest, ...) is imported, or if the
+median import time is above the given threshold: this guards against
+import regressions in rules/common_ngs_cleaning.py and its dependencies.
+
+Usage example:
+python3.8 ./bench_importtime.py --repeats 5 --max-ms 150
+"""
+
+import argparse  # Parse command line
+import os  # OS related activities
+import statistics  # Median of timings
+import subprocess  # Run Python interpreters
+import sys  # System related methods
+
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List  # Type hints
+
+script_path = os.sep.join(
+    [os.path.dirname(os.path.abspath(__file__)), "..", "scripts"]
+)
+sys.path.append(script_path)
+
+from common_script_ngs_cleaning import CustomFormatter
+
+
+# Directory of the modules imported by rules/common.smk
+RULES = Path(__file__).resolve().parent.parent / "rules"
+
+# Modules imported by rules/common.smk
+MODULES = ["common_ngs_cleaning", "stage_fastq"]
+
+# Modules which should never be imported while parsing the pipeline
+HEAVY_MODULES = ["numpy", "pandas", "pyarrow", "pytest", "yaml"]
+
+
+def import_times(modules: List[str]) -> Dict[str, int]:
+    """
+    Import the given modules in a fresh interpreter, and return the
+    cumulative import time of each imported top-level module, in
+    microseconds
+    """
+    result = subprocess.run(
+        [
+            sys.executable, "-X", "importtime",
+            "-c", f"import {', '.join(modules)}"
+        ],
+        cwd=RULES,
+        check=True,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        top_level = name.strip().split(".")[0]
+        times[top_level] = max(times.get(top_level, 0), int(cumulative))
+    return times
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--repeats",
+        help="Number of fresh interpreters to time (default: %(default)s)",
+        type=int,
+        default=5,
+    )
+
+    main_parser.add_argument(
+        "--max-ms",
+        help="Maximum median import time, in milliseconds "
+             "(default: %(default)s)",
+        type=float,
+        default=150,
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> int:
+    """
+    Time imports, print them as a TSV table and return the exit code
+    """
+    runs = [import_times(MODULES) for _ in range(args.repeats)]
+    print("module\tmedian_ms")
+    for module in MODULES:
+        median = statistics.median(run[module] for run in runs) / 1000
+        print(f"{module}\t{median:.1f}")
+
+    total = statistics.median(
+        sum(run[module] for module in MODULES) for run in runs
+    ) / 1000
+    print(f"total\t{total:.1f}")
+
+    heavy = sorted(set(HEAVY_MODULES).intersection(runs[0]))
+    if heavy:
+        print(f"Heavy modules imported: {', '.join(heavy)}", file=sys.stderr)
+        return 1
+    if total > args.max_ms:
+        print(
+            f"Import time above {args.max_ms} ms: {total:.1f} ms",
+            file=sys.stderr
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
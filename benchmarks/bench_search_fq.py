@@ -0,0 +1,134 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script compares the fastq files search methods of prepare_design.py
+on a synthetic directory tree.
+
+It builds a tree of empty files looking like a sequencer output (one
+sub-directory per lane, a majority of fastq files mixed with other
+files), then times the recursive generator (search_fq) and the threaded
+scandir crawler (crawl_fq).
+
+Usage example:
+python3.8 ./bench_search_fq.py --files 100000 --threads 1 4 16
+"""
+
+import argparse  # Parse command line
+import os  # OS related activities
+import sys  # System related methods
+import tempfile  # Temporary directories
+import time  # Timers
+
+from pathlib import Path  # Paths related methods
+from typing import Any, Callable, List  # Type hints
+
+script_path = os.sep.join(
+    [os.path.dirname(os.path.abspath(__file__)), "..", "scripts"]
+)
+sys.path.append(script_path)
+
+from common_script_ngs_cleaning import CustomFormatter
+from prepare_design import crawl_fq, search_fq
+
+
+def build_tree(root: Path, nb_files: int, files_per_dir: int) -> None:
+    """
+    Build a synthetic sequencer output with nb_files empty files, split
+    in sub-directories of files_per_dir files each.
+    """
+    for index in range(nb_files):
+        run_dir = root / f"run_{index // (files_per_dir * 4)}"
+        lane_dir = run_dir / f"L{(index // files_per_dir) % 4 + 1:03d}"
+        if index % files_per_dir == 0:
+            lane_dir.mkdir(parents=True, exist_ok=True)
+
+        extension = "fastq.gz" if index % 10 else "xml"
+        (lane_dir / f"S{index}_R{index % 2 + 1}.{extension}").touch()
+
+
+def timer(func: Callable[[], List[Any]], repeat: int) -> float:
+    """
+    Return the best wall time of func over `repeat` calls
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--files",
+        help="Number of files in the synthetic tree (default: %(default)s)",
+        type=int,
+        default=100000,
+    )
+
+    main_parser.add_argument(
+        "--files-per-dir",
+        help="Number of files per lane directory (default: %(default)s)",
+        type=int,
+        default=50,
+    )
+
+    main_parser.add_argument(
+        "--threads",
+        help="Crawler pool sizes to benchmark (default: %(default)s)",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16],
+    )
+
+    main_parser.add_argument(
+        "--repeat",
+        help="Number of timed runs per method (default: %(default)s)",
+        type=int,
+        default=3,
+    )
+
+    main_parser.add_argument(
+        "--root",
+        help="Directory in which the synthetic tree is built "
+             "(default: a temporary directory)",
+        type=str,
+        default=None,
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    Build the synthetic tree and print timings as a TSV table
+    """
+    with tempfile.TemporaryDirectory(dir=args.root) as tmp:
+        root = Path(tmp)
+        build_tree(root, args.files, args.files_per_dir)
+
+        expected = len(list(search_fq(root, True)))
+        print("method\tthreads\tfastq_files\tseconds")
+        seconds = timer(lambda: list(search_fq(root, True)), args.repeat)
+        print(f"search_fq\t1\t{expected}\t{seconds:.3f}")
+
+        for threads in args.threads:
+            found = len(list(crawl_fq(root, max_depth=None, threads=threads)))
+            seconds = timer(
+                lambda: list(crawl_fq(root, max_depth=None, threads=threads)),
+                args.repeat
+            )
+            print(f"crawl_fq\t{threads}\t{found}\t{seconds:.3f}")
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -4,12 +4,27 @@ one gathers all the python instructions surch as config mappings or input
 validations.
 """
 
-import pandas
+import functools
+import math
+import os.path
+import re
 
-from typing import Any, List           # Type hinting
+from pathlib import Path  # Paths related methods
+from typing import Any, Callable, Dict, List  # Type hinting
+from snakemake.exceptions import WorkflowError  # Fail with a clear message
+from snakemake.logging import logger  # Traces and loggings
 from snakemake.utils import validate   # Check Yaml/TSV formats
 
-from common_ngs_cleaning import sample_stream, fastq_pairs
+from common_ngs_cleaning import (
+    sample_stream, fastq_pairs, fq_link, read_design
+)
+from common_ngs_cleaning import (
+    load_model, name_regex, size_aware_resource, size_aware_threads,
+    small_sample_batches, validate_design
+)
+from fastq_codecs import codec_suffix
+from resource_model import estimate_resource
+from stage_fastq import mount_of, read_mounts, staging_method
 
 # Snakemake-Wrappers version
 wrapper_version = "https://raw.githubusercontent.com/snakemake/snakemake-wrappers/0.62.0"
@@ -22,26 +37,401 @@ if config == dict():
     configfile: "config.yaml"
 validate(config, schema="../schemas/config.schema.yaml")
 
-# Loading deisgn file
-design = pandas.read_csv(
-    config["design"],
-    sep="\t",
-    header=0,
-    index_col=None,
-    dtype=str
+
+def build_sample_index() -> Dict[str, Any]:
+    """
+    Load and validate the design file, then build the sample mappings
+    used by the rules
+    """
+    design = read_design(config["design"])
+
+    # Rows are validated with jsonschema: pandas is slow to import
+    try:
+        validate_design(
+            design,
+            os.path.join(workflow.basedir, "schemas", "design.schema.yaml")
+        )
+    except ValueError as error:
+        raise WorkflowError(error)
+
+    # fastp parameters selected for each sample, if any (select_trimmer.py)
+    fastp_extra = {}
+    if "Fastp_extra" in design:
+        fastp_extra = {
+            sample: extra
+            for sample, extra in zip(
+                design["Sample_id"], design["Fastp_extra"]
+            )
+            if extra
+        }
+
+    return {
+        "rsample_list": sample_stream(design),
+        "fastq_pairs_dict": fastq_pairs(design),
+        "fq_link_dict": fq_link(design),
+        "fastp_extra_dict": fastp_extra
+    }
+
+
+# Loading design file
+sample_index = build_sample_index()
+rsample_list = sample_index["rsample_list"]
+fastq_pairs_dict = sample_index["fastq_pairs_dict"]
+fq_link_dict = sample_index["fq_link_dict"]
+fastp_extra_dict = sample_index["fastp_extra_dict"]
+
+wildcard_constraints:
+    sample = name_regex(fastq_pairs_dict.keys()),
+    rsample = name_regex(rsample_list),
+    stream = "R1|R2"
+
+
+# Source of each raw fastq file copied (not concatenated), as seen from the
+# working directory, where jobs are run
+single_fq_dict = {
+    name: os.path.join(config["workdir"], files[0])
+    for name, files in fq_link_dict.items()
+    if len(files) == 1
+}
+
+# Staging policy: how each raw fastq file reaches the working directory
+mounts = read_mounts()
+staging_policy = {
+    name: staging_method(
+        source,
+        config["workdir"],
+        config.get("cold_storage", [" "]),
+        mounts
+    )
+    for name, source in single_fq_dict.items()
+}
+
+# Raw fastq files already available in the local copy cache, if any, and
+# the arguments of stage_fastq.py serving copies from this cache
+cached_fq = set()
+copy_cache_args = ""
+if "copy_cache" in config:
+    cache_config = config["copy_cache"]
+    copy_cache_args = f"--cache {cache_config['path']}"
+    if cache_config.get("quota_gb") is not None:
+        copy_cache_args += f" --cache-quota {cache_config['quota_gb']}"
+    if cache_config.get("hash_edges", False) is True:
+        copy_cache_args += " --cache-hash-edges"
+    copy_cache_args += f" --cache-link {cache_config.get('link', 'hardlink')}"
+    from copy_cache import CopyCache
+    copy_cache = CopyCache(config["copy_cache"]["path"])
+    cached_sources = copy_cache.cached(single_fq_dict.values())
+    cached_fq = {
+        name
+        for name, source in single_fq_dict.items()
+        if source in cached_sources
+    }
+
+# Files sequenced over multiple lanes are concatenated, not copied
+merged_fq_regex = "|".join(
+    re.escape(name) for name, files in fq_link_dict.items() if len(files) > 1
+) or "$^"
+
+def preflight_design() -> None:
+    """
+    Check that the raw fastq files of all samples exist and are not
+    truncated (see scripts/check_design.py), and fail with all failing
+    samples at once. Verified files are remembered between runs.
+    """
+    from check_design import preflight
+
+    samples = {
+        sample: [fq_link_dict[os.path.basename(path)] for path in pairs]
+        for sample, pairs in fastq_pairs_dict.items()
+    }
+    errors = preflight(
+        samples,
+        config["workdir"],
+        Path(".snakemake", "ngs_cleaning", "preflight.json")
+    )
+    for sample, sample_errors in errors.items():
+        for error in sample_errors:
+            logger.error(f"{sample}: {error}")
+    if errors:
+        raise WorkflowError(
+            f"{len(errors)} of {len(samples)} samples have missing or "
+            "truncated fastq files"
+        )
+
+
+# Resources are estimated from the size of the raw fastq files, with
+# coefficients fitted from past benchmarks (scripts/resource_model.py)
+resource_model = load_model(config.get("resource_model"))
+
+
+def max_threads(rule_name: str, default: int) -> int:
+    """
+    Return the maximum number of threads of a rule: the count tuned by
+    scripts/autotune_threads.py if any, the configured threads otherwise
+    """
+    return config.get("rule_threads", {}).get(
+        rule_name, config.get("threads", default)
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def raw_fq_size_gb(name: str) -> float:
+    """
+    Return the size in GB of the source files of a raw fastq file. Sources
+    are stated only when a job needs them, then remembered.
+    """
+    size = 0
+    for source in fq_link_dict.get(name, []):
+        try:
+            size += os.stat(os.path.join(config["workdir"], source)).st_size
+        except OSError:
+            pass
+    return size / 1024 ** 3
+
+
+def files_size_gb(wildcards: Any) -> float:
+    """
+    Return the input size of a staging job, in GB
+    """
+    return raw_fq_size_gb(wildcards.files)
+
+
+def raw_sample_size_gb(sample: str) -> float:
+    """
+    Return the size in GB of the source files of a sample, all streams
+    included
+    """
+    return sum(
+        raw_fq_size_gb(os.path.basename(path))
+        for path in fastq_pairs_dict[sample]
+    )
+
+
+def sample_size_gb(wildcards: Any) -> float:
+    """
+    Return the input size of a sample, all streams included, in GB
+    """
+    return raw_sample_size_gb(wildcards.sample)
+
+
+def raw_rsample_size_gb(rsample: str) -> float:
+    """
+    Return the size in GB of the source files of a single stream of a
+    sample
+    """
+    sample, _, stream = rsample.rpartition(".R")
+    if sample in fastq_pairs_dict and stream in ["1", "2"]:
+        return raw_fq_size_gb(f"{sample}_R{stream}.fastq.gz")
+    return raw_fq_size_gb(f"{rsample}.fastq.gz")
+
+
+def rsample_size_gb(wildcards: Any) -> float:
+    """
+    Return the input size of a single stream of a sample, in GB
+    """
+    return raw_rsample_size_gb(wildcards.rsample)
+
+
+def rsamples_size_gb(rsamples: List[str]) -> Callable[[Any], float]:
+    """
+    Return a function returning the input size of a batch of single
+    streams of samples, in GB
+    """
+    def size_w(wildcards: Any) -> float:
+        return sum(raw_rsample_size_gb(rsample) for rsample in rsamples)
+    return size_w
+
+
+def chunk_size_gb(wildcards: Any) -> float:
+    """
+    Return the input size of a chunk of a sample, in GB
+    """
+    return sample_size_gb(wildcards) / fastp_chunks[wildcards.sample]
+
+
+# Very large samples are split and trimmed by chunks, see rules/fastp.smk
+fastp_chunks = {}
+if "fastp_chunks" in config:
+    chunking = config["fastp_chunks"]
+    for sample in fastq_pairs_dict:
+        chunks = chunking.get("chunks") or math.ceil(
+            raw_sample_size_gb(sample)
+            / (chunking.get("chunk_size_gb") or 10)
+        )
+        chunks = min(chunks, chunking.get("max_chunks", 64))
+        if chunks > 1:
+            fastp_chunks[sample] = chunks
+
+chunked_sample_regex = "|".join(
+    re.escape(sample) for sample in fastp_chunks
+) or "$^"
+
+# The fused fastp_trimmer is the only rule writing subsamples, so the
+# gather_fastp_chunks ruleorder does not cover them: chunked samples are
+# excluded from it, and subsample_fastq reads their gathered files
+fused_sample_regex = name_regex(
+    fastq_pairs_dict, fastp_chunks, r"\.(?:R[12]|fastp)\."
+)
+
+
+# Small samples are trimmed by batches, by a single job looping over them,
+# so that scheduling and container startup are paid once per batch
+fastp_batches = []
+if "fastp_batch" in config:
+    batching = config["fastp_batch"]
+    fastp_batches = small_sample_batches(
+        {
+            sample: raw_sample_size_gb(sample)
+            for sample in fastq_pairs_dict
+            if sample not in fastp_chunks
+        },
+        batching.get("max_size_mb", 200) / 1024,
+        lambda size_gb: estimate_resource(
+            resource_model, "fastp_trimmer", "time_min", size_gb
+        ),
+        batching.get("target_minutes", 60),
+        batching.get("max_samples", 50)
+    )
+batched_samples = {sample for batch in fastp_batches for sample in batch}
+
+# Batch rules have no wildcards: Snakemake prefers them to fastp_trimmer
+# and subsample_fastq for the files of batched samples, so these samples
+# need no exclusion regex. Chunked samples rely on a ruleorder, and on
+# fused_sample_regex.
+
+# In streaming mode, raw reads of unchunked samples are streamed into fastp
+# from their storage (see scripts/stream_fastq.py), instead of being staged
+# in raw_data first. Raw files are still staged when other jobs read them.
+streamed_samples = set()
+if config.get("streaming", False) is True:
+    raw_readers = [
+        option for option in ["fastq_stats", "pair_check"]
+        if config.get(option, False) is True
+    ]
+    if raw_readers:
+        logger.info(
+            "Raw reads are staged, not streamed: "
+            f"{', '.join(raw_readers)} read them again"
+        )
+    else:
+        streamed_samples = {
+            sample for sample in fastq_pairs_dict
+            if sample not in fastp_chunks
+        }
+streamed_fq = {
+    os.path.basename(path)
+    for sample in streamed_samples
+    for path in fastq_pairs_dict[sample]
+}
+
+# Raw fastq files staged together by a single job, if any
+staging_batches = []
+if "staging" in config:
+    single_fq = [name for name in single_fq_dict if name not in streamed_fq]
+    batch_size = config["staging"].get("batch_size", 32)
+    staging_batches = [
+        single_fq[i:i + batch_size]
+        for i in range(0, len(single_fq), batch_size)
+    ]
+
+
+def staging_manifest_rows() -> List[str]:
+    """
+    Return the rows of the staging manifest: how each raw fastq file is
+    staged, the mount point and file system of its source, and its sources
+    """
+    rows = []
+    for name, sources in fq_link_dict.items():
+        method = (
+            "stream" if name in streamed_fq
+            else staging_policy.get(name, "concatenate")
+        )
+        mount, fstype = mount_of(
+            os.path.join(config["workdir"], sources[0]), mounts
+        )
+        rows.append(
+            f"{name}\t{method}\t{mount}\t{fstype}\t{','.join(sources)}"
+        )
+    return rows
+
+
+# Codec of trimmed reads (see scripts/fastq_codecs.py): fastp compresses
+# gzip files itself, other codecs are written from its standard output
+trimmed_codec = config.get("trimmed_codec", {}).get("codec", "gzip")
+trimmed_level = config.get("trimmed_codec", {}).get("level")
+trimmed_ext = codec_suffix(trimmed_codec)
+fastp_compression = ""
+if trimmed_codec != "gzip":
+    # Trimmed chunks are compressed again when gathered
+    fastp_compression = "--compression 1"
+elif trimmed_level is not None:
+    fastp_compression = f"--compression {trimmed_level}"
+# Codec arguments of fastq_codecs.py and subsample_fastq.py alike
+codec_args = f"--codec {trimmed_codec}" + (
+    f" --level {trimmed_level}" if trimmed_level is not None else ""
 )
-design.set_index(design["Sample_id"])
-validate(design, schema="../schemas/design.schema.yaml")
 
 
-rsample_list = sample_stream(design)
-fastq_pairs_dict = fastq_pairs(design)
+# Read files screened together by a single fastq_screen job, if any
+fqscreen_batches = []
+if "fastq_screen_batch" in config:
+    batch_size = config["fastq_screen_batch"].get("batch_size", 50)
+    fqscreen_batches = [
+        rsample_list[i:i + batch_size]
+        for i in range(0, len(rsample_list), batch_size)
+    ]
+
+
+def fastq_screen_command(local_conf: str) -> str:
+    """
+    Return the fastq_screen command line, up to its configuration. When
+    screening indexes are staged on node-local storage, fastq_screen is
+    run by stage_screen_index.py with a configuration written at
+    local_conf, which points to local copies of indexes.
+    """
+    conf = config["params"].get(
+        "fastq_screen_config", "fastq_screen_config.tsv"
+    )
+    if "screen_index_staging" not in config:
+        return f"fastq_screen --conf {conf}"
+
+    staging = config["screen_index_staging"]
+    return (
+        f"python3 {script_path('stage_screen_index.py')} --config {conf}"
+        f" --local {staging.get('path', '/dev/shm/ngs-cleaning')}"
+        f" --local-config {local_conf}"
+        f" --max-idle {staging.get('max_idle_hours', 1)}"
+        + (
+            f" --max-gb {staging['max_gb']}"
+            if staging.get("max_gb") is not None else ""
+        )
+        + f" -- fastq_screen --conf {local_conf}"
+    )
+
+
+def script_path(name: str) -> str:
+    """
+    Return the absolute path to a script of this pipeline
+    """
+    return os.path.join(workflow.basedir, "scripts", name)
+
+
+def fastp_extra(sample: str) -> str:
+    """
+    Return the fastp parameters of a sample: its own if it has some in the
+    design, the ones of the configuration otherwise
+    """
+    extra = fastp_extra_dict.get(
+        sample, config["params"].get("fastp_extra", "")
+    )
+    return f"{extra} {fastp_compression}".strip()
+
 
-# wildcard_constraints:
-#     sample = "|"join(design.Sample_id)
-#     rsample = "|".join(rsample_list),
-#     stream = "R1|R2,
-#     format = "|".join(["txt", "png", "html", "json"])
+def fastp_extra_w(wildcards: Any) -> str:
+    """
+    Return the fastp parameters of a sample, see fastp_extra
+    """
+    return fastp_extra(wildcards.sample)
 
 
 def fq_pairs_w(wildcards: Any) -> List[str]:
@@ -51,22 +441,226 @@ def fq_pairs_w(wildcards: Any) -> List[str]:
     return {"sample": fastq_pairs_dict[wildcards.sample]}
 
 
+def trimming_inputs(sample: str) -> Dict[str, Any]:
+    """
+    Return the raw fastq files of a sample (their sources, if the sample
+    is streamed), and its manifest if mates are to be checked before
+    trimming
+    """
+    if sample in streamed_samples:
+        return {"sample": [
+            source
+            for path in fastq_pairs_dict[sample]
+            for source in fq_link_dict[os.path.basename(path)]
+        ]}
+    inputs = {"sample": fastq_pairs_dict[sample]}
+    if config.get("pair_check", False) is True:
+        inputs["manifest"] = f"qc/pairs/{sample}.json"
+    return inputs
+
+
+def fastp_inputs_w(wildcards: Any) -> Dict[str, Any]:
+    """
+    Return the inputs of the trimming of a sample, see trimming_inputs
+    """
+    return trimming_inputs(wildcards.sample)
+
+
+def fastp_reads(sample: str) -> str:
+    """
+    Return the beginning of the fastp command line of a sample: fastp
+    reads the raw fastq files, or, if the sample is streamed, the standard
+    output of stream_fastq.py
+    """
+    pairs = fastq_pairs_dict[sample]
+    if sample not in streamed_samples:
+        return "fastp " + " ".join(
+            f"--in{mate} {path}" for mate, path in enumerate(pairs, 1)
+        )
+
+    mates = " ".join(
+        f"--r{mate} " + " ".join(fq_link_dict[os.path.basename(path)])
+        for mate, path in enumerate(pairs, 1)
+    )
+    interleaved = " --interleaved_in" if len(pairs) == 2 else ""
+    return (
+        f"python3 {script_path('stream_fastq.py')} {mates}"
+        f" | fastp --stdin{interleaved}"
+    )
+
+
+def fastp_reads_w(wildcards: Any) -> str:
+    """
+    Return the beginning of the fastp command line of a sample, see
+    fastp_reads
+    """
+    return fastp_reads(wildcards.sample)
+
+
+def batch_outputs(batch: List[str]) -> Dict[str, List[str]]:
+    """
+    Return the outputs of the trimming of a batch of samples, as the
+    fastp_trimmer rule names them
+    """
+    outputs = {
+        "trimmed": [
+            f"fastp/trimmed/{sample}.R{mate}.{trimmed_ext}"
+            for sample in batch for mate in ["1", "2"]
+        ],
+        "html": [f"fastp/html/{sample}.fastp.html" for sample in batch],
+        "json": [f"fastp/json/{sample}.fastp.json" for sample in batch],
+    }
+    if config.get("fused_subsample", False) is True:
+        outputs["subsample"] = [
+            f"fqscreen/subsample/{sample}.R{mate}.fastq"
+            for sample in batch for mate in ["1", "2"]
+        ]
+    return outputs
+
+
+def batch_trimming_command(sample: str, threads: int) -> str:
+    """
+    Return the command line trimming a sample within a batch job: the one
+    of the fastp_trimmer rule, in the same mode (fused subsample, codec of
+    trimmed reads, streaming). Outputs of missing mates are touched by the
+    batch job.
+    """
+    outputs = batch_outputs([sample])
+    mates = len(fastq_pairs_dict[sample])
+    trimmed = outputs["trimmed"][:mates]
+    fastp = (
+        f"{fastp_reads(sample)} --thread {threads}"
+        f" --html {outputs['html'][0]} --json {outputs['json'][0]}"
+        f" {fastp_extra(sample)}"
+    )
+    codec_threads = max(threads // 2, 1)
+    if config.get("fused_subsample", False) is True:
+        return (
+            f"{fastp} --stdout | python3 {script_path('subsample_fastq.py')}"
+            f" - --tee {' '.join(trimmed)}"
+            f" --output {' '.join(outputs['subsample'][:mates])}"
+            f" --reads {config['params'].get('fastq_screen_subset', 100000)}"
+            f" {codec_args} --threads {codec_threads}"
+        )
+    if trimmed_codec != "gzip":
+        return (
+            f"{fastp} --stdout | python3 {script_path('fastq_codecs.py')}"
+            f" - --output {' '.join(trimmed)} {codec_args}"
+            f" --threads {codec_threads}"
+        )
+    return fastp + "".join(
+        f" --out{mate} {path}" for mate, path in enumerate(trimmed, 1)
+    )
+
+
+def chunk_streams(sample: str) -> List[str]:
+    """
+    Return the streams of a sample, as named in its chunks
+    """
+    return ["R1", "R2"][:len(fastq_pairs_dict[sample])]
+
+
+def fq_chunks_w(wildcards: Any) -> Dict[str, List[str]]:
+    """
+    Return the raw fastq files of a chunk of a sample
+    """
+    return {"sample": expand(
+        "fastp/chunks/{sample}/raw/{chunk}.{stream}.fastq.gz",
+        sample=wildcards.sample,
+        chunk=wildcards.chunk,
+        stream=chunk_streams(wildcards.sample)
+    )}
+
+
+def trimmed_chunks_w(wildcards: Any) -> Dict[str, List[str]]:
+    """
+    Return the trimmed fastq files and fastp reports of all the chunks of
+    a sample
+    """
+    chunks = range(fastp_chunks[wildcards.sample])
+    inputs = {
+        f"R{stream}": expand(
+            "fastp/chunks/{sample}/trimmed/{chunk}.R{stream}.fastq.gz",
+            sample=wildcards.sample, chunk=chunks, stream=stream
+        )
+        for stream in ["1", "2"]
+    }
+    inputs["json"] = expand(
+        "fastp/chunks/{sample}/json/{chunk}.fastp.json",
+        sample=wildcards.sample, chunk=chunks
+    )
+    return inputs
+
+
+# Quality metrics are gathered in a cohort table, see rules/metrics.smk
+metrics_format = config.get("metrics_store", {}).get("format", "tsv")
+
+
+def fastp_json_output(path: str) -> str:
+    """
+    Return the fastp JSON report output, temporary unless it is kept
+    """
+    if config.get("keep_fastp_json", True) is True:
+        return path
+    return temp(path)
+
+
+def metrics_inputs_w(wildcards: Any) -> Dict[str, Any]:
+    """
+    Return the reports parsed in the metrics row of a sample
+    """
+    inputs = {"fastp": f"fastp/json/{wildcards.sample}.fastp.json"}
+    if config.get("pair_check", False) is True:
+        inputs["manifest"] = f"qc/pairs/{wildcards.sample}.json"
+    if config.get("run_fqscreen", False) is True:
+        inputs["screen"] = expand(
+            "fqscreen/{sample}.{stream}.fastq_screen.txt",
+            sample=wildcards.sample,
+            stream=chunk_streams(wildcards.sample)
+        )
+    return inputs
+
+
 def get_targets(get_trimmed: bool = False,
                 get_fqscreen: bool = False,
                 get_fastp: bool = False,
-                get_multiqc: bool = False):
+                get_multiqc: bool = False,
+                get_staging_manifest: bool = False,
+                get_fastq_stats: bool = False,
+                get_metrics: bool = False,
+                get_fastp_summary: bool = False,
+                get_perf_history: bool = False):
     targets = dict()
 
+    if get_perf_history is True and "perf_history" in config:
+        targets["perf_history"] = "qc/perf_history.tsv"
+
+    if get_metrics is True and "metrics_store" in config:
+        targets["metrics"] = "multiqc/metrics.html"
+
+    if get_fastp_summary is True:
+        targets["fastp_summary"] = f"multiqc/fastp_summary.{metrics_format}"
+
+    if get_fastq_stats is True and config.get("fastq_stats", False) is True:
+        targets["fastq_stats"] = expand(
+            "qc/{stage}/{sample}.stats.json",
+            sample=fastq_pairs_dict.keys(),
+            stage=["before", "after"]
+        )
+
+    if get_staging_manifest is True:
+        targets["staging_manifest"] = "staging/manifest.tsv"
+
     if get_trimmed is True:
         targets["trimmed"] = expand(
-            "fastp/trimmed/{rsample}.fastq.gz",
+            f"fastp/trimmed/{{rsample}}.{trimmed_ext}",
             rsample=rsample_list
         )
 
     if get_fastp is True:
         targets["fastp_reports"] = expand(
             "fastp/{format}/{sample}.fastp.{format}",
-            sample=design.Sample_id,
+            sample=fastq_pairs_dict.keys(),
             format=["json", "html"]
         )
 
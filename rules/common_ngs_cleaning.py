@@ -7,15 +7,246 @@ of the common.smk in order to be tested
 """
 
 import os
+import re
 import sys
 
+from typing import Any, Callable, Dict, Iterable, List
+
 script_path = os.sep.join(
     [os.path.dirname(os.path.abspath(__file__)), "..", "scripts"]
 )
-sys.path.append(script_path)
+if script_path not in sys.path:
+    sys.path.append(script_path)
 
 try:
-    from common_script_ngs_cleaning import *
+    from common_script_ngs_cleaning import (
+        fastq_pairs, fq_link, read_design, sample_stream
+    )
 except ImportError:
     print(f"Could not find common_script_ngs_cleaning at {script_path}")
     raise
+
+from resource_model import estimate_resource, estimate_threads, load_model
+
+
+def size_aware_resource(
+    model: Dict[str, Any],
+    rule: str,
+    resource: str,
+    size_gb: Callable[[Any], float]
+) -> Callable[[Any, int], int]:
+    """
+    Return a Snakemake resource function, estimating the given resource
+    from the size of the input files of a job, and the attempt number
+
+    Parameters:
+        model       Dict[str, Any]          See resource_model.load_model
+        rule        str                     Name of the rule in the model
+        resource    str                     Name of the resource
+        size_gb     Callable[[Any], float]  Size of the input files of a
+                                            job, given its wildcards
+    """
+    def resource_w(wildcards: Any, attempt: int) -> int:
+        return estimate_resource(
+            model, rule, resource, size_gb(wildcards), attempt
+        )
+    return resource_w
+
+
+def size_aware_threads(
+    model: Dict[str, Any],
+    rule: str,
+    size_gb: Callable[[Any], float],
+    max_threads: int
+) -> Callable[[Any], int]:
+    """
+    Return a Snakemake threads function, estimating the number of threads
+    from the size of the input files of a job
+    """
+    def threads_w(wildcards: Any) -> int:
+        return estimate_threads(model, rule, size_gb(wildcards), max_threads)
+    return threads_w
+
+
+def small_sample_batches(
+    sizes_gb: Dict[str, float],
+    max_sample_gb: float,
+    batch_minutes: Callable[[float], float],
+    target_minutes: float,
+    max_samples: int = 50
+) -> List[List[str]]:
+    """
+    Pack samples smaller than max_sample_gb in batches, in the given order,
+    as long as the estimated runtime of a batch, given its input size,
+    stays under target_minutes. Samples alone in their batch are left out.
+
+    Example:
+    >>> small_sample_batches(
+    ...     {"A": 0.1, "B": 5, "C": 0.2, "D": 0.1}, 1, lambda gb: 60 * gb, 20
+    ... )
+    [['A', 'C']]
+    """
+    batches: List[List[str]] = [[]]
+    batch_gb = 0
+    for sample, size_gb in sizes_gb.items():
+        if size_gb >= max_sample_gb:
+            continue
+        if batches[-1] and (
+            len(batches[-1]) >= max_samples
+            or batch_minutes(batch_gb + size_gb) > target_minutes
+        ):
+            batches.append([])
+            batch_gb = 0
+        batches[-1].append(sample)
+        batch_gb += size_gb
+    return [batch for batch in batches if len(batch) > 1]
+
+
+def test_small_sample_batches() -> None:
+    """
+    This function tests the packing of small samples in batches
+
+    Example:
+    pytest -v ./common_ngs_cleaning.py -k test_small_sample_batches
+    """
+    sizes = {f"S{sample}": 0.1 for sample in range(7)}
+    assert small_sample_batches(sizes, 1, lambda gb: 20, 60, 3) == [
+        ["S0", "S1", "S2"], ["S3", "S4", "S5"]
+    ]
+    assert small_sample_batches(sizes, 0.1, lambda gb: 20, 60) == []
+    assert small_sample_batches(sizes, 1, lambda gb: 20 + 100 * gb, 45) == [
+        ["S0", "S1"], ["S2", "S3"], ["S4", "S5"]
+    ]
+
+
+def validate_design(design: Dict[str, List[str]], schema_path: str) -> None:
+    """
+    Validate each row of a design, loaded as columns, against the design
+    JSON schema. jsonschema and yaml are Snakemake dependencies: pandas is
+    not needed.
+    """
+    import jsonschema  # Validate rows
+    import yaml  # Load the schema
+
+    with open(schema_path) as schema_stream:
+        schema = yaml.safe_load(schema_stream)
+    validator = jsonschema.validators.validator_for(schema)(schema)
+    columns = list(design.keys())
+    for number, row in enumerate(zip(*design.values()), 1):
+        try:
+            validator.validate(dict(zip(columns, row)))
+        except jsonschema.ValidationError as error:
+            raise ValueError(
+                f"Design row {number} is not valid: {error.message}"
+            ) from error
+
+
+def test_validate_design(tmp_path: Any) -> None:
+    """
+    This function tests the validation of design rows
+
+    Example:
+    pytest -v ./common_ngs_cleaning.py -k test_validate_design
+    """
+    schema = os.path.join(script_path, "..", "schemas", "design.schema.yaml")
+    validate_design(
+        {"Sample_id": ["S1", "S2"], "Upstream_file": ["S1.fq", "S2.fq"]},
+        schema
+    )
+    try:
+        validate_design({"Sample_id": ["S1"]}, schema)
+    except ValueError as error:
+        assert "row 1" in str(error)
+    else:
+        raise AssertionError("Rows without Upstream_file should fail")
+
+
+def name_regex(
+    names: Iterable[str],
+    excluded: Iterable[str] = (),
+    follow: str = r"\."
+) -> str:
+    """
+    Return a wildcard constraint matching the given names: any string made
+    of the characters they use. Unlike an alternation of all names, it is
+    matched in linear time whatever the number of names.
+
+    It does not tell names apart: any string of these characters matches,
+    be it a sample name or not. It only keeps wildcards from spanning
+    directories or unexpected characters. Rules which must not match some
+    names need them excluded.
+
+    Excluded names, when followed by the `follow` pattern, are rejected by
+    a lookahead: only those are enumerated.
+
+    Example:
+    >>> name_regex(["S1", "S2_a"])
+    '[12S_a]+'
+    >>> name_regex(["S1", "S2"], excluded=["S1"])
+    '(?!(?:S1)\\\\.)[12S]+'
+    """
+    chars = sorted(set("".join(names)) - {"/"})
+    if not chars:
+        return "$^"
+    regex = "[" + "".join(re.escape(char) for char in chars) + "]+"
+    excluded = sorted(excluded)
+    if excluded:
+        regex = (
+            "(?!(?:" + "|".join(re.escape(name) for name in excluded) + ")"
+            + follow + ")" + regex
+        )
+    return regex
+
+
+def test_chunked_fused_dag(tmp_path: Any) -> None:
+    """
+    This function tests that, with fastp_chunks and fused_subsample,
+    chunked samples are trimmed by chunks only, and subsampled from their
+    gathered files
+
+    Example:
+    pytest -v ./common_ngs_cleaning.py -k test_chunked_fused_dag
+    """
+    import shutil  # Find Snakemake
+    import subprocess  # Run Snakemake
+    import pytest  # Skip without Snakemake
+
+    if shutil.which("snakemake") is None:
+        pytest.skip("Snakemake is not available")
+
+    with (tmp_path / "design.tsv").open("w") as design:
+        design.write("Sample_id\tUpstream_file\tDownstream_file\n")
+        for sample in ["A", "B"]:
+            mates = [tmp_path / f"{sample}_R{mate}.fq.gz" for mate in "12"]
+            for mate in mates:
+                mate.touch()
+            design.write(f"{sample}\t{mates[0]}\t{mates[1]}\n")
+    (tmp_path / "config.yaml").write_text(
+        f"design: {tmp_path / 'design.tsv'}\n"
+        f"workdir: {tmp_path}\n"
+        "threads: 1\n"
+        "singularity_docker_image: docker://continuumio/miniconda3:4.4.10\n"
+        "cold_storage: [' ']\n"
+        "run_fqscreen: true\n"
+        "fused_subsample: true\n"
+        "fastp_chunks:\n"
+        "  chunks: 2\n"
+        "params:\n"
+        "  fastq_screen_config: fastq_screen_config.tsv\n"
+    )
+    dry_run = subprocess.run(
+        [
+            "snakemake", "--dry-run", "--cores", "1",
+            "--snakefile", os.path.join(script_path, "..", "Snakefile"),
+            "--configfile", str(tmp_path / "config.yaml"),
+            "--directory", str(tmp_path)
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        universal_newlines=True
+    ).stdout
+    jobs = dict(re.findall(r"^(\w+)\s+(\d+)$", dry_run, re.MULTILINE))
+    assert "fastp_trimmer" not in jobs
+    assert jobs["fastp_chunk"] == "4"
+    assert jobs["gather_fastp_chunks"] == "2"
+    assert jobs["subsample_fastq"] == "4"
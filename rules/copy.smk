@@ -1,33 +1,194 @@
 """
 On most clusters, cold and hot storage coexist. Non-expert users might
 try to run IO intensive processes on data through cold storage and break
-either the pipeline or the mounting points on a cluster. This rule
-copies the fastq files.
-More information at:
-https://github.com/tdayris/yawn/tree/master/SnakemakeWrappers/cp/8.25
+either the pipeline or the mounting points on a cluster. These rules stage
+the fastq files in the working directory, following the staging policy
+built in common.smk: files on cold storage or on network file systems are
+copied, files on the same reflink-capable file system are cloned, other
+files are symlinked. Reflinks fall back to copies when cloning fails, so
+they are given the copy time model.
+
+When a copy cache is configured, copies are served from a persistent local
+cache, and only cache misses are copied from the cold storage.
+
+When staging is configured, files are staged by batches: each job copies
+the files of its batch with multiple concurrent streams.
+
+In streaming mode, files of streamed samples are not staged at all: they
+are read from their storage by the trimming jobs (see rules/fastp.smk).
 """
-rule copy_fastq:
+if "staging" in config:
+    for batch, batch_fq in enumerate(staging_batches):
+        rule:
+            input:
+                [fq_link_dict[name][0] for name in batch_fq]
+            output:
+                [temp(f"raw_data/{name}") for name in batch_fq]
+            message:
+                f"Staging batch {batch} ({len(batch_fq)} files)"
+            resources:
+                mem_mb = (
+                    lambda wildcards, attempt: min(attempt * 512, 2048)
+                ),
+                time_min = (
+                    lambda wildcards, attempt: min(attempt * 1440, 2832)
+                )
+            log:
+                report = f"logs/staging/batch_{batch}.tsv",
+                stderr = f"logs/staging/batch_{batch}.log"
+            benchmark:
+                f"benchmarks/staging/batch_{batch}.tsv"
+            threads:
+                config["staging"].get("threads", 8)
+            priority: 1
+            conda:
+                "../envs/python.yaml"
+            params:
+                script = script_path("stage_fastq.py"),
+                methods = [staging_policy[name] for name in batch_fq],
+                retries = config["staging"].get("retries", 3),
+                cache = copy_cache_args
+            shell:
+                "python3 {params.script} --input {input} --output {output}"
+                " --methods {params.methods}"
+                " --threads {threads} --retries {params.retries}"
+                " {params.cache} --report {log.report} > {log.stderr} 2>&1"
+else:
+    copy_time_min = size_aware_resource(
+        resource_model, "copy_fastq", "time_min", files_size_gb
+    )
+
+    rule copy_fastq:
+        input:
+            lambda wildcards: fq_link_dict[wildcards.files][0]
+        output:
+            temp("raw_data/{files}")
+        message:
+            "Staging {wildcards.files} for further process"
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "copy_fastq", "mem_mb", files_size_gb
+            ),
+            time_min = (
+                lambda wildcards, attempt: (
+                    attempt * 5
+                    if wildcards.files in cached_fq
+                    or staging_policy[wildcards.files] == "symlink"
+                    else copy_time_min(wildcards, attempt)
+                )
+            )
+        log:
+            report = "logs/copy/{files}.tsv",
+            stderr = "logs/copy/{files}.log"
+        benchmark:
+            "benchmarks/copy_fastq/{files}.tsv"
+        wildcard_constraints:
+            files = r"[^/]+"
+        threads: 1
+        priority: 1
+        conda:
+            "../envs/python.yaml"
+        params:
+            script = script_path("stage_fastq.py"),
+            method = lambda wildcards: staging_policy[wildcards.files],
+            cache = copy_cache_args
+        shell:
+            "python3 {params.script} --input {input} --output {output}"
+            " --methods {params.method} {params.cache}"
+            " --report {log.report} > {log.stderr} 2>&1"
+
+
+"""
+The staging manifest depends on the design and on the staging policy: it
+is written again when the design changes, or when the method, mount point
+or sources of a file change (cold_storage, mounts, streaming).
+"""
+rule staging_manifest:
+    input:
+        config["design"]
+    output:
+        "staging/manifest.tsv"
+    message:
+        "Recording how raw fastq files were staged"
+    benchmark:
+        "benchmarks/staging_manifest/manifest.tsv"
+    params:
+        rows = lambda wildcards: staging_manifest_rows()
+    run:
+        with open(output[0], "w") as manifest:
+            manifest.write("file\tmethod\tmount_point\tfstype\tsources\n")
+            manifest.writelines(f"{row}\n" for row in params.rows)
+
+
+"""
+Samples sequenced over multiple lanes are listed with multiple fastq files
+in the design. Their gzip members are streamed one after each other from
+the cold storage to a single file: one read, one write, no recompression.
+"""
+rule concatenate_fastq:
     input:
         lambda wildcards: fq_link_dict[wildcards.files]
     output:
         temp("raw_data/{files}")
     message:
-        "Copying {wildcards.files} for further process"
+        "Concatenating lanes of {wildcards.files}"
     resources:
-        mem_mb = (
-            lambda wildcards, attempt: min(attempt * 128, 512)
+        mem_mb = size_aware_resource(
+            resource_model, "concatenate_fastq", "mem_mb", files_size_gb
         ),
-        time_min = (
-            lambda wildcards, attempt: min(attempt * 1440, 2832)
+        time_min = size_aware_resource(
+            resource_model, "concatenate_fastq", "time_min", files_size_gb
         )
     log:
-        "logs/copy/{files}.log"
+        "logs/concatenate/{files}.log"
+    benchmark:
+        "benchmarks/concatenate_fastq/{files}.tsv"
     wildcard_constraints:
-        files = r"[^/]+"
+        files = merged_fq_regex
     threads: 1
     priority: 1
+    conda:
+        "../envs/python.yaml"
+    params:
+        script = script_path("concatenate_fastq.py")
+    shell:
+        "python3 {params.script} {input} --output {output} > {log} 2>&1"
+
+
+"""
+Optionally, mates are checked to hold the same number of records before
+trimming: a partial transfer fails here, not inside fastp. The manifest
+of each sample (records, bases, CRC32 of each mate) is kept for reports.
+"""
+rule pair_manifest:
+    input:
+        unpack(fq_pairs_w)
+    output:
+        "qc/pairs/{sample}.json"
+    message:
+        "Checking the mates of {wildcards.sample}"
+    threads: 2
+    resources:
+        mem_mb = (
+            lambda wildcards, attempt: min(attempt * 512, 2048)
+        ),
+        time_min = size_aware_resource(
+            resource_model, "pair_manifest", "time_min", sample_size_gb
+        )
+    log:
+        "logs/pair_manifest/{sample}.log"
+    benchmark:
+        "benchmarks/pair_manifest/{sample}.tsv"
+    conda:
+        "../envs/python.yaml"
     params:
-        extra = config["params"].get("copy_extra", ""),
-        cold_storage = config.get("cold_storage", ["NONE"])
-    wrapper:
-        f"{git}/bio/cp"
+        script = script_path("pair_manifest.py")
+    shell:
+        "python3 {params.script} {input.sample}"
+        " --sample {wildcards.sample} --output {output} > {log} 2>&1"
+
+
+localrules: concatenate_fastq, staging_manifest
+if "staging" not in config:
+    localrules: copy_fastq
+    ruleorder: concatenate_fastq > copy_fastq
@@ -1,31 +1,460 @@
-rule fastp_trimmer:
+"""
+In fused mode, fastp streams trimmed reads to its standard output. They
+are written to the trimmed files and sampled for fastq_screen at the same
+time, so that trimmed files are never read back for screening. Single-end
+samples get empty R2 files, as with the wrapper.
+
+fastp only writes gzip files, at the level given with trimmed_codec. Other
+codecs (BGZF, zstd) are written from the standard output of fastp too, by
+scripts/fastq_codecs.py.
+
+In streaming mode, raw reads are not staged in raw_data: they are read
+from their storage by scripts/stream_fastq.py, and piped to fastp within
+the trimming job. With fused_subsample, reads are then streamed from the
+raw storage to the trimmed files and the subsample, without intermediate
+files.
+"""
+if config.get("fused_subsample", False) is True:
+    rule fastp_trimmer:
+        input:
+            unpack(fastp_inputs_w)
+        output:
+            trimmed = [
+                f"fastp/trimmed/{{sample}}.R1.{trimmed_ext}",
+                f"fastp/trimmed/{{sample}}.R2.{trimmed_ext}"
+            ],
+            html = report(
+                "fastp/html/{sample}.fastp.html",
+                caption="../report/fastp.rst",
+                category="Quality controls"
+            ),
+            json = fastp_json_output("fastp/json/{sample}.fastp.json"),
+            subsample = [
+                temp("fqscreen/subsample/{sample}.R1.fastq"),
+                temp("fqscreen/subsample/{sample}.R2.fastq")
+            ]
+        message:
+            "Trimming, controling quality and subsampling "
+            "{wildcards.sample}"
+        wildcard_constraints:
+            sample = fused_sample_regex
+        threads:
+            size_aware_threads(
+                resource_model, "fastp_trimmer", sample_size_gb,
+                max_threads("fastp_trimmer", 10)
+            )
+        params:
+            extra = fastp_extra_w,
+            fastp = fastp_reads_w,
+            outputs = lambda wildcards, output: " ".join(
+                ["--tee"]
+                + output.trimmed[:len(fastq_pairs_dict[wildcards.sample])]
+                + ["--output"]
+                + output.subsample[:len(fastq_pairs_dict[wildcards.sample])]
+            ),
+            script = script_path("subsample_fastq.py"),
+            reads = config["params"].get("fastq_screen_subset", 100000),
+            codec = codec_args,
+            codec_threads = lambda wildcards, threads: max(threads // 2, 1)
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "fastp_trimmer", "mem_mb", sample_size_gb
+            ),
+            time_min = size_aware_resource(
+                resource_model, "fastp_trimmer", "time_min", sample_size_gb
+            )
+        log:
+            "logs/fastp/{sample}.log"
+        benchmark:
+            "benchmarks/fastp_trimmer/{sample}.tsv"
+        conda:
+            "../envs/fastp.yaml"
+        shell:
+            "({params.fastp} --stdout --thread {threads}"
+            " --html {output.html} --json {output.json} {params.extra}"
+            " | python3 {params.script} - {params.outputs}"
+            " --reads {params.reads} {params.codec}"
+            " --threads {params.codec_threads}"
+            " && touch {output.trimmed} {output.subsample}) 2> {log}"
+
+
+elif trimmed_codec != "gzip":
+    rule fastp_trimmer:
+        input:
+            unpack(fastp_inputs_w)
+        output:
+            trimmed = [
+                f"fastp/trimmed/{{sample}}.R1.{trimmed_ext}",
+                f"fastp/trimmed/{{sample}}.R2.{trimmed_ext}"
+            ],
+            html = report(
+                "fastp/html/{sample}.fastp.html",
+                caption="../report/fastp.rst",
+                category="Quality controls"
+            ),
+            json = fastp_json_output("fastp/json/{sample}.fastp.json")
+        message:
+            "Trimming and controling quality of {wildcards.sample}"
+        threads:
+            size_aware_threads(
+                resource_model, "fastp_trimmer", sample_size_gb,
+                max_threads("fastp_trimmer", 10)
+            )
+        params:
+            extra = fastp_extra_w,
+            fastp = fastp_reads_w,
+            outputs = lambda wildcards, output: " ".join(
+                output.trimmed[:len(fastq_pairs_dict[wildcards.sample])]
+            ),
+            script = script_path("fastq_codecs.py"),
+            codec = codec_args,
+            codec_threads = lambda wildcards, threads: max(threads // 2, 1)
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "fastp_trimmer", "mem_mb", sample_size_gb
+            ),
+            time_min = size_aware_resource(
+                resource_model, "fastp_trimmer", "time_min", sample_size_gb
+            )
+        log:
+            "logs/fastp/{sample}.log"
+        benchmark:
+            "benchmarks/fastp_trimmer/{sample}.tsv"
+        conda:
+            "../envs/fastp.yaml"
+        shell:
+            "({params.fastp} --stdout --thread {threads}"
+            " --html {output.html} --json {output.json} {params.extra}"
+            " | python3 {params.script} - --output {params.outputs}"
+            " {params.codec} --threads {params.codec_threads}"
+            " && touch {output.trimmed}) 2> {log}"
+
+
+elif streamed_samples:
+    rule fastp_trimmer:
+        input:
+            unpack(fastp_inputs_w)
+        output:
+            trimmed = [
+                f"fastp/trimmed/{{sample}}.R1.{trimmed_ext}",
+                f"fastp/trimmed/{{sample}}.R2.{trimmed_ext}"
+            ],
+            html = report(
+                "fastp/html/{sample}.fastp.html",
+                caption="../report/fastp.rst",
+                category="Quality controls"
+            ),
+            json = fastp_json_output("fastp/json/{sample}.fastp.json")
+        message:
+            "Streaming, trimming and controling quality of {wildcards.sample}"
+        threads:
+            size_aware_threads(
+                resource_model, "fastp_trimmer", sample_size_gb,
+                max_threads("fastp_trimmer", 10)
+            )
+        params:
+            extra = fastp_extra_w,
+            fastp = fastp_reads_w,
+            outputs = lambda wildcards, output: " ".join(
+                f"--out{mate} {path}"
+                for mate, path in enumerate(output.trimmed, 1)
+                if mate <= len(fastq_pairs_dict[wildcards.sample])
+            )
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "fastp_trimmer", "mem_mb", sample_size_gb
+            ),
+            time_min = size_aware_resource(
+                resource_model, "fastp_trimmer", "time_min", sample_size_gb
+            )
+        log:
+            "logs/fastp/{sample}.log"
+        benchmark:
+            "benchmarks/fastp_trimmer/{sample}.tsv"
+        conda:
+            "../envs/fastp.yaml"
+        shell:
+            "({params.fastp} {params.outputs} --thread {threads}"
+            " --html {output.html} --json {output.json} {params.extra}"
+            " && touch {output.trimmed}) 2> {log}"
+
+
+else:
+    rule fastp_trimmer:
+        input:
+            unpack(fastp_inputs_w)
+        output:
+            trimmed = [
+                f"fastp/trimmed/{{sample}}.R1.{trimmed_ext}",
+                f"fastp/trimmed/{{sample}}.R2.{trimmed_ext}"
+            ],
+            html = report(
+                "fastp/html/{sample}.fastp.html",
+                caption="../report/fastp.rst",
+                category="Quality controls"
+            ),
+            json = fastp_json_output("fastp/json/{sample}.fastp.json")
+        message:
+            "Trimming and controling quality of {wildcards.sample}"
+        threads:
+            size_aware_threads(
+                resource_model, "fastp_trimmer", sample_size_gb,
+                max_threads("fastp_trimmer", 10)
+            )
+        params:
+            extra = fastp_extra_w
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "fastp_trimmer", "mem_mb", sample_size_gb
+            ),
+            time_min = size_aware_resource(
+                resource_model, "fastp_trimmer", "time_min", sample_size_gb
+            )
+        log:
+            "logs/fastp/{sample}.log"
+        benchmark:
+            "benchmarks/fastp_trimmer/{sample}.tsv"
+        wrapper:
+            f"{git}/bio/fastp"
+
+
+"""
+Small samples are trimmed by batches, when fastp_batch is set: a single
+job loops over the samples of a batch, in the same way as fastp_trimmer,
+so that a single submission and container startup are paid per batch.
+Batches are filled with samples under max_size_mb, up to target_minutes
+of estimated runtime. With staging, raw files are copied by batches too.
+"""
+for batch, batch_samples in enumerate(fastp_batches):
+    rule:
+        input:
+            sample = [
+                path
+                for sample in batch_samples
+                for path in trimming_inputs(sample)["sample"]
+            ],
+            manifest = [
+                trimming_inputs(sample)["manifest"]
+                for sample in batch_samples
+                if "manifest" in trimming_inputs(sample)
+            ]
+        output:
+            trimmed = batch_outputs(batch_samples)["trimmed"],
+            html = [
+                report(
+                    path,
+                    caption="../report/fastp.rst",
+                    category="Quality controls"
+                )
+                for path in batch_outputs(batch_samples)["html"]
+            ],
+            json = [
+                fastp_json_output(path)
+                for path in batch_outputs(batch_samples)["json"]
+            ],
+            subsample = [
+                temp(path)
+                for path in batch_outputs(batch_samples).get("subsample", [])
+            ]
+        message:
+            f"Trimming batch {batch} ({len(batch_samples)} samples)"
+        threads:
+            size_aware_threads(
+                resource_model, "fastp_trimmer",
+                lambda wildcards, batch_samples=batch_samples: sum(
+                    raw_sample_size_gb(sample) for sample in batch_samples
+                ),
+                max_threads("fastp_trimmer", 10)
+            )
+        params:
+            commands = (
+                lambda wildcards, threads, batch_samples=batch_samples:
+                " && ".join(
+                    f"({batch_trimming_command(sample, threads)})"
+                    for sample in batch_samples
+                )
+            )
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "fastp_trimmer", "mem_mb",
+                lambda wildcards, batch_samples=batch_samples: max(
+                    raw_sample_size_gb(sample) for sample in batch_samples
+                )
+            ),
+            time_min = size_aware_resource(
+                resource_model, "fastp_trimmer", "time_min",
+                lambda wildcards, batch_samples=batch_samples: sum(
+                    raw_sample_size_gb(sample) for sample in batch_samples
+                )
+            )
+        log:
+            f"logs/fastp/batch_{batch}.log"
+        benchmark:
+            f"benchmarks/fastp_trimmer/batch_{batch}.tsv"
+        conda:
+            "../envs/fastp.yaml"
+        shell:
+            "({params.commands}"
+            " && touch {output.trimmed} {output.subsample}) 2> {log}"
+
+
+"""
+Very large samples are split into record-aligned chunks, trimmed by
+separate jobs, then gathered: trimmed chunks are concatenated and fastp
+reports are merged into a single report, which MultiQC still understands.
+"""
+for sample, chunks in fastp_chunks.items():
+    rule:
+        input:
+            **trimming_inputs(sample)
+        output:
+            [
+                temp(f"fastp/chunks/{sample}/raw/{chunk}.{stream}.fastq.gz")
+                for chunk in range(chunks)
+                for stream in chunk_streams(sample)
+            ]
+        message:
+            f"Splitting {sample} in {chunks} chunks"
+        threads: len(chunk_streams(sample))
+        resources:
+            mem_mb = (
+                lambda wildcards, attempt: min(attempt * 512, 2048)
+            ),
+            time_min = size_aware_resource(
+                resource_model, "split_fastq", "time_min",
+                lambda wildcards, sample=sample: raw_sample_size_gb(sample)
+            )
+        log:
+            f"logs/fastp/split/{sample}.log"
+        benchmark:
+            f"benchmarks/split_fastq/{sample}.tsv"
+        conda:
+            "../envs/python.yaml"
+        params:
+            script = script_path("split_fastq.py")
+        shell:
+            "python3 {params.script} --input {input.sample} --output {output}"
+            " > {log} 2>&1"
+
+
+rule fastp_chunk:
     input:
-        unpack(fq_pairs_w)
+        unpack(fq_chunks_w)
     output:
         trimmed = [
-            "fastp/trimmed/{sample}.R1.fastq.gz",
-            "fastp/trimmed/{sample}.R2.fastq.gz"
+            temp("fastp/chunks/{sample}/trimmed/{chunk}.R1.fastq.gz"),
+            temp("fastp/chunks/{sample}/trimmed/{chunk}.R2.fastq.gz")
+        ],
+        html = temp("fastp/chunks/{sample}/html/{chunk}.fastp.html"),
+        json = temp("fastp/chunks/{sample}/json/{chunk}.fastp.json")
+    message:
+        "Trimming and controling quality of {wildcards.sample}, "
+        "chunk {wildcards.chunk}"
+    wildcard_constraints:
+        sample = chunked_sample_regex,
+        chunk = r"\d+"
+    threads:
+        size_aware_threads(
+            resource_model, "fastp_trimmer", chunk_size_gb,
+            max_threads("fastp_trimmer", 10)
+        )
+    params:
+        extra = fastp_extra_w
+    resources:
+        mem_mb = size_aware_resource(
+            resource_model, "fastp_trimmer", "mem_mb", chunk_size_gb
+        ),
+        time_min = size_aware_resource(
+            resource_model, "fastp_trimmer", "time_min", chunk_size_gb
+        )
+    log:
+        "logs/fastp/{sample}.{chunk}.log"
+    benchmark:
+        "benchmarks/fastp_chunk/{sample}.{chunk}.tsv"
+    wrapper:
+        f"{git}/bio/fastp"
+
+
+rule gather_fastp_chunks:
+    input:
+        unpack(trimmed_chunks_w)
+    output:
+        trimmed = [
+            f"fastp/trimmed/{{sample}}.R1.{trimmed_ext}",
+            f"fastp/trimmed/{{sample}}.R2.{trimmed_ext}"
         ],
         html = report(
             "fastp/html/{sample}.fastp.html",
             caption="../report/fastp.rst",
             category="Quality controls"
         ),
-        json = temp("fastp/json/{sample}.fastp.json")
+        json = fastp_json_output("fastp/json/{sample}.fastp.json")
     message:
-        "Trimming and controling quality of {wildcards.sample}"
-    threads:
-        min(config.get("threads", 10), 10)
+        "Gathering trimmed chunks of {wildcards.sample}"
+    wildcard_constraints:
+        sample = chunked_sample_regex
+    threads: 1
+    resources:
+        mem_mb = (
+            lambda wildcards, attempt: min(attempt * 512, 2048)
+        ),
+        time_min = size_aware_resource(
+            resource_model, "gather_fastp_chunks", "time_min", sample_size_gb
+        )
+    log:
+        "logs/fastp/gather/{sample}.log"
+    benchmark:
+        "benchmarks/gather_fastp_chunks/{sample}.tsv"
+    conda:
+        "../envs/python.yaml"
     params:
-        extra = config["params"].get("fastp_extra", "")
+        # gzip members are concatenated, other codecs are written again
+        concatenate = (
+            script_path("concatenate_fastq.py") if trimmed_codec == "gzip"
+            else f"{script_path('fastq_codecs.py')} {codec_args}"
+        ),
+        merge = script_path("merge_fastp_json.py")
+    shell:
+        "(python3 {params.concatenate} {input.R1} --output {output.trimmed[0]}"
+        " && python3 {params.concatenate} {input.R2}"
+        " --output {output.trimmed[1]}"
+        " && python3 {params.merge} {input.json} --output {output.json}"
+        " --html {output.html}) > {log} 2>&1"
+
+
+ruleorder: gather_fastp_chunks > fastp_trimmer
+
+
+"""
+fastp JSON reports are kept, unless keep_fastp_json is false, and their
+main metrics are flattened in a typed table, next to the MultiQC report.
+Temporary reports are removed only after this table is written.
+"""
+rule fastp_summary:
+    input:
+        expand(
+            "fastp/json/{sample}.fastp.json",
+            sample=fastq_pairs_dict.keys()
+        )
+    output:
+        f"multiqc/fastp_summary.{metrics_format}"
+    message:
+        "Summarizing fastp reports"
+    threads: 1
     resources:
         mem_mb = (
-            lambda wildcards, attempt: min(attempt * 2048, 20480)
+            lambda wildcards, attempt: min(attempt * 1024, 10240)
         ),
         time_min = (
-            lambda wildcards, attempt: min(attempt * 20, 200)
+            lambda wildcards, attempt: attempt * 30
         )
     log:
-        "logs/fastp/{sample}.log"
-    wrapper:
-        f"{git}/bio/fastp"
+        "logs/fastp/summary.log"
+    benchmark:
+        "benchmarks/fastp_summary/summary.tsv"
+    conda:
+        "../envs/metrics.yaml"
+    params:
+        script = script_path("fastp_summary.py")
+    shell:
+        "python3 {params.script} {input} --output {output} > {log} 2>&1"
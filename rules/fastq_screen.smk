@@ -1,47 +1,200 @@
-rule fastq_screen:
+"""
+fastq_screen maps a uniform random sample of the trimmed reads. This
+sample is drawn in a single streaming pass, and is small enough to be
+screened in minutes.
+"""
+rule subsample_fastq:
     input:
-        "fastp/trimmed/{rsample}.fastq.gz"
+        f"fastp/trimmed/{{rsample}}.{trimmed_ext}"
     output:
-        txt = temp("fqscreen/{rsample}.fastq_screen.txt"),
-        png = temp("fqscreen/{rsample}.fastq_screen.png")
+        temp("fqscreen/subsample/{rsample}.fastq")
     message:
-        "Screening {wildcards.rsample}"
-    params:
-        subset = config["params"].get("fastq_screen_subset", 100000),
-        fastq_screen_config = config["params"].get(
-            "fastq_screen_config", "fastq_screen_config.tsv"
-        ),
-        # fastq_screen_config = {
-        #     "database": {
-        #         "Human": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Human/Homo_sapiens.GRCh38"},
-        #         "Mouse": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Mouse/Mus_musculus.GRCm38"},
-        #         "Rat": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Rat/Rnor_6.0"},
-        #         "Drosophila": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Drosophila/BDGP6"},
-        #         "Worm": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Worm/Caenorhabditis_elegans.WBcel235"},
-        #         "Yeast": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Yeast/Saccharomyces_cerevisiae.R64-1-1"},
-        #         "Arabidopsis": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Arabidopsis/Arabidopsis_thaliana.TAIR10"},
-        #         "Ecoli": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/E_coli/Ecoli"},
-        #         "rRNA": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/rRNA/GRCm38_rRNA"},
-        #         "MT": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Mitochondria/mitochondria"},
-        #         "PhiX": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/PhiX/phi_plus_SNPs"},
-        #         "Lambda": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Lambda/Lambda"},
-        #         "Vectors": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Vectors/Vectors"},
-        #         "Adapters": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Adapters/Contaminants"},
-        #         "SalmoSalar": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Salmo_salar/SalmoSalar.ICSASGv2"},
-        #     },
-        #     "aligner_paths": {'bowtie': 'bowtie', 'bowtie2': 'bowtie2'}
-        # },
-        aligner = config["params"].get("fastq_screen_aligner", 'bowtie2')
-    threads:
-        min(config.get("threads", 20), 20)
+        "Subsampling {wildcards.rsample} for contamination screening"
+    threads: 1
     resources:
-        mem_mb = (
-                lambda wildcards, attempt: min(10240 * attempt, 15360)
-            ),
-        time_min = (
-            lambda wildcards, attempt: 115 * attempt
+        mem_mb = size_aware_resource(
+            resource_model, "subsample_fastq", "mem_mb", rsample_size_gb
+        ),
+        time_min = size_aware_resource(
+            resource_model, "subsample_fastq", "time_min", rsample_size_gb
         )
     log:
-        "logs/fastq_screen/{rsample}.log"
-    wrapper:
-        f"{git}/bio/fastq_screen"
+        "logs/fastq_screen/subsample/{rsample}.log"
+    benchmark:
+        "benchmarks/subsample_fastq/{rsample}.tsv"
+    conda:
+        "../envs/python.yaml"
+    params:
+        script = script_path("subsample_fastq.py"),
+        reads = config["params"].get("fastq_screen_subset", 100000)
+    shell:
+        "python3 {params.script} {input} --output {output}"
+        " --reads {params.reads} > {log} 2>&1"
+
+
+if config.get("fused_subsample", False) is True:
+    ruleorder: fastp_trimmer > subsample_fastq
+
+
+"""
+Each fastq_screen job loads all the aligner indexes listed in its
+configuration. When fastq_screen_batch is set, read files are screened by
+batches: reads of the batch are multiplexed in a single file, screened by
+a single job, then dealt back to their files, so that indexes are loaded
+once per batch.
+
+When screen_index_staging is set, fastq_screen jobs copy the screening
+indexes to node-local storage (e.g. /dev/shm) once per node, and share
+these copies, see scripts/stage_screen_index.py.
+"""
+if "fastq_screen_batch" in config:
+    for batch, batch_rsamples in enumerate(fqscreen_batches):
+        rule:
+            input:
+                [f"fqscreen/subsample/{rsample}.fastq"
+                 for rsample in batch_rsamples]
+            output:
+                txt = [temp(f"fqscreen/{rsample}.fastq_screen.txt")
+                       for rsample in batch_rsamples],
+                png = [temp(f"fqscreen/{rsample}.fastq_screen.png")
+                       for rsample in batch_rsamples],
+                batch = temp(directory(f"fqscreen/batch/{batch}"))
+            message:
+                f"Screening batch {batch} ({len(batch_rsamples)} files)"
+            threads:
+                size_aware_threads(
+                    resource_model, "fastq_screen",
+                    rsamples_size_gb(batch_rsamples),
+                    max_threads("fastq_screen", 20)
+                )
+            resources:
+                mem_mb = size_aware_resource(
+                    resource_model, "fastq_screen", "mem_mb",
+                    rsamples_size_gb(batch_rsamples)
+                ),
+                time_min = size_aware_resource(
+                    resource_model, "fastq_screen", "time_min",
+                    rsamples_size_gb(batch_rsamples)
+                )
+            log:
+                f"logs/fastq_screen/batch_{batch}.log"
+            benchmark:
+                f"benchmarks/fastq_screen/batch_{batch}.tsv"
+            conda:
+                "../envs/fastq_screen.yaml"
+            params:
+                script = script_path("multiplex_fastq_screen.py"),
+                fastq_screen = fastq_screen_command(
+                    f"fqscreen/batch/{batch}/fastq_screen.conf"
+                ),
+                aligner = config["params"].get(
+                    "fastq_screen_aligner", "bowtie2"
+                ),
+                multiplexed = f"batch_{batch}.fastq",
+                tagged = f"batch_{batch}.tagged.fastq"
+            shell:
+                "(python3 {params.script} multiplex {input}"
+                " --output {output.batch}/{params.multiplexed}"
+                " && {params.fastq_screen} --aligner {params.aligner}"
+                " --threads {threads}"
+                " --subset 0 --tag --force --outdir {output.batch}"
+                " {output.batch}/{params.multiplexed}"
+                " && python3 {params.script} demultiplex"
+                " {output.batch}/{params.tagged} --aligner {params.aligner}"
+                " --txt {output.txt} --png {output.png}) > {log} 2>&1"
+elif "screen_index_staging" in config:
+    rule fastq_screen:
+        input:
+            "fqscreen/subsample/{rsample}.fastq"
+        output:
+            txt = temp("fqscreen/{rsample}.fastq_screen.txt"),
+            png = temp("fqscreen/{rsample}.fastq_screen.png")
+        message:
+            "Screening {wildcards.rsample} with node-local indexes"
+        params:
+            fastq_screen = lambda wildcards: fastq_screen_command(
+                f"fqscreen/tmp/{wildcards.rsample}/fastq_screen.conf"
+            ),
+            outdir = "fqscreen/tmp/{rsample}",
+            aligner = config["params"].get("fastq_screen_aligner", "bowtie2")
+        threads:
+            size_aware_threads(
+                resource_model, "fastq_screen", rsample_size_gb,
+                max_threads("fastq_screen", 20)
+            )
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "fastq_screen", "mem_mb", rsample_size_gb
+            ),
+            time_min = size_aware_resource(
+                resource_model, "fastq_screen", "time_min", rsample_size_gb
+            )
+        log:
+            "logs/fastq_screen/{rsample}.log"
+        benchmark:
+            "benchmarks/fastq_screen/{rsample}.tsv"
+        conda:
+            "../envs/fastq_screen.yaml"
+        shell:
+            "({params.fastq_screen} --aligner {params.aligner}"
+            " --threads {threads} --subset 0 --force"
+            " --outdir {params.outdir} {input}"
+            " && mv {params.outdir}/{wildcards.rsample}_screen.txt"
+            " {output.txt}"
+            " && mv {params.outdir}/{wildcards.rsample}_screen.png"
+            " {output.png}"
+            " && rm -r {params.outdir}) > {log} 2>&1"
+else:
+    rule fastq_screen:
+        input:
+            "fqscreen/subsample/{rsample}.fastq"
+        output:
+            txt = temp("fqscreen/{rsample}.fastq_screen.txt"),
+            png = temp("fqscreen/{rsample}.fastq_screen.png")
+        message:
+            "Screening {wildcards.rsample}"
+        params:
+            # Input reads are already subsampled: fastq_screen uses them all
+            subset = 0,
+            fastq_screen_config = config["params"].get(
+                "fastq_screen_config", "fastq_screen_config.tsv"
+            ),
+            # fastq_screen_config = {
+            #     "database": {
+            #         "Human": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Human/Homo_sapiens.GRCh38"},
+            #         "Mouse": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Mouse/Mus_musculus.GRCm38"},
+            #         "Rat": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Rat/Rnor_6.0"},
+            #         "Drosophila": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Drosophila/BDGP6"},
+            #         "Worm": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Worm/Caenorhabditis_elegans.WBcel235"},
+            #         "Yeast": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Yeast/Saccharomyces_cerevisiae.R64-1-1"},
+            #         "Arabidopsis": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Arabidopsis/Arabidopsis_thaliana.TAIR10"},
+            #         "Ecoli": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/E_coli/Ecoli"},
+            #         "rRNA": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/rRNA/GRCm38_rRNA"},
+            #         "MT": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Mitochondria/mitochondria"},
+            #         "PhiX": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/PhiX/phi_plus_SNPs"},
+            #         "Lambda": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Lambda/Lambda"},
+            #         "Vectors": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Vectors/Vectors"},
+            #         "Adapters": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Adapters/Contaminants"},
+            #         "SalmoSalar": {"bowtie2": "/mnt/beegfs/database/bioinfo/Index_DB/FastQ_Screen/0.13.0/Salmo_salar/SalmoSalar.ICSASGv2"},
+            #     },
+            #     "aligner_paths": {'bowtie': 'bowtie', 'bowtie2': 'bowtie2'}
+            # },
+            aligner = config["params"].get("fastq_screen_aligner", 'bowtie2')
+        threads:
+            size_aware_threads(
+                resource_model, "fastq_screen", rsample_size_gb,
+                max_threads("fastq_screen", 20)
+            )
+        resources:
+            mem_mb = size_aware_resource(
+                resource_model, "fastq_screen", "mem_mb", rsample_size_gb
+            ),
+            time_min = size_aware_resource(
+                resource_model, "fastq_screen", "time_min", rsample_size_gb
+            )
+        log:
+            "logs/fastq_screen/{rsample}.log"
+        benchmark:
+            "benchmarks/fastq_screen/{rsample}.tsv"
+        wrapper:
+            f"{git}/bio/fastq_screen"
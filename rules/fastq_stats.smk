@@ -0,0 +1,61 @@
+"""
+Native quality statistics of raw and trimmed reads, written as fastp-like
+JSON reports. These are cheap to compute, and do not depend on any
+external tool. They are final targets of the pipeline. MultiQC does not
+read them: its fastp module only looks for *fastp.json reports.
+"""
+rule raw_fastq_stats:
+    input:
+        unpack(fq_pairs_w)
+    output:
+        "qc/before/{sample}.stats.json"
+    message:
+        "Computing statistics of raw reads of {wildcards.sample}"
+    threads: 2
+    resources:
+        mem_mb = (
+            lambda wildcards, attempt: min(attempt * 1024, 4096)
+        ),
+        time_min = size_aware_resource(
+            resource_model, "raw_fastq_stats", "time_min", sample_size_gb
+        )
+    log:
+        "logs/fastq_stats/before/{sample}.log"
+    benchmark:
+        "benchmarks/raw_fastq_stats/{sample}.tsv"
+    conda:
+        "../envs/python.yaml"
+    params:
+        script = script_path("fastq_stats.py")
+    shell:
+        "python3 {params.script} {input.sample} --output {output}"
+        " --stage before > {log} 2>&1"
+
+
+rule trimmed_fastq_stats:
+    input:
+        f"fastp/trimmed/{{sample}}.R1.{trimmed_ext}",
+        f"fastp/trimmed/{{sample}}.R2.{trimmed_ext}"
+    output:
+        "qc/after/{sample}.stats.json"
+    message:
+        "Computing statistics of trimmed reads of {wildcards.sample}"
+    threads: 2
+    resources:
+        mem_mb = (
+            lambda wildcards, attempt: min(attempt * 1024, 4096)
+        ),
+        time_min = size_aware_resource(
+            resource_model, "trimmed_fastq_stats", "time_min", sample_size_gb
+        )
+    log:
+        "logs/fastq_stats/after/{sample}.log"
+    benchmark:
+        "benchmarks/trimmed_fastq_stats/{sample}.tsv"
+    conda:
+        "../envs/python.yaml"
+    params:
+        script = script_path("fastq_stats.py")
+    shell:
+        "python3 {params.script} {input} --output {output}"
+        " --stage after > {log} 2>&1"
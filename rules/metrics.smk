@@ -0,0 +1,130 @@
+"""
+Quality metrics of each sample are parsed once, into a row file, then
+appended to a persistent cohort table (qc/metrics_store.{format}). The
+table is updated in place: only new or updated rows are read, so adding
+samples to a cohort costs work proportional to the new samples only.
+A lightweight HTML report is rendered from that table.
+"""
+rule metrics_row:
+    input:
+        unpack(metrics_inputs_w)
+    output:
+        f"qc/metrics/{{sample}}.{metrics_format}"
+    message:
+        "Gathering quality metrics of {wildcards.sample}"
+    threads: 1
+    resources:
+        mem_mb = (
+            lambda wildcards, attempt: min(attempt * 512, 2048)
+        ),
+        time_min = (
+            lambda wildcards, attempt: attempt * 5
+        )
+    log:
+        "logs/metrics/{sample}.log"
+    benchmark:
+        "benchmarks/metrics_row/{sample}.tsv"
+    conda:
+        "../envs/metrics.yaml"
+    params:
+        script = script_path("metrics_store.py"),
+        screen = lambda wildcards, input: (
+            f"--screen {' '.join(input.screen)}" if "screen" in input.keys()
+            else ""
+        ),
+        manifest = lambda wildcards, input: (
+            f"--manifest {input.manifest}" if "manifest" in input.keys()
+            else ""
+        )
+    shell:
+        "python3 {params.script} row --sample {wildcards.sample}"
+        " --fastp {input.fastp} {params.screen} {params.manifest}"
+        " --output {output} > {log} 2>&1"
+
+
+rule metrics_report:
+    input:
+        expand(
+            "qc/metrics/{sample}.{format}",
+            sample=fastq_pairs_dict.keys(),
+            format=metrics_format
+        )
+    output:
+        "multiqc/metrics.html"
+    message:
+        "Updating the cohort metrics table and its report"
+    threads: 1
+    resources:
+        mem_mb = (
+            lambda wildcards, attempt: min(attempt * 1024, 10240)
+        ),
+        time_min = (
+            lambda wildcards, attempt: attempt * 30
+        )
+    log:
+        "logs/metrics/report.log"
+    benchmark:
+        "benchmarks/metrics_report/report.tsv"
+    conda:
+        "../envs/metrics.yaml"
+    params:
+        script = script_path("metrics_store.py"),
+        # The store is not an output: Snakemake would remove it before
+        # each update
+        store = f"qc/metrics_store.{metrics_format}"
+    shell:
+        "python3 {params.script} aggregate {input} --store {params.store}"
+        " --html {output} > {log} 2>&1"
+
+
+"""
+Benchmarks of all rules are appended to a performance history, kept
+across runs (perf_history.path), once all other targets are built. Only
+benchmarks of jobs run since the last collection are appended, with their
+input sizes and throughputs; throughput regressions are logged and
+flagged in qc/perf_history.tsv.
+"""
+rule perf_history:
+    input:
+        **get_targets(
+            get_trimmed=True,
+            get_fqscreen=True,
+            get_fastp=True,
+            get_multiqc=True,
+            get_staging_manifest=True,
+            get_fastq_stats=True,
+            get_metrics=True,
+            get_fastp_summary=True
+        )
+    output:
+        "qc/perf_history.tsv"
+    message:
+        "Appending benchmarks to the performance history"
+    threads: 1
+    resources:
+        mem_mb = (
+            lambda wildcards, attempt: min(attempt * 1024, 10240)
+        ),
+        time_min = (
+            lambda wildcards, attempt: attempt * 30
+        )
+    log:
+        "logs/perf_history.log"
+    benchmark:
+        "benchmarks/perf_history/history.tsv"
+    conda:
+        "../envs/metrics.yaml"
+    params:
+        script = script_path("perf_history.py"),
+        design = config["design"],
+        # The history is not an output: Snakemake would remove it before
+        # each update
+        history = config.get("perf_history", {}).get("path"),
+        tolerance = config.get("perf_history", {}).get("tolerance", 0.25)
+    shell:
+        "python3 {params.script} --design {params.design}"
+        " --history {params.history} --tolerance {params.tolerance}"
+        " --output {output} > {log} 2>&1"
+
+
+localrules: perf_history
@@ -35,5 +35,7 @@ rule multiqc:
         extra = config["params"].get("multiqc_extra", "")
     log:
         "logs/multiqc.log"
+    benchmark:
+        "benchmarks/multiqc/report.tsv"
     wrapper:
         f"{git}/bio/multiqc"
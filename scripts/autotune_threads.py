@@ -0,0 +1,439 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script picks the number of threads of fastp_trimmer and fastq_screen
+jobs that maximizes the number of samples processed per core-hour.
+
+Cores reserved but idle are wasted: fastp, for instance, stops scaling
+after a few threads because of its gzip output. Counts are picked from
+either:
+
+- history: the performance history of past runs (see perf_history.py).
+  A job uses on average cpu_time / s cores, whatever its reservation:
+  past jobs of a rule are grouped by this number of cores, rounded up,
+  and their median throughput (reads/s, or samples/s when reads are
+  unknown) is divided by it.
+- calibration: the first reads of a sample are processed with each
+  candidate thread count, and timed. Samples per core-hour are
+  3600 / (threads * (wall time + job overhead)).
+
+In both cases, among counts within a tolerance of the best throughput per
+thread, the largest is picked: samples are then processed faster, for
+about the same core-hours.
+
+Counts are capped by the maximum number of threads of each rule. They are
+written in the configuration by prepare_config.py (--tune-threads), as
+rule_threads, and printed as yaml when this script is run.
+
+You can test this script with:
+pytest -v ./autotune_threads.py
+
+Usage example:
+python3.8 ./autotune_threads.py --design design.tsv \
+    --history /path/to/perf_history.sqlite
+python3.8 ./autotune_threads.py --design design.tsv --calibrate \
+    --reads 200000 --candidates 1 2 4 6 8 10
+"""
+
+import argparse  # Parse command line
+import logging  # Traces and loggings
+import math  # Rounding
+import pandas  # Handle history tables
+import statistics  # Median of timings
+import subprocess  # Run calibration commands
+import sys  # System related methods
+import tempfile  # Calibration directory
+import time  # Timers
+
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List, Optional  # Type hints
+
+from common_script_ngs_cleaning import (
+    CustomFormatter, design_fastq, read_design
+)
+from fastq_codecs import open_output
+from resource_model import MIN_POINTS
+from stream_fastq import record_lines
+
+
+# Rules whose threads are tuned, and their maximum number of threads
+TUNED_RULES = {"fastp_trimmer": 10, "fastq_screen": 20}
+
+# Thread counts within this relative distance of the best number of
+# samples per core-hour are considered as efficient as the best one
+TOLERANCE = 0.1
+
+# Candidate thread counts of calibration runs
+CANDIDATES = [1, 2, 4, 6, 8, 10, 12, 16, 20]
+
+
+def best_threads(
+    timings: Dict[int, float],
+    overhead: float = 0,
+    tolerance: float = TOLERANCE
+) -> int:
+    """
+    Return the thread count which maximizes samples per core-hour, given
+    the wall time of a sample with each thread count. The largest count
+    within the tolerance of the best one is returned.
+
+    Example:
+    >>> best_threads({1: 60, 2: 31, 4: 17, 8: 15})
+    2
+    >>> best_threads({1: 60, 2: 31, 4: 17, 8: 15}, tolerance=0.15)
+    4
+    """
+    per_core_hour = {
+        threads: 3600 / (threads * (seconds + overhead))
+        for threads, seconds in timings.items()
+    }
+    best = max(per_core_hour.values())
+    return max(
+        threads for threads, samples in per_core_hour.items()
+        if samples >= best * (1 - tolerance)
+    )
+
+
+def history_threads(
+    history: Any,
+    rule: str,
+    max_threads: int,
+    min_points: int = MIN_POINTS,
+    tolerance: float = TOLERANCE
+) -> Optional[int]:
+    """
+    Return the thread count which maximizes the throughput per thread of
+    past jobs of a rule, from a performance history table. Jobs are
+    grouped by the number of cores they used, rounded up. None if the rule
+    has less than min_points benchmarks.
+    """
+    jobs = history.loc[history["rule"] == rule].copy()
+    for column in ["s", "cores_used", "reads_per_s"]:
+        jobs[column] = pandas.to_numeric(jobs[column], errors="coerce")
+    jobs = jobs.dropna(subset=["cores_used"])
+    jobs = jobs[jobs["s"] > 0]
+    if len(jobs) < min_points:
+        return None
+
+    threads = jobs["cores_used"].apply(math.ceil).clip(1, max_threads)
+    throughput = jobs["reads_per_s"]
+    if throughput.isna().any():
+        # Reads are unknown for some jobs: samples per second
+        throughput = 1 / jobs["s"]
+
+    # best_threads expects the wall time of a sample at each thread count:
+    # the inverse of the throughput, on any time scale
+    medians = throughput.groupby(threads).median()
+    return best_threads(
+        {int(count): 1 / value for count, value in medians.items()},
+        tolerance=tolerance
+    )
+
+
+def calibration_chunk(
+    mates: List[List[Path]], reads: int, directory: Path
+) -> List[Path]:
+    """
+    Write the first reads of each mate of a sample in gzipped files of the
+    given directory, and return their paths
+    """
+    chunk = []
+    for mate, lanes in enumerate(mates, 1):
+        path = directory / f"chunk_R{mate}.fastq.gz"
+        lines: List[bytes] = []
+        for batch in record_lines(lanes):
+            lines.extend(batch[:4 * reads - len(lines)])
+            if len(lines) >= 4 * reads:
+                break
+        with open_output(path, "gzip", 1) as output:
+            output.write(b"\n".join(lines) + b"\n")
+        chunk.append(path)
+    return chunk
+
+
+def calibration_command(
+    rule: str,
+    chunk: List[Path],
+    directory: Path,
+    fastq_screen_config: Optional[str] = None
+) -> Optional[str]:
+    """
+    Return the command line timed to calibrate a rule, with a {threads}
+    field, or None if the rule cannot be calibrated
+    """
+    if rule == "fastp_trimmer":
+        inputs = " ".join(
+            f"--in{mate} {path} --out{mate} {directory}/trimmed_R{mate}.fq.gz"
+            for mate, path in enumerate(chunk, 1)
+        )
+        return (
+            f"fastp {inputs} --thread {{threads}}"
+            f" --json {directory}/fastp.json --html {directory}/fastp.html"
+        )
+    if rule == "fastq_screen" and fastq_screen_config is not None:
+        return (
+            f"fastq_screen --conf {fastq_screen_config}"
+            " --threads {threads} --subset 0 --force"
+            f" --outdir {directory}/fqscreen {chunk[0]}"
+        )
+    return None
+
+
+def calibrate(
+    command: str, candidates: List[int], repeats: int = 1
+) -> Dict[int, float]:
+    """
+    Return the median wall time of the command with each thread count
+    """
+    timings = {}
+    for threads in candidates:
+        seconds = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(
+                command.format(threads=threads),
+                shell=True,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            seconds.append(time.perf_counter() - start)
+        timings[threads] = statistics.median(seconds)
+        logging.info(f"{threads} threads: {timings[threads]:.2f}s")
+    return timings
+
+
+def tune_threads(
+    design: str,
+    workdir: str = ".",
+    history: Optional[Path] = None,
+    calibration: bool = False,
+    reads: int = 200000,
+    candidates: List[int] = CANDIDATES,
+    overhead: float = 0,
+    fastq_screen_config: Optional[str] = None,
+    max_threads: Dict[str, int] = TUNED_RULES
+) -> Dict[str, int]:
+    """
+    Return the tuned number of threads of each rule which could be tuned
+
+    Parameters:
+        design              str             Path to the design file
+        workdir             str             Directory relative paths of the
+                                            design are relative to
+        history             Optional[Path]  Performance history, if any
+        calibration         bool            Calibrate rules on the first
+                                            sample of the design
+        reads               int             Reads per mate of calibration
+        candidates          List[int]       Calibrated thread counts
+        overhead            float           Fixed cost of a job in seconds
+        fastq_screen_config Optional[str]   fastq_screen configuration, if
+                                            fastq_screen is calibrated
+        max_threads         Dict[str, int]  Maximum threads of each rule
+
+    Return:
+                            Dict[str, int]  Threads of each tuned rule
+    """
+    tuned = {}
+    if history is not None:
+        from perf_history import read_history
+        table = read_history(history)
+        for rule, maximum in max_threads.items():
+            threads = history_threads(table, rule, maximum)
+            if threads is not None:
+                tuned[rule] = threads
+        logging.info(f"Threads from {history}: {tuned}")
+
+    if calibration is True:
+        sample, streams = next(iter(design_fastq(read_design(design)).items()))
+        mates = [
+            [Path(workdir) / path for path in stream] for stream in streams
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            chunk = calibration_chunk(mates, reads, Path(tmp))
+            for rule, maximum in max_threads.items():
+                command = calibration_command(
+                    rule, chunk, Path(tmp), fastq_screen_config
+                )
+                if command is None:
+                    continue
+                logging.info(f"Calibrating {rule} on {sample}")
+                timings = calibrate(
+                    command, [c for c in candidates if c <= maximum]
+                )
+                tuned[rule] = best_threads(timings, overhead)
+    return tuned
+
+
+def test_tune_threads(tmp_path: Path) -> None:
+    """
+    This function tests thread counts picked from timings, from a
+    performance history and from a calibration run
+
+    Example:
+    pytest -v ./autotune_threads.py -k test_tune_threads
+    """
+    import gzip  # Build test files
+
+    assert best_threads({1: 100, 2: 50, 4: 25}) == 4
+    assert best_threads({1: 100, 2: 50, 4: 40}, tolerance=0) == 2
+
+    # Reads per thread per second: 100 with 1 and 2 threads, 75 with 4
+    history = pandas.DataFrame({
+        "rule": ["fastp_trimmer"] * 6 + ["fastq_screen"] * 2,
+        "s": [10, 12, 5, 6, 3, 4, 60, 60],
+        "cores_used": [0.9, 1, 1.6, 2, 3.5, 4, 12, 15],
+        "reads_per_s": [100, 100, 200, 200, 300, 300, None, None],
+    })
+    assert history_threads(history, "fastp_trimmer", 10) == 2
+    assert history_threads(history, "fastp_trimmer", 10, tolerance=0.3) == 4
+    assert history_threads(history, "fastp_trimmer", 1) == 1
+    assert history_threads(history, "fastq_screen", 20) is None
+
+    # Without reads, samples per second: {1: 60, 2: 31, 4: 17} seconds
+    history = pandas.DataFrame({
+        "rule": ["fastq_screen"] * 3,
+        "s": [60, 31, 17],
+        "cores_used": [1, 2, 4],
+        "reads_per_s": [None, None, None],
+    })
+    assert history_threads(history, "fastq_screen", 20) == 2
+
+    record = b"@read\nACGT\n+\nIIII\n"
+    (tmp_path / "S1_R1.fq.gz").write_bytes(gzip.compress(record * 10))
+    (tmp_path / "S1_R2.fq").write_bytes(record * 10)
+    chunk = calibration_chunk(
+        [[tmp_path / "S1_R1.fq.gz"], [tmp_path / "S1_R2.fq"]], 4, tmp_path
+    )
+    assert [gzip.decompress(path.read_bytes()) for path in chunk] == [
+        record * 4, record * 4
+    ]
+    command = calibration_command("fastp_trimmer", chunk, tmp_path)
+    assert "--in2 " in command and "--thread {threads}" in command
+    assert calibration_command("fastq_screen", chunk, tmp_path) is None
+
+    timings = calibrate(f"{sys.executable} -c 'print({{threads}})'", [1, 2])
+    assert sorted(timings.keys()) == [1, 2]
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--design",
+        help="Path to the design file (default: %(default)s)",
+        type=str,
+        default="design.tsv",
+    )
+
+    main_parser.add_argument(
+        "--workdir",
+        help="Directory relative paths of the design are relative to "
+             "(default: %(default)s)",
+        type=str,
+        default=".",
+    )
+
+    main_parser.add_argument(
+        "--history",
+        help="Path to the performance history (.sqlite or .parquet)",
+        type=Path,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--calibrate",
+        help="Calibrate rules on the first reads of the first sample",
+        default=False,
+        action="store_true",
+    )
+
+    main_parser.add_argument(
+        "--reads",
+        help="Reads per mate of calibration runs (default: %(default)s)",
+        type=int,
+        default=200000,
+    )
+
+    main_parser.add_argument(
+        "--candidates",
+        help="Calibrated thread counts (default: %(default)s)",
+        type=int,
+        nargs="+",
+        default=CANDIDATES,
+    )
+
+    main_parser.add_argument(
+        "--job-overhead",
+        help="Fixed cost of a job (scheduling, container start) in seconds "
+             "(default: %(default)s)",
+        type=float,
+        default=0,
+    )
+
+    main_parser.add_argument(
+        "--fastq-screen-config",
+        help="fastq_screen configuration, to calibrate fastq_screen",
+        type=str,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function prints the tuned threads of each rule, as yaml
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    tuned = tune_threads(
+        args.design,
+        args.workdir,
+        args.history,
+        args.calibrate,
+        args.reads,
+        args.candidates,
+        args.job_overhead,
+        args.fastq_screen_config,
+    )
+    print("rule_threads:")
+    for rule, threads in tuned.items():
+        print(f"  {rule}: {threads}")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,399 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script checks, before any job is run, that the fastq files listed in
+a design exist, are readable, and are not truncated.
+
+Files are checked in parallel, with cheap reads only:
+- gzip files must start with a gzip header. The end of the file is read:
+  BGZF files must end with their EOF block, and the last gzip member of
+  other files is decompressed, which checks its CRC and ISIZE trailer.
+  Single-member files larger than the tail read cannot be verified that
+  way: their trailer is reported as unverified, not as an error.
+- plain fastq files must start with '@' and end with a new line.
+- the mates of paired samples must have sizes of the same order.
+
+Results are cached, keyed by path, size and modification time, so that
+files already verified are not read again by later runs. All failing
+samples are reported at once.
+
+You can test this script with:
+pytest -v ./check_design.py
+
+Usage example:
+python3.8 ./check_design.py design.tsv --workdir /path/to/workdir \
+    --cache .snakemake/ngs_cleaning/preflight.json --threads 8
+"""
+
+import argparse  # Parse command line
+import gzip  # Build test files
+import json  # Handle the cache
+import logging  # Traces and loggings
+import os  # OS related activities
+import sys  # System related methods
+import zlib  # Decompress gzip members
+
+from concurrent.futures import ThreadPoolExecutor  # Check files in parallel
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List, NamedTuple, Optional  # Type hints
+
+from common_script_ngs_cleaning import (
+    CustomFormatter, design_fastq, read_design
+)
+from fastq_codecs import BGZF_EOF
+
+
+# First bytes of a deflate-compressed gzip member
+GZIP_MAGIC = b"\x1f\x8b\x08"
+
+# Bytes read at the end of each gzip file
+TAIL_SIZE = 1024 * 1024
+
+# Status of files which could be read, but not fully verified
+UNVERIFIED = "unverified"
+
+
+class FileCheck(NamedTuple):
+    """
+    The result of the check of a single file: status is either 'ok',
+    'unverified', or an error message
+    """
+    path: str
+    size: int
+    status: str
+
+
+def check_gzip(path: str, size: int, tail_size: int = TAIL_SIZE) -> str:
+    """
+    Return the status of a gzip file, from its header and its last bytes
+    """
+    with open(path, "rb") as stream:
+        if stream.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+            return "not a gzip file"
+        start = max(0, size - tail_size)
+        stream.seek(start)
+        tail = stream.read()
+
+    if tail.endswith(BGZF_EOF):
+        return "ok"
+
+    # Look for the last complete gzip member within the tail
+    offset = len(tail)
+    while True:
+        offset = tail.rfind(GZIP_MAGIC, 0, offset)
+        if offset < 0:
+            break
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        try:
+            decompressor.decompress(tail[offset:])
+        except zlib.error:
+            continue
+        if decompressor.eof:
+            if decompressor.unused_data:
+                return "truncated gzip: last member is incomplete"
+            return "ok"
+        if start + offset == 0:
+            return "truncated gzip: unexpected end of file"
+
+    return UNVERIFIED if start > 0 else "truncated gzip: no complete member"
+
+
+def check_plain(path: str, size: int) -> str:
+    """
+    Return the status of an uncompressed fastq file
+    """
+    if size == 0:
+        return "empty file"
+    with open(path, "rb") as stream:
+        first = stream.read(1)
+        stream.seek(size - 1)
+        last = stream.read(1)
+    if first != b"@":
+        return "not a fastq file"
+    if last != b"\n":
+        return "truncated fastq: no final new line"
+    return "ok"
+
+
+def cache_key(path: str, stat: os.stat_result) -> str:
+    """
+    Return the key of a file in the cache
+    """
+    return f"{os.path.abspath(path)}\t{stat.st_size}\t{stat.st_mtime_ns}"
+
+
+def check_file(path: str, cache: Dict[str, str]) -> FileCheck:
+    """
+    Check a single file, unless the cache holds its status
+    """
+    try:
+        stat = os.stat(path)
+    except OSError as error:
+        return FileCheck(path, 0, f"cannot stat: {error.strerror}")
+
+    key = cache_key(path, stat)
+    if key in cache:
+        return FileCheck(path, stat.st_size, cache[key])
+
+    try:
+        if path.endswith(".gz"):
+            status = check_gzip(path, stat.st_size)
+        else:
+            status = check_plain(path, stat.st_size)
+    except OSError as error:
+        status = f"cannot read: {error.strerror}"
+    return FileCheck(path, stat.st_size, status)
+
+
+def mates_status(
+    checks: List[List[FileCheck]], max_mate_ratio: float
+) -> Optional[str]:
+    """
+    Return an error message if the mates of a paired sample have sizes
+    too different to hold the same reads, None otherwise
+    """
+    sizes = [sum(check.size for check in stream) for stream in checks]
+    if len(sizes) != 2:
+        return None
+    if min(sizes) == 0 or max(sizes) / min(sizes) > max_mate_ratio:
+        return f"mates sizes differ: R1 is {sizes[0]}, R2 is {sizes[1]} bytes"
+    return None
+
+
+def preflight(
+    samples: Dict[str, List[List[str]]],
+    workdir: str = ".",
+    cache_path: Optional[Path] = None,
+    threads: int = 8,
+    max_mate_ratio: float = 1.5,
+) -> Dict[str, List[str]]:
+    """
+    Check the files of all samples, and return the errors of each failing
+    sample. Files found correct (or unverified) are saved in the cache.
+
+    Parameters:
+        samples         Dict[str, List[List[str]]]  Files of each stream of
+                                                    each sample, see
+                                                    design_fastq
+        workdir         str                         Directory relative paths
+                                                    are relative to
+        cache_path      Optional[Path]              JSON cache, if any
+        threads         int                         Files checked at once
+        max_mate_ratio  float                       Maximum ratio between
+                                                    the sizes of mates
+
+    Return:
+                        Dict[str, List[str]]        Errors of each failing
+                                                    sample
+    """
+    cache = {}
+    if cache_path is not None and cache_path.exists():
+        try:
+            cache = json.loads(cache_path.read_text())
+        except ValueError:
+            logging.warning(f"Ignoring unreadable cache {cache_path}")
+
+    paths = sorted({
+        os.path.join(workdir, path)
+        for streams in samples.values()
+        for stream in streams
+        for path in stream
+    })
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        checks = dict(zip(
+            paths, executor.map(lambda path: check_file(path, cache), paths)
+        ))
+
+    errors = {}
+    for sample, streams in samples.items():
+        sample_checks = [
+            [checks[os.path.join(workdir, path)] for path in stream]
+            for stream in streams
+        ]
+        sample_errors = [
+            f"{check.path}: {check.status}"
+            for stream in sample_checks
+            for check in stream
+            if check.status not in ["ok", UNVERIFIED]
+        ]
+        mates = mates_status(sample_checks, max_mate_ratio)
+        if mates is not None:
+            sample_errors.append(mates)
+        if sample_errors:
+            errors[sample] = sample_errors
+
+    unverified = [
+        check.path for check in checks.values() if check.status == UNVERIFIED
+    ]
+    if unverified:
+        logging.info(
+            f"{len(unverified)} single-member gzip files could not be "
+            "verified from their last bytes"
+        )
+
+    if cache_path is not None:
+        for path, check in checks.items():
+            if check.status in ["ok", UNVERIFIED]:
+                cache[cache_key(path, os.stat(path))] = check.status
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_cache = cache_path.with_name(f".{cache_path.name}.{os.getpid()}")
+        tmp_cache.write_text(json.dumps(cache))
+        os.replace(tmp_cache, cache_path)
+
+    return errors
+
+
+def test_preflight(tmp_path: Path) -> None:
+    """
+    This function tests the detection of missing, truncated and
+    mispaired files, and the cache
+
+    Example:
+    pytest -v ./check_design.py -k test_preflight
+    """
+    record = b"@read\nACGT\n+\nIIII\n"
+    member = gzip.compress(record * 100)
+    files = {
+        "A_R1.fq.gz": member,
+        "A_R2.fq.gz": member + member,
+        "B_R1.fq.gz": member[:-4],
+        "B_R2.fq.gz": member,
+        "C_R1.fq.gz": member + member[:20],
+        "C_R2.fq.gz": member * 4,
+        "D.fq.gz": member + BGZF_EOF,
+        "E.fq": record * 3,
+        "F.fq": record[:-1],
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_bytes(content)
+
+    assert check_gzip(str(tmp_path / "A_R2.fq.gz"), 2 * len(member)) == "ok"
+    assert check_gzip(
+        str(tmp_path / "A_R2.fq.gz"), 2 * len(member), tail_size=10
+    ) == UNVERIFIED
+
+    samples = {
+        "A": [["A_R1.fq.gz"], ["A_R2.fq.gz"]],
+        "B": [["B_R1.fq.gz"], ["B_R2.fq.gz"]],
+        "C": [["C_R1.fq.gz"], ["C_R2.fq.gz"]],
+        "D": [["D.fq.gz"]],
+        "E": [["E.fq"]],
+        "F": [["F.fq"]],
+        "G": [["G_R1.fq.gz"], ["A_R2.fq.gz"]],
+    }
+    cache = tmp_path / "cache.json"
+    errors = preflight(samples, str(tmp_path), cache, max_mate_ratio=2.5)
+    assert sorted(errors.keys()) == ["B", "C", "F", "G"]
+    assert "unexpected end of file" in errors["B"][0]
+    assert "last member is incomplete" in errors["C"][0]
+    assert "mates sizes differ" in errors["C"][1]
+    assert "no final new line" in errors["F"][0]
+    assert "cannot stat" in errors["G"][0]
+
+    # Files already verified are not read again
+    mate = tmp_path / "A_R1.fq.gz"
+    stat = mate.stat()
+    mate.write_bytes(b"x" * stat.st_size)
+    os.utime(mate, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert "A" not in preflight(samples, str(tmp_path), cache, 1, 2.5)
+    assert "A" in preflight(samples, str(tmp_path), None, 1, 2.5)
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "design",
+        help="Path to the design file",
+        type=str,
+    )
+
+    main_parser.add_argument(
+        "--workdir",
+        help="Directory relative paths of the design are relative to "
+             "(default: %(default)s)",
+        type=str,
+        default=".",
+    )
+
+    main_parser.add_argument(
+        "--cache",
+        help="Path to the cache of verified files (default: no cache)",
+        type=Path,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--threads",
+        help="Number of files checked at once (default: %(default)s)",
+        type=int,
+        default=8,
+    )
+
+    main_parser.add_argument(
+        "--max-mate-ratio",
+        help="Maximum ratio between the sizes of the mates of a sample "
+             "(default: %(default)s)",
+        type=float,
+        default=1.5,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function checks the files of the design, and fails if any
+    sample is not correct
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    samples = design_fastq(read_design(args.design))
+    errors = preflight(
+        samples, args.workdir, args.cache, args.threads, args.max_mate_ratio
+    )
+    for sample, sample_errors in errors.items():
+        for error in sample_errors:
+            logging.error(f"{sample}: {error}")
+    if errors:
+        raise ValueError(
+            f"{len(errors)} of {len(samples)} samples have incorrect files"
+        )
+    logging.info(f"All files of {len(samples)} samples are correct")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
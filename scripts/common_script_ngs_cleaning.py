@@ -5,20 +5,23 @@
 """
 This script contains functions that are to be called by any other scripts in
 this pipeline.
+
+It is imported each time Snakemake parses the workflow, including by each
+cluster job: it should only import standard modules. Heavy ones, such
+as yaml, are imported by the functions needing them. Designs are given
+either as pandas DataFrames, or as dictionnaries of columns (see
+read_design). Tests are in test_common_script_ngs_cleaning.py
 """
 
 import argparse  # Argument parsing
-import logging  # Logging behaviour
-import pandas  # Handle large datasets
-import pytest
-import yaml  # Handle Yaml IO
-
-import os.path as op  # Path and file system manipulation
-import pandas  # Deal with TSV files (design)
+import csv  # Parse TSV files (design)
 
-from itertools import chain  # Chain iterators
 from pathlib import Path  # Easily handle paths
-from typing import Any, Dict, List, Optional, Union  # Type hints
+from typing import Any, Dict, List, Mapping, Sequence  # Type hints
+
+
+# A design: a pandas DataFrame, or a dictionnary of columns
+Design = Mapping[str, Sequence[str]]
 
 
 # Building custom class for help formatter
@@ -32,242 +35,150 @@ class CustomFormatter(
     """
 
 
+# Our fastp presets, from the most permissive to the most stringent
+FASTP_PRESETS = {
+    "soft": (
+        "--cut_front "
+        "--cut_tail "
+        "--cut_window_size 6 "
+        "--cut_mean_quality 10 "
+        "--unqualified_percent_limit 50 "
+        "--n_base_limit 7 "
+        "--average_qual 0 "
+        "--length_required 15 "
+        "--overrepresentation_analysis"
+    ),
+    "medium": (
+        "--cut_front "
+        "--cut_tail "
+        "--cut_window_size 5 "
+        "--cut_mean_quality 15 "
+        "--unqualified_percent_limit 40 "
+        "--n_base_limit 7 "
+        "--average_qual 10 "
+        "--length_required 30 "
+        "--low_complexity_filter "
+        "--complexity_threshold 10 "
+        "--overrepresentation_analysis"
+    ),
+    "hard": (
+        "--trim_poly_g "
+        "--cut_front "
+        "--cut_tail "
+        "--cut_window_size 5 "
+        "--cut_mean_quality 20 "
+        "--unqualified_percent_limit 30 "
+        "--n_base_limit 5 "
+        "--average_qual 15 "
+        "--length_required 30 "
+        "--low_complexity_filter "
+        "--complexity_threshold 30 "
+        "--overrepresentation_analysis"
+    ),
+}
+
+
 def write_yaml(output_yaml: Path, data: Dict[str, Any]) -> None:
     """
     Save given dictionnary as Yaml-formatted text file
     """
+    import yaml  # Handle Yaml IO
+
     with output_yaml.open("w") as outyaml:
         yaml.dump(data, outyaml, default_flow_style=False)
 
 
-def fastq_pairs(design: pandas.DataFrame) -> Dict[str, List[str]]:
+def read_design(design_path: str) -> Dict[str, List[str]]:
     """
-    This function returns fastq files as pairs if the input design is paired,
-    or single ended elsewise.
+    Load a TSV design as a dictionnary of columns, without pandas. Empty
+    cells are empty strings.
+
+    Example:
+    >>> read_design("design.tsv")["Sample_id"]  # doctest: +SKIP
+    ['S1', 'S2']
     """
-    try:
-        # Pair-ended case
-        design_iterator = zip(
-            design.Sample_id,
-            design.Upstream_file,
-            design.Downstream_file
-        )
+    with open(design_path, newline="") as design_stream:
+        reader = csv.reader(design_stream, delimiter="\t")
+        header = next(reader)
+        columns = {column: [] for column in header}
+        for line in reader:
+            if not any(line):
+                continue
+            line += [""] * (len(header) - len(line))
+            for column, value in zip(header, line):
+                columns[column].append(value)
+    return columns
+
 
-        return {
-            sample: [up, down]
-            for sample, up, down in design_iterator
-        }
-    except AttributeError:
-        # Single ended case
-        design_iterator = zip(
-            design.Sample_id,
-            design.Upstream_file
-        )
+def design_fastq(design: Design) -> Dict[str, List[List[str]]]:
+    """
+    This function returns, for each sample, the list of fastq files of each
+    stream (one stream if the design is single ended, two elsewise). A
+    sample sequenced over multiple lanes lists its files with commas, or
+    is repeated over multiple rows. Files order is kept.
+    """
+    streams = ["Upstream_file"]
+    if "Downstream_file" in design:
+        streams.append("Downstream_file")
 
-        return {
-            sample: [fq]
-            for sample, fq in design_iterator
-        }
+    samples = {}
+    design_iterator = zip(design["Sample_id"], *(design[s] for s in streams))
+    for sample, *files in design_iterator:
+        sample_files = samples.setdefault(sample, [[] for _ in streams])
+        for stream_files, paths in zip(sample_files, files):
+            stream_files.extend(path.strip() for path in paths.split(","))
 
+    return samples
 
-@pytest.mark.parametrize(
-    "test, expected", [
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {
-                        "Sample_id": "S1",
-                        "Upstream_file": "S1.R1.fq.gz",
-                        "Downstream_file": "S1.R2.fq.gz"
-                    },
-                    "S2": {
-                        "Sample_id": "S2",
-                        "Upstream_file": "S2.R1.fq.gz",
-                        "Downstream_file": "S2.R2.fq.gz"
-                    }
-                }
-            ).T,
-            {
-                "S1": ["S1.R1.fq.gz", "S1.R2.fq.gz"],
-                "S2": ["S2.R1.fq.gz", "S2.R2.fq.gz"]
-            }
-        ),
 
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {"Sample_id": "S1", "Upstream_file": "S1.R1.fq.gz"},
-                    "S2":{"Sample_id": "S2", "Upstream_file": "S2.R1.fq.gz"}
-                }
-            ).T,
-            {
-                "S1": ["S1.R1.fq.gz"],
-                "S2": ["S2.R1.fq.gz"]
-            }
-        )
-    ]
-)
-def test_fastq_pairs(test: pandas.DataFrame, expected: List[str]) -> None:
+def fastq_pairs(design: Design) -> Dict[str, List[str]]:
     """
-    Test the function fastq_pairs
+    This function returns fastq files, as they are named in the pipeline
+    (see fq_link), as pairs if the input design is paired, or single ended
+    elsewise.
     """
-    assert fastq_pairs(test) == expected
+    fastq_pairs_dict = {}
+    for sample, files in design_fastq(design).items():
+        if len(files) == 2:
+            # Pair-ended case
+            fastq_pairs_dict[sample] = [
+                f"raw_data/{sample}_R1.fastq.gz",
+                f"raw_data/{sample}_R2.fastq.gz"
+            ]
+        else:
+            # Single ended case
+            fastq_pairs_dict[sample] = [f"raw_data/{sample}.fastq.gz"]
 
+    return fastq_pairs_dict
 
-def sample_stream(design: pandas.DataFrame) -> Dict[str, str]:
+
+def sample_stream(design: Design) -> Dict[str, str]:
     """
     Return the name of the samples and their stream if necessary
     """
-    if "Downstream_file" in design.columns.to_list():
+    # Samples sequenced over multiple lanes may be repeated
+    samples = list(dict.fromkeys(design["Sample_id"]))
+    if "Downstream_file" in design:
         return  [
             f"{s}.R{r}"
-            for s in design.Sample_id
+            for s in samples
             for r in ["1", "2"]
         ]
-    return design.Sample_id.tolist()
-
+    return samples
 
-@pytest.mark.parametrize(
-    "test, expected", [
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {
-                        "Sample_id": "S1",
-                        "Upstream_file": "S1.R1.fq.gz",
-                        "Downstream_file": "S1.R2.fq.gz"
-                    },
-                    "S2": {
-                        "Sample_id": "S2",
-                        "Upstream_file": "S2.R1.fq.gz",
-                        "Downstream_file": "S2.R2.fq.gz"
-                    }
-                }
-            ).T,
-            ["S1.R1", "S1.R2", "S2.R1", "S2.R2"]
-        ),
 
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {"Sample_id": "S1", "Upstream_file": "S1.R1.fq.gz"},
-                    "S2":{"Sample_id": "S2", "Upstream_file": "S2.R1.fq.gz"}
-                }
-            ).T,
-            ["S1", "S2"]
-        )
-    ]
-)
-def test_sample_stream(test: pandas.DataFrame, expected: List[str]) -> None:
-    """
-    Test the function fastq_pairs
-    """
-    assert sample_stream(test) == expected
-
-
-def fq_link(design: pandas.DataFrame) -> Dict[str, str]:
+def fq_link(design: Design) -> Dict[str, List[str]]:
     """
     Return a dictionnary containing the file name as it is expected in the
-    pipeline, and the original file path
+    pipeline, and the original file path(s)
     """
     fq_link_dict = {}
-    try:
-        # Pair-ended case
-        design_iterator = zip(
-            design.Sample_id,
-            design.Upstream_file,
-            design.Downstream_file
-        )
-
-        for sample, up, down in design_iterator:
-            fq_link_dict[f"{sample}_R1.fastq.gz"] = up
-            fq_link_dict[f"{sample}_R2.fastq.gz"] = down
-    except AttributeError:
-        fq_link_dict = {
-            f"{sample}.fastq.gz": fq
-            for sample, fq in zip(design.Sample_id, design.Upstream_file)
-        }
+    for sample, files in design_fastq(design).items():
+        if len(files) == 2:
+            # Pair-ended case
+            fq_link_dict[f"{sample}_R1.fastq.gz"] = files[0]
+            fq_link_dict[f"{sample}_R2.fastq.gz"] = files[1]
+        else:
+            fq_link_dict[f"{sample}.fastq.gz"] = files[0]
 
     return fq_link_dict
-
-
-@pytest.mark.parametrize(
-    "test, expected", [
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {
-                        "Sample_id": "S1",
-                        "Upstream_file": "S1.R1.fq.gz",
-                        "Downstream_file": "S1.R2.fq.gz"
-                    },
-                    "S2": {
-                        "Sample_id": "S2",
-                        "Upstream_file": "S2.R1.fq.gz",
-                        "Downstream_file": "S2.R2.fq.gz"
-                    }
-                }
-            ).T,
-            {"S1_R1.fastq.gz": "S1.R1.fq.gz", "S1_R2.fastq.gz": "S1.R2.fq.gz",
-             "S2_R1.fastq.gz": "S2.R1.fq.gz", "S2_R2.fastq.gz": "S2.R2.fq.gz"}
-        ),
-
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {
-                        "Sample_id": "S1",
-                        "Upstream_file": "S1.R1.fq.gz"
-                    },
-                    "S2": {
-                        "Sample_id": "S2",
-                        "Upstream_file": "S2.R1.fq.gz"
-                    }
-                }
-            ).T,
-            {"S1.fastq.gz": "S1.R1.fq.gz",
-             "S2.fastq.gz": "S2.R1.fq.gz"}
-        ),
-
-
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {
-                        "Sample_id": "S1",
-                        "Upstream_file": "/absolute/path/to/S1.R1.fq.gz"
-                    },
-                    "S2": {
-                        "Sample_id": "S2",
-                        "Upstream_file": "/absolute/path/to/S2.R1.fq.gz"
-                    }
-                }
-            ).T,
-            {"S1.fastq.gz": "/absolute/path/to/S1.R1.fq.gz",
-             "S2.fastq.gz": "/absolute/path/to/S2.R1.fq.gz"}
-        ),
-
-        (
-            pandas.DataFrame(
-                {
-                    "S1": {
-                        "Sample_id": "S1",
-                        "Upstream_file": "relative/path/to/S1.R1.fq.gz"
-                    },
-                    "S2": {
-                        "Sample_id": "S2",
-                        "Upstream_file": "relative/path/to/S2.R1.fq.gz"
-                    }
-                }
-            ).T,
-            {"S1.fastq.gz": "relative/path/to/S1.R1.fq.gz",
-             "S2.fastq.gz": "relative/path/to/S2.R1.fq.gz"}
-        ),
-
-    ]
-)
-def test_fq_link(test: pandas.DataFrame, expected: List[str]) -> None:
-    """
-    Test the function fastq_pairs
-    """
-    assert fq_link(test) == expected
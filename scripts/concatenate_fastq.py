@@ -0,0 +1,179 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script concatenates the fastq files of a sample sequenced over
+multiple lanes into a single gzipped fastq file.
+
+A gzip file may be made of multiple members: gzipped inputs are streamed
+as-is to the output, without being decompressed nor recompressed. Plain
+text inputs are compressed on the fly as new members.
+
+You can test this script with:
+pytest -v ./concatenate_fastq.py
+
+Usage example:
+python3.8 ./concatenate_fastq.py L001.fq.gz L002.fq.gz --output S1.fq.gz
+"""
+
+import argparse  # Parse command line
+import gzip  # Handle gzipped files
+import logging  # Traces and loggings
+import shutil  # Stream file objects
+import sys  # System related methods
+
+from pathlib import Path  # Paths related methods
+from typing import Any, BinaryIO, List  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+
+
+# Gzip files always start with these two bytes
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Large reads amortize the latency of cold storage mount points
+BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def is_gzip(path: Path) -> bool:
+    """
+    Return True if the given file starts with the gzip magic number
+    """
+    with path.open("rb") as infile:
+        return infile.read(2) == GZIP_MAGIC
+
+
+def concatenate_fastq(
+    fq_files: List[Path],
+    output: BinaryIO,
+    compresslevel: int = 6,
+    buffer_size: int = BUFFER_SIZE
+) -> None:
+    """
+    Stream the given fastq files, in order, into a single gzipped output
+
+    Parameters:
+        fq_files        List[Path]  Fastq files to concatenate
+        output          BinaryIO    Opened binary output stream
+        compresslevel   int         Compression level of plain text inputs
+        buffer_size     int         Size of each read in input files
+
+    Example:
+    >>> with open("S1.fq.gz", "wb") as out:
+    ...     concatenate_fastq([Path("L001.fq.gz"), Path("L002.fq")], out)
+    """
+    for fq in fq_files:
+        with fq.open("rb") as infile:
+            if infile.read(2) == GZIP_MAGIC:
+                logging.debug(f"Streaming gzip members of {fq}")
+                output.write(GZIP_MAGIC)
+                shutil.copyfileobj(infile, output, buffer_size)
+            else:
+                logging.debug(f"Compressing {fq} as a new gzip member")
+                infile.seek(0)
+                with gzip.GzipFile(
+                    fileobj=output, mode="wb", compresslevel=compresslevel
+                ) as member:
+                    shutil.copyfileobj(infile, member, buffer_size)
+
+
+def test_concatenate_fastq(tmp_path: Path) -> None:
+    """
+    This function tests the concatenation of gzipped and plain fastq files
+
+    Example:
+    pytest -v ./concatenate_fastq.py -k test_concatenate_fastq
+    """
+    records = [f"@r{i}\nACGT\n+\nIIII\n".encode() for i in range(3)]
+    fq_files = [tmp_path / name for name in ["L1.fq.gz", "L2.fq", "L3.fq.gz"]]
+    with gzip.open(fq_files[0], "wb") as fq:
+        fq.write(records[0])
+    fq_files[1].write_bytes(records[1])
+    with gzip.open(fq_files[2], "wb") as fq:
+        fq.write(records[2])
+
+    output = tmp_path / "S1.fq.gz"
+    with output.open("wb") as out:
+        concatenate_fastq(fq_files, out, buffer_size=2)
+
+    assert is_gzip(output)
+    with gzip.open(output, "rb") as merged:
+        assert merged.read() == b"".join(records)
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "fq_files",
+        help="Fastq files to concatenate, in order",
+        type=Path,
+        nargs="+",
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the concatenated gzipped fastq file",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "-c",
+        "--compresslevel",
+        help="Gzip compression level of plain text inputs "
+             "(default: %(default)s)",
+        type=int,
+        default=6,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function performs the whole concatenation
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with args.output.open("wb") as output:
+        concatenate_fastq(args.fq_files, output, args.compresslevel)
+    logging.info(f"{len(args.fq_files)} files concatenated in {args.output}")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,462 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script serves raw fastq files from a persistent local cache, and only
+copies them from the cold storage when they are missing from that cache.
+
+Cached files are identified by their source path, size and modification
+time, and optionally by a hash of their first and last megabytes. Hits are
+served as hard links (or reflinks, or copies). The least recently used
+files are evicted when the cache exceeds its disk quota.
+
+The index is a small JSON file, which can be read by the Snakefile while
+building the DAG.
+
+You can test this script with:
+pytest -v ./copy_cache.py
+
+Usage example:
+python3.8 ./copy_cache.py /cold/S1_R1.fq.gz raw_data/S1_R1.fastq.gz \
+    --cache /scratch/fastq_cache --quota 500
+"""
+
+import argparse  # Parse command line
+import fcntl  # File locks and ioctl
+import hashlib  # Fallback hash functions
+import json  # Handle the cache index
+import logging  # Traces and loggings
+import os  # OS related activities
+import shutil  # Copy files
+import sys  # System related methods
+import time  # Access times
+
+from contextlib import contextmanager  # Lock context
+from pathlib import Path  # Paths related methods
+from typing import (  # Type hints
+    Any, Callable, Dict, Iterable, Iterator, Optional, Set
+)
+
+from common_script_ngs_cleaning import CustomFormatter
+
+try:
+    import xxhash  # Fast non-cryptographic hash functions
+
+    def edges_hasher() -> Any:
+        return xxhash.xxh64()
+except ImportError:
+    def edges_hasher() -> Any:
+        return hashlib.blake2b(digest_size=8)
+
+
+# Size of the file edges (head and tail) included in the fingerprint
+EDGE_SIZE = 1024 * 1024
+
+# ioctl request cloning a file on btrfs/xfs (linux/fs.h)
+FICLONE = 0x40049409
+
+
+def file_key(path: str, stat: os.stat_result) -> str:
+    """
+    Return the index key of a source file: its absolute path, size and
+    modification time
+    """
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def edges_digest(path: str, edge_size: int = EDGE_SIZE) -> str:
+    """
+    Hash the first and last edge_size bytes of a file. This is cheap on
+    large files and catches files rewritten in place.
+    """
+    hasher = edges_hasher()
+    with open(path, "rb") as infile:
+        hasher.update(infile.read(edge_size))
+        size = os.fstat(infile.fileno()).st_size
+        if size > edge_size:
+            infile.seek(max(size - edge_size, edge_size))
+            hasher.update(infile.read(edge_size))
+    return hasher.hexdigest()
+
+
+def test_edges_digest(tmp_path: Path) -> None:
+    """
+    This function tests that edges digests depend on both file edges
+
+    Example:
+    pytest -v ./copy_cache.py -k test_edges_digest
+    """
+    path = tmp_path / "reads.fq"
+    path.write_bytes(b"A" * 10 + b"C" * 10 + b"G" * 10)
+    digest = edges_digest(str(path), edge_size=10)
+    path.write_bytes(b"A" * 10 + b"T" * 10 + b"G" * 10)
+    assert edges_digest(str(path), edge_size=10) == digest
+    path.write_bytes(b"A" * 10 + b"C" * 10 + b"GGGGGGGGGT")
+    assert edges_digest(str(path), edge_size=10) != digest
+
+
+def reflink(source: str, dest: str) -> None:
+    """
+    Clone a file with the FICLONE ioctl: both files share their blocks
+    until one of them is modified. Raises OSError when the file system
+    does not support it.
+    """
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.unlink(dest)
+            raise
+
+
+def link_file(source: str, dest: str, mode: str = "hardlink") -> str:
+    """
+    Make dest available with the content of source, as cheaply as the
+    given mode and the file system allow. Returns the method actually used.
+
+    Parameters:
+        source      str     Path to an existing file
+        dest        str     Path to the file to create
+        mode        str     Preferred method: hardlink, reflink or copy
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    if mode == "hardlink":
+        try:
+            os.link(source, dest)
+            return "hardlink"
+        except OSError:
+            logging.debug(f"Could not hardlink {source}, trying reflink")
+            mode = "reflink"
+
+    if mode == "reflink":
+        try:
+            reflink(source, dest)
+            return "reflink"
+        except OSError:
+            logging.debug(f"Could not reflink {source}, copying")
+
+    shutil.copyfile(source, dest)
+    return "copy"
+
+
+class CopyCache:
+    """
+    A persistent cache of fastq files, indexed by a JSON file and bounded
+    by a disk quota with a least recently used eviction policy.
+
+    The index maps file keys (see file_key) to:
+        blob        name of the cached file within the cache directory
+        size        size of the cached file, in bytes
+        digest      hash of the file edges, or null
+        last_access unix time of the last hit
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        quota_bytes: Optional[int] = None,
+        hash_edges: bool = False,
+        copier: Callable[[str, str], Any] = shutil.copyfile
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.index_path = self.cache_dir / "index.json"
+        self.quota_bytes = quota_bytes
+        self.hash_edges = hash_edges
+        self.copier = copier
+
+    def read_index(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Load the index, without any lock: this is meant to be cheap and
+        used while building the DAG
+        """
+        try:
+            with self.index_path.open("r") as index:
+                return json.load(index)
+        except FileNotFoundError:
+            return {}
+
+    def write_index(self, entries: Dict[str, Dict[str, Any]]) -> None:
+        """
+        Atomically replace the index on disk
+        """
+        tmp_index = self.index_path.with_suffix(f".{os.getpid()}.tmp")
+        with tmp_index.open("w") as index:
+            json.dump(entries, index, indent=1, sort_keys=True)
+        os.replace(tmp_index, self.index_path)
+
+    @contextmanager
+    def locked_index(self) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """
+        Load the index under an exclusive lock, and save it back on exit.
+        Multiple copy jobs may run at the same time on a given node.
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with (self.cache_dir / "index.lock").open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.read_index()
+            yield entries
+            self.write_index(entries)
+
+    def contains(self, source: str) -> bool:
+        """
+        Return True if source is cached with its current size and
+        modification time. Edges digests are not checked here.
+        """
+        return source in self.cached([source])
+
+    def cached(self, sources: Iterable[str]) -> Set[str]:
+        """
+        Return the subset of sources cached with their current size and
+        modification time, reading the index only once
+        """
+        entries = self.read_index()
+        cached_sources = set()
+        for source in sources:
+            try:
+                key = file_key(source, os.stat(source))
+            except OSError:
+                continue
+            if key in entries:
+                cached_sources.add(source)
+        return cached_sources
+
+    def evict(self, entries: Dict[str, Dict[str, Any]], keep: str) -> None:
+        """
+        Remove the least recently used files until the cache fits into
+        its quota. The entry named `keep` is never evicted.
+        """
+        if self.quota_bytes is None:
+            return
+
+        total = sum(entry["size"] for entry in entries.values())
+        by_age = sorted(entries, key=lambda key: entries[key]["last_access"])
+        for key in by_age:
+            if total <= self.quota_bytes:
+                break
+            if key == keep:
+                continue
+            entry = entries.pop(key)
+            logging.info(f"Evicting {key} ({entry['size']} bytes)")
+            try:
+                os.unlink(self.cache_dir / entry["blob"])
+            except FileNotFoundError:
+                pass
+            total -= entry["size"]
+
+    def pin(self, blob: str) -> Path:
+        """
+        Hard link a cached file to a name private to this process, and
+        return it. Called under the index lock: the pinned content remains
+        available while dest is created out of the lock, even if a
+        concurrent job evicts the cached file meanwhile.
+        """
+        pinned = self.cache_dir / f"{blob}.{os.getpid()}.pin"
+        if os.path.lexists(pinned):
+            os.unlink(pinned)
+        os.link(self.cache_dir / blob, pinned)
+        return pinned
+
+    def serve(self, pinned: Path, dest: str, mode: str) -> str:
+        """
+        Create dest from a pinned cached file, then release the pin.
+        Returns the method actually used.
+        """
+        try:
+            return link_file(str(pinned), dest, mode)
+        finally:
+            os.unlink(pinned)
+
+    def fetch(self, source: str, dest: str, mode: str = "hardlink") -> bool:
+        """
+        Make dest a copy of source, served from the cache if possible.
+        Returns True on cache hit, False on cache miss.
+        """
+        key = file_key(source, os.stat(source))
+        digest = edges_digest(source) if self.hash_edges else None
+
+        with self.locked_index() as entries:
+            entry = entries.get(key)
+            hit = (
+                entry is not None
+                and (self.cache_dir / entry["blob"]).exists()
+                and (digest is None or entry["digest"] == digest)
+            )
+            if hit:
+                entry["last_access"] = time.time()
+                pinned = self.pin(entry["blob"])
+
+        if hit:
+            method = self.serve(pinned, dest, mode)
+            logging.info(f"Cache hit for {source}, served as {method}")
+            return True
+
+        # The copy itself is performed out of the lock
+        blob = hashlib.sha1(f"{key}:{digest}".encode()).hexdigest()
+        tmp_blob = self.cache_dir / f"{blob}.{os.getpid()}.tmp"
+        logging.info(f"Cache miss for {source}, copying it")
+        self.copier(source, str(tmp_blob))
+        os.replace(tmp_blob, self.cache_dir / blob)
+
+        with self.locked_index() as entries:
+            # A file rewritten in place has a new digest, hence a new blob
+            replaced = entries.get(key)
+            if replaced is not None and replaced["blob"] != blob:
+                try:
+                    os.unlink(self.cache_dir / replaced["blob"])
+                except FileNotFoundError:
+                    pass
+            entries[key] = {
+                "blob": blob,
+                "size": os.stat(self.cache_dir / blob).st_size,
+                "digest": digest,
+                "last_access": time.time(),
+            }
+            self.evict(entries, keep=key)
+            pinned = self.pin(blob)
+
+        self.serve(pinned, dest, mode)
+        return False
+
+
+def test_copy_cache(tmp_path: Path) -> None:
+    """
+    This function tests cache hits, misses, invalidation and eviction
+
+    Example:
+    pytest -v ./copy_cache.py -k test_copy_cache
+    """
+    sources = []
+    for name in ["A", "B", "C"]:
+        sources.append(tmp_path / f"{name}.fq.gz")
+        sources[-1].write_bytes(name.encode() * 100)
+
+    cache = CopyCache(tmp_path / "cache", quota_bytes=250, hash_edges=True)
+    dest = tmp_path / "raw_data.fq.gz"
+
+    assert cache.fetch(str(sources[0]), str(dest)) is False
+    assert dest.read_bytes() == sources[0].read_bytes()
+    assert cache.contains(str(sources[0]))
+    assert cache.fetch(str(sources[0]), str(dest)) is True
+    assert dest.read_bytes() == sources[0].read_bytes()
+
+    # A is the least recently used file when C is inserted
+    cache.fetch(str(sources[1]), str(dest))
+    cache.fetch(str(sources[2]), str(dest), mode="copy")
+    assert not cache.contains(str(sources[0]))
+    assert cache.contains(str(sources[1])) and cache.contains(str(sources[2]))
+    assert len(list((tmp_path / "cache").glob("*"))) == 4
+
+    # Modified sources are fetched again
+    sources[1].write_bytes(b"D" * 100)
+    assert cache.fetch(str(sources[1]), str(dest)) is False
+    assert dest.read_bytes() == b"D" * 100
+
+    # Files rewritten in place, with the same size and modification time,
+    # replace their former cached file
+    stat = sources[2].stat()
+    sources[2].write_bytes(b"E" * 100)
+    os.utime(sources[2], ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.fetch(str(sources[2]), str(dest)) is False
+    assert dest.read_bytes() == b"E" * 100
+    blobs = {entry["blob"] for entry in cache.read_index().values()}
+    assert {
+        path.name for path in (tmp_path / "cache").glob("*")
+    } == blobs | {"index.json", "index.lock"}
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "source",
+        help="Path to the original fastq file",
+        type=str,
+    )
+
+    main_parser.add_argument(
+        "dest",
+        help="Path to the fastq file in the working directory",
+        type=str,
+    )
+
+    main_parser.add_argument(
+        "--cache",
+        help="Path to the cache directory",
+        type=str,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--quota",
+        help="Maximum size of the cache, in GB (default: unlimited)",
+        type=float,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--hash-edges",
+        help="Also identify files with a hash of their first and last MB",
+        default=False,
+        action="store_true",
+    )
+
+    main_parser.add_argument(
+        "--link",
+        help="How cached files are served (default: %(default)s)",
+        type=str,
+        choices=["hardlink", "reflink", "copy"],
+        default="hardlink",
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function serves the requested file
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    quota = None if args.quota is None else int(args.quota * 1024 ** 3)
+    cache = CopyCache(args.cache, quota, args.hash_edges)
+    Path(args.dest).parent.mkdir(parents=True, exist_ok=True)
+    cache.fetch(args.source, args.dest, args.link)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,175 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script flattens the main metrics of fastp JSON reports in a single
+typed table, one row per sample, so that dashboards can query them
+without parsing reports, nor running MultiQC again.
+
+Reports are loaded with orjson when it is installed, with the standard
+json module otherwise.
+
+You can test this script with:
+pytest -v ./fastp_summary.py
+
+Usage example:
+python3.8 ./fastp_summary.py fastp/json/S1.fastp.json \
+    fastp/json/S2.fastp.json --output multiqc/fastp_summary.tsv
+"""
+
+import argparse  # Parse command line
+import json  # Handle fastp reports
+import logging  # Traces and loggings
+import pandas  # Handle metrics tables
+import sys  # System related methods
+
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+from metrics_store import FASTP_METRICS, fastp_metrics, write_table
+
+try:
+    import orjson  # Fast JSON parser
+
+    def load_report(path: Path) -> Dict[str, Any]:
+        return orjson.loads(path.read_bytes())
+except ImportError:
+    def load_report(path: Path) -> Dict[str, Any]:
+        with path.open() as report:
+            return json.load(report)
+
+
+# Suffix of fastp JSON reports, removed to get sample identifiers
+REPORT_SUFFIX = ".fastp.json"
+
+
+def column_type(column: str) -> str:
+    """
+    Return the type of a summary column: rates and contents are floats,
+    other metrics are (nullable) counts
+
+    Example:
+    >>> column_type("q30_rate_after"), column_type("reads_after")
+    ('float64', 'Int64')
+    """
+    if "rate" in column or "content" in column:
+        return "float64"
+    return "Int64"
+
+
+def fastp_summary(reports: List[Path]) -> pandas.DataFrame:
+    """
+    Return the typed table of fastp metrics, one row per report
+    """
+    rows = [
+        {
+            "sample": report.name[:-len(REPORT_SUFFIX)],
+            **fastp_metrics(load_report(report))
+        }
+        for report in reports
+    ]
+    table = pandas.DataFrame(
+        rows, columns=["sample"] + [name for name, _ in FASTP_METRICS]
+    ).set_index("sample")
+    return table.astype({
+        column: column_type(column) for column in table.columns
+    })
+
+
+def test_fastp_summary(tmp_path: Path) -> None:
+    """
+    This function tests the types and values of the summary table
+
+    Example:
+    pytest -v ./fastp_summary.py -k test_fastp_summary
+    """
+    reports = []
+    for sample, reads in [("S1", 10), ("S2", 20)]:
+        reports.append(tmp_path / f"{sample}.fastp.json")
+        reports[-1].write_text(json.dumps({
+            "summary": {
+                "before_filtering": {"total_reads": reads, "q30_rate": 0.9},
+                "after_filtering": {"total_reads": reads - 1}
+            },
+            "duplication": {"rate": 0.25},
+            "insert_size": {"peak": 150}
+        }))
+
+    table = fastp_summary(reports)
+    assert list(table.index) == ["S1", "S2"]
+    assert table.loc["S2", "reads_after"] == 19
+    assert table.loc["S1", "q30_rate_before"] == 0.9
+    assert str(table.dtypes["reads_before"]) == "Int64"
+    assert str(table.dtypes["duplication_rate"]) == "float64"
+    assert str(table.dtypes["gc_content_after"]) == "float64"
+    assert table["adapter_trimmed_bases"].isna().all()
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "reports",
+        help="fastp JSON reports, named {sample}.fastp.json",
+        type=Path,
+        nargs="+",
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the summary table (.parquet or .tsv)",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function summarizes the given reports
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    table = fastp_summary(args.reports)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    write_table(table, args.output)
+    logging.info(f"{len(table)} reports summarized in {args.output}")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
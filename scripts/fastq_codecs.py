@@ -0,0 +1,431 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script writes fastq files with the codec chosen for trimmed reads,
+and reads them back whatever their codec.
+
+- gzip: a single gzip member, at the given level. Level 1 to 4 cost a
+  fraction of the CPU time of level 6, for slightly larger files.
+- bgzf: blocked gzip, as written by bgzip. Files are still gzip files,
+  but their independent blocks are compressed in parallel threads (zlib
+  releases the GIL), and allow random access and parallel decompression
+  by downstream tools (htslib, pigz, ...).
+- zstd: Zstandard frames, much faster to write and read than gzip at an
+  equivalent ratio. Tools of the pipeline read them, but many third party
+  tools do not: keep this codec for intermediate outputs. The zstandard
+  module is used when it is installed, the zstd command line otherwise.
+
+When run, records of the input fastq files (or of the standard input) are
+dealt to the outputs: one output per mate, mates being interleaved in the
+input.
+
+You can test this script with:
+pytest -v ./fastq_codecs.py
+
+Usage example:
+fastp --in1 S1_R1.fq.gz --in2 S1_R2.fq.gz --stdout \
+    | python3.8 ./fastq_codecs.py - --codec bgzf --threads 4 \
+        --output fastp/trimmed/S1.R1.fastq.gz fastp/trimmed/S1.R2.fastq.gz
+"""
+
+import argparse  # Parse command line
+import gzip  # Handle gzipped files
+import io  # Buffered streams
+import logging  # Traces and loggings
+import struct  # BGZF headers
+import subprocess  # zstd command line
+import sys  # System related methods
+import zlib  # Compress BGZF blocks
+
+from concurrent.futures import ThreadPoolExecutor  # Compress in parallel
+from itertools import chain, islice  # Read blocks of lines
+from pathlib import Path  # Paths related methods
+from typing import Any, BinaryIO, Iterable, List, Optional
+
+from common_script_ngs_cleaning import CustomFormatter
+from concatenate_fastq import BUFFER_SIZE, is_gzip
+
+try:
+    import zstandard  # Zstandard bindings
+except ImportError:
+    zstandard = None
+
+
+# Codecs of trimmed reads, and their default levels
+CODECS = {"gzip": 4, "bgzf": 6, "zstd": 3}
+
+# Zstandard frames always start with these four bytes
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Uncompressed bytes per BGZF block, as htslib
+BGZF_BLOCK_SIZE = 0xff00
+
+# Empty block ending BGZF files
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+# Number of records written at once per mate
+BATCH_RECORDS = 10000
+
+
+def codec_suffix(codec: str) -> str:
+    """
+    Return the suffix of fastq files written with the given codec
+
+    Example:
+    >>> codec_suffix("bgzf"), codec_suffix("zstd")
+    ('fastq.gz', 'fastq.zst')
+    """
+    return "fastq.zst" if codec == "zstd" else "fastq.gz"
+
+
+def bgzf_block(data: bytes, level: int) -> bytes:
+    """
+    Return a single BGZF block holding the given data
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack(
+        "<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+        ord("B"), ord("C"), 2, len(deflated) + 25
+    )
+    return header + deflated + struct.pack(
+        "<2I", zlib.crc32(data), len(data)
+    )
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    A BGZF file, which blocks are compressed by a pool of threads, and
+    written in order
+    """
+
+    def __init__(self, path: Path, level: int = 6, threads: int = 1):
+        self.output = open(path, "wb")
+        self.level = level
+        self.executor = ThreadPoolExecutor(max_workers=max(threads, 1))
+        self.batch_size = 4 * max(threads, 1) * BGZF_BLOCK_SIZE
+        self.buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.batch_size:
+            self.flush_blocks(complete_only=True)
+        return len(data)
+
+    def flush_blocks(self, complete_only: bool = False) -> None:
+        """
+        Compress and write buffered data, but the last incomplete block
+        if asked to
+        """
+        size = len(self.buffer)
+        if complete_only:
+            size -= size % BGZF_BLOCK_SIZE
+        blocks = [
+            bytes(self.buffer[start:start + BGZF_BLOCK_SIZE])
+            for start in range(0, size, BGZF_BLOCK_SIZE)
+        ]
+        del self.buffer[:size]
+        for block in self.executor.map(
+            lambda data: bgzf_block(data, self.level), blocks
+        ):
+            self.output.write(block)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.flush_blocks()
+            self.output.write(BGZF_EOF)
+            self.output.close()
+            self.executor.shutdown()
+        super().close()
+
+
+class ZstdProcessWriter(io.RawIOBase):
+    """
+    A Zstandard file written by the zstd command line, when the
+    zstandard module is not installed
+    """
+
+    def __init__(self, path: Path, level: int = 3, threads: int = 1):
+        self.process = subprocess.Popen(
+            ["zstd", "-q", "-f", f"-{level}", f"-T{threads}", "-o", str(path)],
+            stdin=subprocess.PIPE
+        )
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        self.process.stdin.write(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise OSError(f"zstd exited with {self.process.returncode}")
+        super().close()
+
+
+def open_output(
+    path: Path, codec: str = "gzip", level: Optional[int] = None,
+    threads: int = 1
+) -> BinaryIO:
+    """
+    Open a fastq file for writing with the given codec. Levels default to
+    the ones of CODECS.
+    """
+    level = CODECS[codec] if level is None else level
+    if codec == "bgzf":
+        return BgzfWriter(path, level, threads)
+    if codec == "zstd":
+        if zstandard is None:
+            return ZstdProcessWriter(path, level, threads)
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        return compressor.stream_writer(open(path, "wb"))
+    return gzip.open(path, "wb", compresslevel=level)
+
+
+def is_zstd(path: Path) -> bool:
+    """
+    Return True if the given file starts with a Zstandard frame
+    """
+    with path.open("rb") as infile:
+        return infile.read(4) == ZSTD_MAGIC
+
+
+def open_zstd(path: Path) -> BinaryIO:
+    """
+    Open a Zstandard file for buffered reading
+    """
+    if zstandard is None:
+        process = subprocess.Popen(
+            ["zstd", "-q", "-d", "-c", str(path)],
+            stdout=subprocess.PIPE,
+            bufsize=BUFFER_SIZE
+        )
+        return process.stdout
+    reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return io.BufferedReader(reader, BUFFER_SIZE)
+
+
+def open_input(path: Path) -> BinaryIO:
+    """
+    Open a fastq file for buffered reading, be it gzipped, BGZF, zstd
+    compressed or not
+    """
+    if is_gzip(path):
+        return io.BufferedReader(gzip.open(path, "rb"), BUFFER_SIZE)
+    if is_zstd(path):
+        return open_zstd(path)
+    return path.open("rb", buffering=BUFFER_SIZE)
+
+
+def deal_records(
+    handles: Iterable[BinaryIO],
+    outputs: List[BinaryIO],
+    batch_records: int = BATCH_RECORDS
+) -> int:
+    """
+    Write the records of the given fastq streams in the outputs, one
+    output per mate, mates being interleaved. Each mate is written by its
+    own thread. Returns the number of records per mate.
+    """
+    mates = len(outputs)
+    lines = chain.from_iterable(handles)
+    records = 0
+    with ThreadPoolExecutor(max_workers=mates) as executor:
+        pending = []
+        while True:
+            block = list(islice(lines, 4 * mates * batch_records))
+            if not block:
+                break
+            if len(block) % (4 * mates) != 0:
+                raise ValueError(
+                    f"Incomplete record or pair after {records} records"
+                )
+            batches = [
+                b"".join(chain.from_iterable(
+                    block[start:start + 4]
+                    for start in range(4 * mate, len(block), 4 * mates)
+                ))
+                for mate in range(mates)
+            ]
+            for future in pending:
+                future.result()
+            pending = [
+                executor.submit(output.write, batch)
+                for output, batch in zip(outputs, batches)
+            ]
+            records += len(block) // (4 * mates)
+        for future in pending:
+            future.result()
+    return records
+
+
+def test_codecs(tmp_path: Path) -> None:
+    """
+    This function tests that each codec writes fastq files which are read
+    back identical, and that interleaved mates are dealt apart
+
+    Example:
+    pytest -v ./fastq_codecs.py -k test_codecs
+    """
+    records = [
+        f"@r{read}/{mate}\nACGTN\n+\nIIII#\n".encode()
+        for read in range(1000)
+        for mate in [1, 2]
+    ]
+    interleaved = tmp_path / "interleaved.fq"
+    interleaved.write_bytes(b"".join(records))
+
+    for codec in CODECS:
+        mates = [tmp_path / f"{codec}.R{mate}.{codec_suffix(codec)}"
+                 for mate in [1, 2]]
+        outputs = [open_output(mate, codec, threads=2) for mate in mates]
+        with open_input(interleaved) as handle:
+            assert deal_records([handle], outputs, batch_records=7) == 1000
+        for output in outputs:
+            output.close()
+
+        with open_input(mates[1]) as mate:
+            assert mate.read() == b"".join(records[1::2])
+
+    # BGZF files are gzip files, made of small blocks
+    bgzf = (tmp_path / "bgzf.R1.fastq.gz").read_bytes()
+    assert bgzf.endswith(BGZF_EOF)
+    assert gzip.decompress(bgzf) == b"".join(records[::2])
+    big = tmp_path / "big.fastq.gz"
+    with open_output(big, "bgzf", threads=4) as output:
+        output.write(b"@r\nACGT\n+\nIIII\n" * 100000)
+    assert big.read_bytes().count(b"BC\x02\x00") > 20
+
+    try:
+        deal_records([io.BytesIO(b"".join(records[:3]))], [io.BytesIO()] * 2)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Incomplete pairs should be rejected")
+
+    # Command line, with the codec arguments of the pipeline rules
+    mates = [tmp_path / f"cli.R{mate}.fastq.gz" for mate in [1, 2]]
+    main(parse_args([
+        str(interleaved), "--output", *map(str, mates),
+        "--codec", "gzip", "--level", "5"
+    ]))
+    assert gzip.decompress(mates[0].read_bytes()) == b"".join(records[::2])
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "fq_files",
+        help="Fastq files to read one after each other, whatever their "
+             "codec, or - to read the standard input",
+        type=str,
+        nargs="+",
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Paths to the fastq files to write, one per mate. Input mates "
+             "are expected to be interleaved",
+        type=Path,
+        nargs="+",
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--codec",
+        help="Codec of the output files (default: %(default)s)",
+        type=str,
+        choices=list(CODECS.keys()),
+        default="gzip",
+    )
+
+    main_parser.add_argument(
+        "-l",
+        "--level",
+        help="Compression level (default: 4 with gzip, 6 with bgzf, "
+             "3 with zstd)",
+        type=int,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Threads used to compress each output, with bgzf and zstd "
+             "(default: %(default)s)",
+        type=int,
+        default=1,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function writes the input records with the given codec
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    for path in args.output:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    outputs = [
+        open_output(path, args.codec, args.level, args.threads)
+        for path in args.output
+    ]
+    handles = (
+        sys.stdin.buffer if path == "-" else open_input(Path(path))
+        for path in args.fq_files
+    )
+    try:
+        records = deal_records(handles, outputs)
+    finally:
+        for output in outputs:
+            output.close()
+    logging.info(f"{records} records written with {args.codec}")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
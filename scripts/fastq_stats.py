@@ -0,0 +1,528 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script computes quality statistics of fastq files: per-cycle quality
+and base composition, length distribution, N rate and duplication rate.
+
+Gzipped fastq files are read by large blocks. Records of each block are
+parsed together into NumPy arrays, and statistics are accumulated with
+vectorized operations, one block at a time, in constant memory.
+
+Statistics are written with the layout of fastp JSON reports (the
+read1_before_filtering, read1_after_filtering, ... sections).
+
+You can test this script with:
+pytest -v ./fastq_stats.py
+
+Usage example:
+python3.8 ./fastq_stats.py raw_data/S1_R1.fastq.gz raw_data/S1_R2.fastq.gz \
+    --output qc/before/S1.stats.json --stage before
+"""
+
+import argparse  # Parse command line
+import gzip  # Handle gzipped files
+import json  # Write fastp-like reports
+import logging  # Traces and loggings
+import numpy  # Vectorized statistics
+import sys  # System related methods
+
+from concurrent.futures import ThreadPoolExecutor  # Process mates together
+from pathlib import Path  # Paths related methods
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from common_script_ngs_cleaning import CustomFormatter
+from fastq_codecs import open_input
+
+
+# Size of decompressed blocks parsed at once
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# Number of reads considered for the duplication rate estimation
+DUP_READS = 1000000
+
+# Phred+33 encoding of quality scores, in printable ASCII characters
+PHRED_OFFSET = 33
+QUALITY_CHARS = 128
+
+# Bases, in the order of fastp reports. Other letters are counted as N.
+BASES = "ATCGN"
+BASE_KEYS = numpy.full(256, 4 * QUALITY_CHARS, dtype=numpy.int32)
+for code, base in enumerate("ATCG"):
+    BASE_KEYS[ord(base)] = code * QUALITY_CHARS
+    BASE_KEYS[ord(base.lower())] = code * QUALITY_CHARS
+
+# Number of cycles counted together, and the key offsets of these cycles
+CYCLES_PER_COUNT = 16
+CYCLE_OFFSETS = (
+    numpy.arange(CYCLES_PER_COUNT, dtype=numpy.int32)
+    * len(BASES) * QUALITY_CHARS
+)
+
+
+def read_records(
+    handle: BinaryIO, block_size: int = BLOCK_SIZE
+) -> Iterator[Tuple[List[bytes], List[bytes]]]:
+    """
+    Read a fastq stream by blocks, and yield the sequences and qualities
+    of the complete records of each block
+
+    Parameters:
+        handle      BinaryIO    Opened fastq stream
+        block_size  int         Number of bytes read at once
+    """
+    remainder = b""
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+        lines = (remainder + block).split(b"\n")
+        complete = 4 * ((len(lines) - 1) // 4)
+        remainder = b"\n".join(lines[complete:])
+        if complete > 0:
+            yield lines[1:complete:4], lines[3:complete:4]
+
+    lines = remainder.rstrip(b"\n").split(b"\n") if remainder.strip() else []
+    if len(lines) % 4 != 0:
+        raise ValueError("Fastq file is truncated: incomplete last record")
+    if lines:
+        yield lines[1::4], lines[3::4]
+
+
+class FastqStats:
+    """
+    Statistics of a single fastq stream, accumulated block after block.
+
+    Everything but lengths and duplication derives from a single per-cycle
+    histogram of (base, quality character) pairs.
+    """
+
+    def __init__(self, dup_reads: int = DUP_READS) -> None:
+        self.dup_reads = dup_reads
+        self.total_reads = 0
+        self.total_bases = 0
+        self.histogram = numpy.zeros(
+            (0, len(BASES), QUALITY_CHARS), dtype=numpy.int64
+        )
+        self.length_counts = numpy.zeros(0, dtype=numpy.int64)
+        self.dup_hashes = set()
+        self.dup_considered = 0
+
+    @property
+    def base_counts(self) -> numpy.ndarray:
+        """
+        Number of each base at each cycle, one column per base
+        """
+        return self.histogram.sum(axis=2)
+
+    @property
+    def quality_sums(self) -> numpy.ndarray:
+        """
+        Sum of the quality scores of each base at each cycle
+        """
+        scores = numpy.arange(QUALITY_CHARS) - PHRED_OFFSET
+        return (self.histogram * scores).sum(axis=2)
+
+    def bases_above(self, quality: int) -> int:
+        """
+        Return the number of bases with a quality score of at least quality
+        """
+        return int(self.histogram[:, :, quality + PHRED_OFFSET:].sum())
+
+    @property
+    def q20_bases(self) -> int:
+        return self.bases_above(20)
+
+    @property
+    def q30_bases(self) -> int:
+        return self.bases_above(30)
+
+    def grow(self, cycles: int) -> None:
+        """
+        Make per-cycle accumulators long enough for the given read length
+        """
+        missing = cycles - self.histogram.shape[0]
+        if missing > 0:
+            self.histogram = numpy.concatenate([
+                self.histogram,
+                numpy.zeros((missing, len(BASES), QUALITY_CHARS),
+                            dtype=numpy.int64)
+            ])
+        missing = cycles + 1 - self.length_counts.shape[0]
+        if missing > 0:
+            self.length_counts = numpy.concatenate([
+                self.length_counts, numpy.zeros(missing, dtype=numpy.int64)
+            ])
+
+    def update(self, sequences: List[bytes], qualities: List[bytes]) -> None:
+        """
+        Accumulate the statistics of a batch of records
+        """
+        lengths = numpy.fromiter(
+            map(len, sequences), dtype=numpy.int64, count=len(sequences)
+        )
+        if lengths.size == 0:
+            return
+        self.grow(int(lengths.max()))
+        self.length_counts += numpy.bincount(
+            lengths, minlength=self.length_counts.shape[0]
+        )
+        self.total_reads += len(sequences)
+        self.total_bases += int(lengths.sum())
+
+        # Reads of equal lengths are processed as a single 2D array
+        unique_lengths = numpy.unique(lengths)
+        for length in unique_lengths.tolist():
+            if length == 0:
+                continue
+            if unique_lengths.size == 1:
+                group_seq, group_qual = sequences, qualities
+            else:
+                indices = numpy.flatnonzero(lengths == length).tolist()
+                group_seq = [sequences[i] for i in indices]
+                group_qual = [qualities[i] for i in indices]
+            self.update_cycles(
+                numpy.frombuffer(b"".join(group_seq), dtype=numpy.uint8),
+                numpy.frombuffer(b"".join(group_qual), dtype=numpy.uint8),
+                length
+            )
+
+        if self.dup_considered < self.dup_reads:
+            considered = sequences[:self.dup_reads - self.dup_considered]
+            self.dup_hashes.update(map(hash, considered))
+            self.dup_considered += len(considered)
+
+    def update_cycles(
+        self, bases: numpy.ndarray, qualities: numpy.ndarray, length: int
+    ) -> None:
+        """
+        Accumulate per-cycle statistics of reads of a given length, given
+        as flat arrays of concatenated sequences and qualities
+        """
+        if bases.size != qualities.size:
+            raise ValueError("Sequences and qualities differ in length")
+
+        # Each (base, quality) pair is a single key. Keys of a few cycles
+        # at a time are offset by cycle and counted together: bincount
+        # over small contiguous arrays is faster than over the whole block
+        keys = BASE_KEYS[bases]
+        keys += qualities & (QUALITY_CHARS - 1)
+        keys = keys.reshape(-1, length)
+        nb_keys = len(BASES) * QUALITY_CHARS
+        for first in range(0, length, CYCLES_PER_COUNT):
+            last = min(first + CYCLES_PER_COUNT, length)
+            cycle_keys = keys[:, first:last] + CYCLE_OFFSETS[:last - first]
+            self.histogram[first:last] += numpy.bincount(
+                cycle_keys.ravel(), minlength=(last - first) * nb_keys
+            ).reshape(last - first, len(BASES), QUALITY_CHARS)
+
+    def mean_length(self) -> int:
+        """
+        Return the mean read length
+        """
+        return round(self.total_bases / self.total_reads) if self else 0
+
+    def duplication_rate(self) -> float:
+        """
+        Return the fraction of duplicated sequences among the first reads
+        """
+        if self.dup_considered == 0:
+            return 0.0
+        return 1 - len(self.dup_hashes) / self.dup_considered
+
+    def __bool__(self) -> bool:
+        return self.total_reads > 0
+
+    def to_fastp(self) -> Dict[str, Any]:
+        """
+        Return statistics as a fastp read{1,2}_{stage}_filtering section
+        """
+        counts = self.base_counts
+        quality_sums = self.quality_sums
+        per_cycle = numpy.maximum(counts.sum(axis=1), 1)
+
+        def curve(values: numpy.ndarray) -> List[float]:
+            return numpy.round(values, 4).tolist()
+
+        quality_curves = {
+            base: curve(
+                quality_sums[:, i] / numpy.maximum(counts[:, i], 1)
+            )
+            for i, base in enumerate(BASES[:4])
+        }
+        quality_curves["mean"] = curve(
+            quality_sums.sum(axis=1) / per_cycle
+        )
+        content_curves = {
+            base: curve(counts[:, i] / per_cycle)
+            for i, base in enumerate(BASES)
+        }
+        content_curves["GC"] = curve(counts[:, 2:4].sum(axis=1) / per_cycle)
+
+        return {
+            "total_reads": self.total_reads,
+            "total_bases": self.total_bases,
+            "q20_bases": self.q20_bases,
+            "q30_bases": self.q30_bases,
+            "total_cycles": int(counts.shape[0]),
+            "quality_curves": quality_curves,
+            "content_curves": content_curves,
+            "length_histogram": self.length_counts.tolist(),
+            "n_rate": (
+                int(counts[:, 4].sum()) / self.total_bases if self else 0.0
+            ),
+            "duplication_rate": self.duplication_rate(),
+        }
+
+
+def fastq_stats(
+    path: Path,
+    block_size: int = BLOCK_SIZE,
+    dup_reads: int = DUP_READS,
+    max_reads: Optional[int] = None
+) -> FastqStats:
+    """
+    Compute the statistics of a fastq file
+
+    Parameters:
+        path        Path    Path to a fastq file, gzipped or not
+        block_size  int     Number of bytes parsed at once
+        dup_reads   int     Number of reads considered for duplication
+        max_reads   int     Stop after this number of reads, if any
+
+    Example:
+    >>> fastq_stats(Path("S1_R1.fq.gz")).mean_length()
+    101
+    """
+    stats = FastqStats(dup_reads)
+    with open_input(path) as handle:
+        for sequences, qualities in read_records(handle, block_size):
+            if max_reads is not None:
+                sequences = sequences[:max_reads - stats.total_reads]
+                qualities = qualities[:len(sequences)]
+            stats.update(sequences, qualities)
+            if max_reads is not None and stats.total_reads >= max_reads:
+                break
+    logging.info(f"{stats.total_reads} reads in {path}")
+    return stats
+
+
+def fastp_report(
+    mates: List[FastqStats], stage: str = "before"
+) -> Dict[str, Any]:
+    """
+    Build a fastp-like report from the statistics of each mate
+
+    Parameters:
+        mates   List[FastqStats]    Statistics of R1, and R2 if any
+        stage   str                 before (raw reads) or after (trimmed)
+    """
+    total_bases = sum(mate.total_bases for mate in mates)
+    q20_bases = sum(mate.q20_bases for mate in mates)
+    q30_bases = sum(mate.q30_bases for mate in mates)
+    gc_bases = sum(int(mate.base_counts[:, 2:4].sum()) for mate in mates)
+    summary = {
+        "total_reads": sum(mate.total_reads for mate in mates),
+        "total_bases": total_bases,
+        "q20_bases": q20_bases,
+        "q30_bases": q30_bases,
+        "q20_rate": q20_bases / total_bases if total_bases else 0.0,
+        "q30_rate": q30_bases / total_bases if total_bases else 0.0,
+        "gc_content": gc_bases / total_bases if total_bases else 0.0,
+    }
+    for read, mate in enumerate(mates, 1):
+        summary[f"read{read}_mean_length"] = mate.mean_length()
+
+    cycles = " + ".join(
+        f"{mate.base_counts.shape[0]} cycles" for mate in mates
+    )
+    report = {
+        "summary": {
+            "fastp_version": "ngs-cleaning fastq_stats",
+            "sequencing": (
+                f"paired end ({cycles})" if len(mates) == 2
+                else f"single end ({cycles})"
+            ),
+            f"{stage}_filtering": summary,
+        },
+        "duplication": {
+            "rate": sum(
+                mate.duplication_rate() for mate in mates
+            ) / len(mates)
+        },
+    }
+    for read, mate in enumerate(mates, 1):
+        report[f"read{read}_{stage}_filtering"] = mate.to_fastp()
+    return report
+
+
+def test_fastq_stats(tmp_path: Path) -> None:
+    """
+    This function tests statistics on a small fastq file, parsed with
+    blocks smaller than records
+
+    Example:
+    pytest -v ./fastq_stats.py -k test_fastq_stats
+    """
+    path = tmp_path / "reads.fq.gz"
+    with gzip.open(path, "wb") as fq:
+        fq.write(b"@r1\nACGT\n+\nI+I5\n")
+        fq.write(b"@r2\nACGN\n+\nIIII\n")
+        fq.write(b"@r3\nACGT\n+\nI+I5\n")
+        fq.write(b"@r4\nAC\n+\nII")
+
+    for block_size in [7, BLOCK_SIZE]:
+        stats = fastq_stats(path, block_size=block_size)
+        assert stats.total_reads == 4
+        assert stats.total_bases == 14
+        assert stats.q30_bases == 10
+        assert stats.q20_bases == 12
+        assert stats.length_counts.tolist() == [0, 0, 1, 0, 3]
+        assert stats.duplication_rate() == 0.25
+
+        section = stats.to_fastp()
+        assert section["total_cycles"] == 4
+        assert section["n_rate"] == 1 / 14
+        assert section["content_curves"]["A"][:2] == [1.0, 0.0]
+        assert section["content_curves"]["N"][3] == 0.3333
+        assert section["quality_curves"]["A"][0] == 40.0
+        assert section["quality_curves"]["mean"][1] == 25.0
+
+    assert fastq_stats(path, max_reads=2).total_reads == 2
+
+    report = fastp_report([stats, stats])
+    assert report["summary"]["before_filtering"]["total_reads"] == 8
+    assert report["summary"]["before_filtering"]["gc_content"] == 0.5
+    assert report["summary"]["sequencing"] == (
+        "paired end (4 cycles + 4 cycles)"
+    )
+    assert "read2_before_filtering" in report
+
+    truncated = tmp_path / "truncated.fq"
+    truncated.write_bytes(b"@r1\nACGT\n+\n")
+    try:
+        fastq_stats(truncated)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Truncated fastq files should be rejected")
+
+    truncated = tmp_path / "truncated.fq.gz"
+    truncated.write_bytes(path.read_bytes()[:-10])
+    try:
+        fastq_stats(truncated)
+    except EOFError:
+        pass
+    else:
+        raise AssertionError("Truncated gzip members should be rejected")
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "fq_files",
+        help="Fastq files of a sample: R1, and R2 if any",
+        type=Path,
+        nargs="+",
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the fastp-like JSON report",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--stage",
+        help="Whether reads are raw (before) or trimmed (after) "
+             "(default: %(default)s)",
+        type=str,
+        choices=["before", "after"],
+        default="before",
+    )
+
+    main_parser.add_argument(
+        "--max-reads",
+        help="Only consider this number of first reads per file "
+             "(default: all reads)",
+        type=int,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--dup-reads",
+        help="Number of reads considered for duplication rate estimation "
+             "(default: %(default)s)",
+        type=int,
+        default=DUP_READS,
+    )
+
+    main_parser.add_argument(
+        "--block-size",
+        help="Size of parsed blocks, in MB (default: %(default)s)",
+        type=int,
+        default=BLOCK_SIZE // (1024 * 1024),
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function computes and saves the statistics of all mates
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    with ThreadPoolExecutor(max_workers=len(args.fq_files)) as executor:
+        mates = list(executor.map(
+            lambda path: fastq_stats(
+                path,
+                args.block_size * 1024 * 1024,
+                args.dup_reads,
+                args.max_reads
+            ),
+            args.fq_files
+        ))
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with args.output.open("w") as output:
+        json.dump(fastp_report(mates, args.stage), output, indent=4)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,299 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script merges the fastp JSON reports of the chunks of a sample into a
+single fastp JSON report, which MultiQC still understands.
+
+Read, base and k-mer counts, as well as histograms, are summed. Per-cycle
+curves and other ratios are averaged, weighted by the number of reads of
+each chunk. Quality rates, mean lengths and insert size peak are then
+computed again from merged values.
+
+A short HTML summary is written along, since fastp HTML reports can not be
+merged.
+
+You can test this script with:
+pytest -v ./merge_fastp_json.py
+
+Usage example:
+python3.8 ./merge_fastp_json.py chunks/0.fastp.json chunks/1.fastp.json \
+    --output S1.fastp.json --html S1.fastp.html
+"""
+
+import argparse  # Parse command line
+import json  # Handle fastp reports
+import logging  # Traces and loggings
+import sys  # System related methods
+
+from itertools import zip_longest  # Pad per-cycle values
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List, Optional  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+
+
+# Integer values which are not counts
+MAX_KEYS = {"total_cycles"}
+MEAN_KEYS = {"read1_mean_length", "read2_mean_length"}
+
+
+def merge_values(
+    values: List[Any], weights: List[float], key: Optional[str] = None
+) -> Any:
+    """
+    Merge the values found under a given key in each chunk report
+
+    Parameters:
+        values      List[Any]       Values of each chunk
+        weights     List[float]     Number of reads of each chunk
+        key         str             Key of the values, if any
+
+    Example:
+    >>> merge_values([{"total_reads": 2, "rate": 0.5},
+    ...               {"total_reads": 6, "rate": 0.1}], [1, 1])
+    {'total_reads': 8, 'rate': 0.2}
+    """
+    first = values[0]
+    if isinstance(first, dict):
+        # Nested sections are weighted by their own number of reads
+        if all(isinstance(value.get("total_reads"), int) for value in values):
+            weights = [value["total_reads"] for value in values]
+        keys = dict.fromkeys(name for value in values for name in value)
+        return {
+            name: merge_values(
+                [value[name] for value in values if name in value],
+                [w for value, w in zip(values, weights) if name in value],
+                name
+            )
+            for name in keys
+        }
+
+    if isinstance(first, list):
+        columns = list(zip_longest(*values))
+        if key == "histogram":
+            return [sum(v for v in column if v is not None)
+                    for column in columns]
+        return [
+            weighted_mean(
+                [v for v in column if v is not None],
+                [w for v, w in zip(column, weights) if v is not None]
+            )
+            for column in columns
+        ]
+
+    if isinstance(first, bool) or isinstance(first, str):
+        return first
+
+    if isinstance(first, int):
+        if key in MAX_KEYS:
+            return max(values)
+        if key in MEAN_KEYS:
+            return round(weighted_mean(values, weights))
+        return sum(values)
+
+    return weighted_mean(values, weights)
+
+
+def weighted_mean(values: List[float], weights: List[float]) -> float:
+    """
+    Return the mean of values, weighted by the given weights
+    """
+    total = sum(weights)
+    if total == 0:
+        return sum(values) / len(values)
+    return sum(v * w for v, w in zip(values, weights)) / total
+
+
+def update_rates(section: Dict[str, Any]) -> None:
+    """
+    Compute rates and peaks again from merged counts, in place
+    """
+    for value in section.values():
+        if isinstance(value, dict):
+            update_rates(value)
+
+    total_bases = section.get("total_bases")
+    for quality in ["q20", "q30"]:
+        if total_bases and f"{quality}_bases" in section:
+            section[f"{quality}_rate"] = (
+                section[f"{quality}_bases"] / total_bases
+            )
+
+    if section.get("histogram") and "peak" in section:
+        histogram = section["histogram"]
+        section["peak"] = histogram.index(max(histogram))
+
+
+def merge_reports(reports: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Merge fastp reports of the chunks of a sample into a single report
+    """
+    if not reports:
+        raise ValueError("No fastp report to merge")
+    weights = [
+        report["summary"]["before_filtering"]["total_reads"]
+        for report in reports
+    ]
+    merged = merge_values(reports, weights)
+    update_rates(merged)
+    return merged
+
+
+def test_merge_reports() -> None:
+    """
+    This function tests the merge of two chunks reports
+
+    Example:
+    pytest -v ./merge_fastp_json.py -k test_merge_reports
+    """
+    def chunk(reads: int, q30_bases: int, mean: float) -> Dict[str, Any]:
+        return {
+            "summary": {
+                "fastp_version": "0.20.1",
+                "before_filtering": {
+                    "total_reads": reads, "total_bases": reads * 100,
+                    "q30_bases": q30_bases, "q30_rate": 0.0,
+                    "read1_mean_length": 100, "gc_content": mean
+                }
+            },
+            "duplication": {"rate": mean},
+            "insert_size": {
+                "peak": 0, "unknown": 1, "histogram": [reads, 3, 1]
+            },
+            "read1_before_filtering": {
+                "total_reads": reads, "total_cycles": reads,
+                "quality_curves": {"mean": [mean, mean]},
+                "kmer_count": {"AAAAA": 1}
+            },
+            "command": "fastp -i chunk.fq.gz"
+        }
+
+    merged = merge_reports([chunk(1, 50, 30.0), chunk(3, 250, 34.0)])
+    summary = merged["summary"]["before_filtering"]
+    assert summary["total_reads"] == 4
+    assert summary["q30_rate"] == 0.75
+    assert summary["read1_mean_length"] == 100
+    assert summary["gc_content"] == 33.0
+    assert merged["summary"]["fastp_version"] == "0.20.1"
+    assert merged["duplication"]["rate"] == 33.0
+    assert merged["insert_size"] == {
+        "peak": 1, "unknown": 2, "histogram": [4, 6, 2]
+    }
+    assert merged["read1_before_filtering"]["total_cycles"] == 3
+    assert merged["read1_before_filtering"]["quality_curves"] == {
+        "mean": [33.0, 33.0]
+    }
+    assert merged["read1_before_filtering"]["kmer_count"] == {"AAAAA": 2}
+
+    # A chunk without reads does not weigh on means
+    merged = merge_reports([chunk(0, 0, 0.0), chunk(3, 250, 34.0)])
+    assert merged["summary"]["before_filtering"]["gc_content"] == 34.0
+    assert merged["duplication"]["rate"] == 34.0
+    try:
+        merge_reports([])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("An empty list of reports should be rejected")
+
+
+def write_html(report: Dict[str, Any], nb_chunks: int, html: Path) -> None:
+    """
+    Write a short HTML summary of a merged report
+    """
+    rows = "".join(
+        f"<tr><td>{stage}</td><td>{key}</td><td>{value}</td></tr>"
+        for stage in ["before_filtering", "after_filtering"]
+        for key, value in report["summary"].get(stage, {}).items()
+    )
+    html.write_text(
+        "<html><head><title>fastp report</title></head><body>"
+        f"<h1>fastp report</h1><p>Merged from {nb_chunks} chunks. See the "
+        "JSON report or the MultiQC report for details.</p>"
+        f"<table>{rows}</table></body></html>\n"
+    )
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "reports",
+        help="fastp JSON reports of each chunk",
+        type=Path,
+        nargs="+",
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the merged fastp JSON report",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--html",
+        help="Path to the HTML summary of the merged report",
+        type=Path,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function merges the given reports
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    reports = []
+    for path in args.reports:
+        with path.open() as report:
+            reports.append(json.load(report))
+
+    merged = merge_reports(reports)
+    with args.output.open("w") as output:
+        json.dump(merged, output, indent=4)
+    logging.info(f"{len(reports)} reports merged in {args.output}")
+
+    if args.html is not None:
+        write_html(merged, len(reports), args.html)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
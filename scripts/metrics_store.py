@@ -0,0 +1,374 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script keeps a cohort table of quality metrics, one row per sample,
+and renders a lightweight HTML report from it.
+
+row: the fastp JSON report and the fastq_screen tables of a sample are
+parsed once, into a single row file.
+
+aggregate: row files are appended to a persistent cohort table. Only rows
+missing from the table, or written after it, are read: adding samples to
+a cohort costs work proportional to the new samples only. Rows of samples
+which are not given anymore are dropped.
+
+Tables are written in Parquet when their name ends with .parquet (this
+requires pyarrow), in TSV otherwise.
+
+You can test this script with:
+pytest -v ./metrics_store.py
+
+Usage example:
+python3.8 ./metrics_store.py row --sample S1 --fastp S1.fastp.json \
+    --screen S1.R1.fastq_screen.txt S1.R2.fastq_screen.txt \
+    --output qc/metrics/S1.tsv
+python3.8 ./metrics_store.py aggregate qc/metrics/S1.tsv qc/metrics/S2.tsv \
+    --store qc/metrics.tsv --html multiqc/metrics.html
+"""
+
+import argparse  # Parse command line
+import json  # Handle fastp reports
+import logging  # Traces and loggings
+import os  # OS related activities
+import pandas  # Handle metrics tables
+import sys  # System related methods
+
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List, Optional  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+
+
+# Columns of fastp JSON reports kept in rows, as (column, path in report)
+FASTP_METRICS = [
+    ("reads_before", ("summary", "before_filtering", "total_reads")),
+    ("reads_after", ("summary", "after_filtering", "total_reads")),
+    ("bases_before", ("summary", "before_filtering", "total_bases")),
+    ("bases_after", ("summary", "after_filtering", "total_bases")),
+    ("q20_rate_before", ("summary", "before_filtering", "q20_rate")),
+    ("q20_rate_after", ("summary", "after_filtering", "q20_rate")),
+    ("q30_rate_before", ("summary", "before_filtering", "q30_rate")),
+    ("q30_rate_after", ("summary", "after_filtering", "q30_rate")),
+    ("gc_content_before", ("summary", "before_filtering", "gc_content")),
+    ("gc_content_after", ("summary", "after_filtering", "gc_content")),
+    ("duplication_rate", ("duplication", "rate")),
+    ("adapter_trimmed_reads", ("adapter_cutting", "adapter_trimmed_reads")),
+    ("adapter_trimmed_bases", ("adapter_cutting", "adapter_trimmed_bases")),
+    ("insert_size_peak", ("insert_size", "peak")),
+    ("passed_filter_reads", ("filtering_result", "passed_filter_reads")),
+    ("low_quality_reads", ("filtering_result", "low_quality_reads")),
+    ("too_many_n_reads", ("filtering_result", "too_many_N_reads")),
+    ("too_short_reads", ("filtering_result", "too_short_reads")),
+]
+
+
+def fastp_metrics(report: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return the metrics of a fastp JSON report kept in rows. Missing
+    metrics (e.g. insert size of single-end reads) are None.
+
+    Example:
+    >>> fastp_metrics({"duplication": {"rate": 0.1}})["duplication_rate"]
+    0.1
+    """
+    metrics = {}
+    for column, keys in FASTP_METRICS:
+        value = report
+        for key in keys:
+            value = value.get(key) if isinstance(value, dict) else None
+        metrics[column] = value
+    return metrics
+
+
+def fastq_screen_metrics(txt: Path, stream: str) -> Dict[str, float]:
+    """
+    Return the percent of reads hitting each genome, and hitting no
+    genome, in a fastq_screen table
+    """
+    metrics = {}
+    with txt.open() as table:
+        header = None
+        for line in table:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] == "Genome":
+                header = fields
+            elif line.startswith("%Hit_no_genomes:"):
+                metrics[f"{stream}_no_hit_percent"] = float(
+                    line.split(":")[1]
+                )
+            elif header is not None and len(fields) == len(header):
+                row = dict(zip(header, fields))
+                metrics[f"{stream}_{fields[0]}_percent"] = round(
+                    100 - float(row["%Unmapped"]), 2
+                )
+    return metrics
+
+
+def sample_row(
+    sample: str,
+    fastp_json: Path,
+    screens: List[Path],
+    manifest: Optional[Path] = None
+) -> pandas.DataFrame:
+    """
+    Return the metrics row of a sample. fastq_screen tables are expected
+    to be named {sample}.{stream}.fastq_screen.txt. Raw records and bases
+    are taken from the manifest of the sample (see pair_manifest.py), if
+    any.
+    """
+    with fastp_json.open() as report:
+        metrics = {"sample": sample, **fastp_metrics(json.load(report))}
+    if manifest is not None:
+        with manifest.open() as manifest_json:
+            counts = json.load(manifest_json)
+        metrics["raw_records"] = counts["records"]
+        metrics["raw_bases"] = counts["bases"]
+    for screen in screens:
+        stream = screen.name[len(sample) + 1:].split(".")[0]
+        metrics.update(fastq_screen_metrics(screen, stream))
+    return pandas.DataFrame([metrics]).set_index("sample")
+
+
+def read_table(path: Path) -> pandas.DataFrame:
+    """
+    Load a metrics table, be it in Parquet or TSV
+    """
+    if path.suffix == ".parquet":
+        return pandas.read_parquet(path)
+    return pandas.read_csv(path, sep="\t", index_col="sample")
+
+
+def write_table(table: pandas.DataFrame, path: Path) -> None:
+    """
+    Atomically write a metrics table, be it in Parquet or TSV
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    if path.suffix == ".parquet":
+        table.to_parquet(tmp_path)
+    else:
+        table.to_csv(tmp_path, sep="\t", index_label="sample")
+    os.replace(tmp_path, path)
+
+
+def update_store(store: Path, rows: List[Path]) -> pandas.DataFrame:
+    """
+    Append new or updated rows to the cohort table, drop rows of samples
+    which are not given anymore, and return the cohort table. Row files
+    are expected to be named {sample}.{format}
+    """
+    samples = {row.name[:-len(row.suffix)]: row for row in rows}
+    table, store_mtime = None, None
+    if store.exists():
+        table = read_table(store)
+        store_mtime = store.stat().st_mtime_ns
+        table = table[table.index.isin(samples.keys())]
+
+    updated = [
+        row for sample, row in samples.items()
+        if table is None or sample not in table.index
+        or row.stat().st_mtime_ns > store_mtime
+    ]
+    logging.info(f"{len(updated)} of {len(samples)} rows to update")
+    new_rows = [read_table(row) for row in updated]
+    if table is not None:
+        table = table[~table.index.isin(
+            [row.name[:-len(row.suffix)] for row in updated]
+        )]
+        new_rows.insert(0, table)
+    table = pandas.concat(new_rows, sort=False) if new_rows else table
+
+    store.parent.mkdir(parents=True, exist_ok=True)
+    write_table(table, store)
+    return table
+
+
+def write_html(table: pandas.DataFrame, html: Path) -> None:
+    """
+    Write the cohort table as a lightweight HTML report
+    """
+    html.parent.mkdir(parents=True, exist_ok=True)
+    html.write_text(
+        "<html><head><title>Quality metrics</title></head><body>"
+        f"<h1>Quality metrics</h1><p>{len(table)} samples.</p>"
+        + table.to_html(float_format=lambda value: f"{value:.4g}")
+        + "</body></html>\n"
+    )
+
+
+def test_metrics_store(tmp_path: Path) -> None:
+    """
+    This function tests rows parsing and incremental aggregation
+
+    Example:
+    pytest -v ./metrics_store.py -k test_metrics_store
+    """
+    def write_inputs(sample: str, reads: int) -> List[Path]:
+        fastp_json = tmp_path / f"{sample}.fastp.json"
+        fastp_json.write_text(json.dumps({
+            "summary": {"before_filtering": {"total_reads": reads}},
+            "duplication": {"rate": 0.25}
+        }))
+        screen = tmp_path / f"{sample}.R1.fastq_screen.txt"
+        screen.write_text(
+            "#Fastq_screen version: 0.14.0\n"
+            "Genome\t#Reads_processed\t#Unmapped\t%Unmapped\n"
+            "Human\t100\t10\t10.00\n"
+            "\n%Hit_no_genomes: 8.00\n"
+        )
+        return [fastp_json, screen]
+
+    rows = []
+    for sample, reads in [("S1", 10), ("S2", 20)]:
+        fastp_json, screen = write_inputs(sample, reads)
+        manifest = tmp_path / f"{sample}.json"
+        manifest.write_text(json.dumps({"records": reads, "bases": 0}))
+        rows.append(tmp_path / "rows" / f"{sample}.tsv")
+        rows[-1].parent.mkdir(exist_ok=True)
+        write_table(
+            sample_row(sample, fastp_json, [screen], manifest), rows[-1]
+        )
+
+    store = tmp_path / "metrics.tsv"
+    table = update_store(store, rows[:1])
+    assert table.loc["S1", "reads_before"] == 10
+    assert table.loc["S1", "R1_Human_percent"] == 90
+    assert table.loc["S1", "R1_no_hit_percent"] == 8
+    assert table.loc["S1", "raw_records"] == 10
+
+    # Only the new row is read: the stored one is not parsed again
+    rows[0].write_text("not a table")
+    os.utime(rows[0], ns=(0, 0))
+    table = update_store(store, rows)
+    assert list(table.index) == ["S1", "S2"]
+    assert table.loc["S2", "reads_before"] == 20
+
+    table = update_store(store, rows[1:])
+    assert list(read_table(store).index) == ["S2"]
+
+    write_html(table, tmp_path / "metrics.html")
+    assert "S2" in (tmp_path / "metrics.html").read_text()
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+    subparsers = main_parser.add_subparsers(dest="command", required=True)
+
+    row_parser = subparsers.add_parser(
+        "row",
+        help="Parse the reports of a sample into a single row",
+        formatter_class=CustomFormatter,
+    )
+    row_parser.add_argument(
+        "--sample",
+        help="Sample identifier",
+        type=str,
+        required=True,
+    )
+    row_parser.add_argument(
+        "--fastp",
+        help="fastp JSON report of the sample",
+        type=Path,
+        required=True,
+    )
+    row_parser.add_argument(
+        "--screen",
+        help="fastq_screen tables of the sample, if any",
+        type=Path,
+        nargs="*",
+        default=[],
+    )
+    row_parser.add_argument(
+        "--manifest",
+        help="Manifest of the raw reads of the sample, if any",
+        type=Path,
+        default=None,
+    )
+    row_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the row file (.parquet or .tsv)",
+        type=Path,
+        required=True,
+    )
+
+    aggregate_parser = subparsers.add_parser(
+        "aggregate",
+        help="Append rows to the cohort table, and render a report",
+        formatter_class=CustomFormatter,
+    )
+    aggregate_parser.add_argument(
+        "rows",
+        help="Row files of all samples of the cohort",
+        type=Path,
+        nargs="+",
+    )
+    aggregate_parser.add_argument(
+        "--store",
+        help="Path to the persistent cohort table (.parquet or .tsv)",
+        type=Path,
+        required=True,
+    )
+    aggregate_parser.add_argument(
+        "--html",
+        help="Path to the HTML report",
+        type=Path,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function builds a row, or updates the cohort table
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    if args.command == "row":
+        row = sample_row(
+            args.sample, args.fastp, args.screen, args.manifest
+        )
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        write_table(row, args.output)
+        return
+
+    table = update_store(args.store, args.rows)
+    if args.html is not None:
+        write_html(table, args.html)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
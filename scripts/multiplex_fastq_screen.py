@@ -0,0 +1,401 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script lets a single fastq_screen job screen the reads of a batch of
+samples, so that aligner indexes are loaded once per batch, instead of
+once per sample.
+
+multiplex: reads of each sample are written in a single fastq file, their
+names prefixed with the index of their sample in the batch.
+
+demultiplex: fastq_screen is run with --tag on the multiplexed file. Its
+tagged reads are then dealt back to their samples, and the screen table of
+each sample is computed again from read tags, in the format of
+fastq_screen, which MultiQC understands. A stacked bar chart is drawn
+along, without labels, in place of the fastq_screen plot.
+
+You can test this script with:
+pytest -v ./multiplex_fastq_screen.py
+
+Usage example:
+python3.8 ./multiplex_fastq_screen.py multiplex S1.R1.fastq S2.R1.fastq \
+    --output batch_0.fastq
+fastq_screen --tag --subset 0 --conf fastq_screen.conf batch_0.fastq
+python3.8 ./multiplex_fastq_screen.py demultiplex batch_0.tagged.fastq \
+    --txt S1.R1.fastq_screen.txt S2.R1.fastq_screen.txt \
+    --png S1.R1.fastq_screen.png S2.R1.fastq_screen.png
+"""
+
+import argparse  # Parse command line
+import logging  # Traces and loggings
+import struct  # Build PNG chunks
+import sys  # System related methods
+import zlib  # Compress PNG pixels
+
+from pathlib import Path  # Paths related methods
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from common_script_ngs_cleaning import CustomFormatter
+from concatenate_fastq import BUFFER_SIZE
+from fastq_codecs import open_input
+from subsample_fastq import iter_records
+
+
+# Separates the sample index from the read name in multiplexed reads
+SEPARATOR = b"|"
+
+# Marks the tag added by fastq_screen at the end of read names
+TAG = b"#FQST:"
+
+# Screen table columns, after the number of reads processed
+CATEGORIES = [
+    "Unmapped",
+    "One_hit_one_genome",
+    "Multiple_hits_one_genome",
+    "One_hit_multiple_genomes",
+    "Multiple_hits_multiple_genomes",
+]
+
+# Colors of mapped categories in the bar chart, as in fastq_screen
+COLORS = [
+    (140, 180, 230),
+    (30, 70, 160),
+    (240, 140, 140),
+    (160, 30, 30),
+]
+
+
+def multiplex(fq_files: List[Path], output: BinaryIO) -> List[int]:
+    """
+    Write the reads of each fastq file in a single stream, their names
+    prefixed with the index of their file. Returns the number of reads of
+    each file.
+
+    Example:
+    >>> with open("batch.fastq", "wb") as batch:
+    ...     multiplex([Path("S1.R1.fastq"), Path("S2.R1.fastq")], batch)
+    [100000, 100000]
+    """
+    reads = []
+    for index, fq_file in enumerate(fq_files):
+        prefix = b"@%d%s" % (index, SEPARATOR)
+        reads.append(0)
+        with open_input(fq_file) as handle:
+            for name, sequence, plus, quality in iter_records(handle):
+                output.write(prefix + name[1:])
+                output.writelines((sequence, plus, quality))
+                reads[-1] += 1
+    return reads
+
+
+def parse_tag(name: bytes) -> Tuple[int, Optional[List[str]], bytes]:
+    """
+    Return the sample index, the genomes (listed in the first read only)
+    and the hit codes of a tagged read name
+
+    Example:
+    >>> parse_tag(b"@1|read1#FQST:Human:Mouse:10")
+    (1, ['Human', 'Mouse'], b'10')
+    >>> parse_tag(b"@0|read2#FQST:02")
+    (0, None, b'02')
+    """
+    index, _, rest = name[1:].partition(SEPARATOR)
+    tag = rest[rest.rindex(TAG) + len(TAG):].split()[0]
+    *genomes, codes = tag.split(b":")
+    return (
+        int(index),
+        [genome.decode() for genome in genomes] if genomes else None,
+        codes
+    )
+
+
+def count_hits(
+    tagged: BinaryIO, nb_samples: int
+) -> Tuple[List[str], List[Dict[bytes, int]]]:
+    """
+    Count the reads of each sample, by hit codes. Returns the screened
+    genomes and, for each sample, the number of reads per hit codes.
+    """
+    genomes = None
+    counts = [{} for _ in range(nb_samples)]
+    for record in iter_records(tagged):
+        index, named, codes = parse_tag(record[0].rstrip())
+        if named is not None:
+            genomes = named
+        counts[index][codes] = counts[index].get(codes, 0) + 1
+    if genomes is None:
+        raise ValueError("No genome listed in tagged reads")
+    return genomes, counts
+
+
+def screen_table(
+    genomes: List[str], counts: Dict[bytes, int]
+) -> Tuple[Dict[str, Dict[str, int]], int, int]:
+    """
+    Return, for each genome, the number of reads in each category, along
+    with the number of reads and the number of reads hitting no genome
+
+    Example:
+    >>> table, reads, no_hit = screen_table(["Human", "PhiX"],
+    ...                                     {b"10": 3, b"21": 1, b"00": 1})
+    >>> table["Human"]["One_hit_one_genome"], reads, no_hit
+    (3, 5, 1)
+    """
+    table = {genome: dict.fromkeys(CATEGORIES, 0) for genome in genomes}
+    for codes, reads in counts.items():
+        multiple_genomes = sum(code != ord("0") for code in codes) > 1
+        for genome, code in zip(genomes, codes):
+            if code == ord("0"):
+                category = "Unmapped"
+            elif code == ord("1"):
+                category = "One_hit_" + (
+                    "multiple_genomes" if multiple_genomes else "one_genome"
+                )
+            else:
+                category = "Multiple_hits_" + (
+                    "multiple_genomes" if multiple_genomes else "one_genome"
+                )
+            table[genome][category] += reads
+    no_hit = counts.get(b"0" * len(genomes), 0)
+    return table, sum(counts.values()), no_hit
+
+
+def write_txt(
+    table: Dict[str, Dict[str, int]],
+    reads: int,
+    no_hit: int,
+    txt: Path,
+    aligner: str = "bowtie2"
+) -> None:
+    """
+    Write a screen table in the text format of fastq_screen
+    """
+    def percent(value: int) -> str:
+        return f"{100 * value / reads:.2f}" if reads else "0.00"
+
+    header = ["Genome", "#Reads_processed"]
+    for category in CATEGORIES:
+        header += [f"#{category}", f"%{category}"]
+    lines = [
+        "#Fastq_screen version: multiplexed\t"
+        f"#Aligner: {aligner}\t#Reads in subset: {reads}",
+        "\t".join(header)
+    ]
+    for genome, categories in table.items():
+        row = [genome, str(reads)]
+        for category in CATEGORIES:
+            row += [str(categories[category]), percent(categories[category])]
+        lines.append("\t".join(row))
+    lines += ["", f"%Hit_no_genomes: {percent(no_hit)}"]
+    txt.write_text("\n".join(lines) + "\n")
+
+
+def write_png(
+    table: Dict[str, Dict[str, int]],
+    reads: int,
+    png: Path,
+    bar_width: int = 40,
+    height: int = 200
+) -> None:
+    """
+    Draw the percentages of mapped reads per genome as stacked bars, in a
+    PNG file
+    """
+    width = bar_width * max(len(table), 1)
+    pixels = [bytearray(b"\xff" * 3 * width) for _ in range(height)]
+    for bar, categories in enumerate(table.values()):
+        bottom = 0
+        for category, color in zip(CATEGORIES[1:], COLORS):
+            top = bottom + (
+                height * categories[category] // reads if reads else 0
+            )
+            for row in range(height - top, height - bottom):
+                left = bar * bar_width + bar_width // 8
+                right = (bar + 1) * bar_width - bar_width // 8
+                pixels[row][3 * left:3 * right] = bytes(color) * (
+                    right - left
+                )
+            bottom = top
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data)) + kind + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    png.write_bytes(
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(
+            b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        )
+        + chunk(b"IDAT", zlib.compress(b"".join(
+            b"\x00" + bytes(row) for row in pixels
+        )))
+        + chunk(b"IEND", b"")
+    )
+
+
+def test_multiplex_screen(tmp_path: Path) -> None:
+    """
+    This function tests a multiplexing/demultiplexing round trip, with
+    fastq_screen tags added by hand
+
+    Example:
+    pytest -v ./multiplex_fastq_screen.py -k test_multiplex_screen
+    """
+    fq_files = [tmp_path / f"S{sample}.fastq" for sample in range(2)]
+    for sample, fq_file in enumerate(fq_files):
+        fq_file.write_bytes(b"".join(
+            b"@r%d 1:N:0\nACGT\n+\nIIII\n" % read
+            for read in range(2 + sample)
+        ))
+
+    batch = tmp_path / "batch.fastq"
+    with batch.open("wb") as output:
+        assert multiplex(fq_files, output) == [2, 3]
+
+    codes = [b"Human:PhiX:10", b"00", b"10", b"11", b"20"]
+    lines = batch.read_bytes().split(b"\n")
+    for read, code in enumerate(codes):
+        lines[4 * read] += TAG + code
+    with open(tmp_path / "batch.tagged.fastq", "wb") as tagged:
+        tagged.write(b"\n".join(lines))
+
+    with open_input(tmp_path / "batch.tagged.fastq") as tagged:
+        genomes, counts = count_hits(tagged, 2)
+    assert genomes == ["Human", "PhiX"]
+    assert counts == [{b"10": 1, b"00": 1}, {b"10": 1, b"11": 1, b"20": 1}]
+
+    table, reads, no_hit = screen_table(genomes, counts[1])
+    assert (reads, no_hit) == (3, 0)
+    assert table["Human"]["One_hit_one_genome"] == 1
+    assert table["Human"]["One_hit_multiple_genomes"] == 1
+    assert table["Human"]["Multiple_hits_one_genome"] == 1
+    assert table["PhiX"]["Unmapped"] == 2
+
+    txt, png = tmp_path / "S1.txt", tmp_path / "S1.png"
+    write_txt(table, reads, no_hit, txt)
+    write_png(table, reads, png)
+    assert txt.read_text().split("\n")[2].startswith(
+        "Human\t3\t0\t0.00\t1\t33.33\t1\t33.33\t1\t33.33\t0\t0.00"
+    )
+    assert png.read_bytes().startswith(b"\x89PNG")
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+    subparsers = main_parser.add_subparsers(dest="command", required=True)
+
+    multiplex_parser = subparsers.add_parser(
+        "multiplex",
+        help="Write reads of multiple samples in a single fastq file",
+        formatter_class=CustomFormatter,
+    )
+    multiplex_parser.add_argument(
+        "fq_files",
+        help="Fastq files to screen, in the order of outputs",
+        type=Path,
+        nargs="+",
+    )
+    multiplex_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the multiplexed fastq file",
+        type=Path,
+        required=True,
+    )
+
+    demultiplex_parser = subparsers.add_parser(
+        "demultiplex",
+        help="Deal tagged reads back to their samples, and write their "
+             "screen tables",
+        formatter_class=CustomFormatter,
+    )
+    demultiplex_parser.add_argument(
+        "tagged",
+        help="Reads tagged by fastq_screen --tag",
+        type=Path,
+    )
+    demultiplex_parser.add_argument(
+        "--txt",
+        help="Screen tables to write, one per multiplexed fastq file",
+        type=Path,
+        nargs="+",
+        required=True,
+    )
+    demultiplex_parser.add_argument(
+        "--png",
+        help="Bar charts to write, one per multiplexed fastq file",
+        type=Path,
+        nargs="+",
+        required=True,
+    )
+    demultiplex_parser.add_argument(
+        "--aligner",
+        help="Aligner used by fastq_screen (default: %(default)s)",
+        type=str,
+        default="bowtie2",
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function multiplexes or demultiplexes reads of a batch
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    if args.command == "multiplex":
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with args.output.open("wb", buffering=BUFFER_SIZE) as output:
+            reads = multiplex(args.fq_files, output)
+        logging.info(f"{sum(reads)} reads of {len(reads)} files multiplexed")
+        return
+
+    if len(args.txt) != len(args.png):
+        raise ValueError("Each screen table needs its bar chart")
+    with open_input(args.tagged) as tagged:
+        genomes, counts = count_hits(tagged, len(args.txt))
+    for sample_counts, txt, png in zip(counts, args.txt, args.png):
+        table, reads, no_hit = screen_table(genomes, sample_counts)
+        write_txt(table, reads, no_hit, txt, args.aligner)
+        write_png(table, reads, png)
+        logging.info(f"{reads} reads screened for {txt}")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
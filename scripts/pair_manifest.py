@@ -0,0 +1,308 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script checks that the mates of a paired sample hold the same number
+of records, and writes a small manifest of the sample: records, bases and
+a checksum of each mate.
+
+Mates are read at the same time, in two threads. Each one is decompressed
+by large blocks (zlib releases the GIL while inflating). Records are
+counted from the new lines of each block, sequence lengths are summed
+from every fourth line, and a CRC32 of the decompressed stream is kept,
+so that reads are never parsed one by one.
+
+The script fails, without writing the manifest, if a mate ends with an
+incomplete record or a truncated gzip member, or if mates differ in
+record counts.
+
+You can test this script with:
+pytest -v ./pair_manifest.py
+
+Usage example:
+python3.8 ./pair_manifest.py raw_data/S1_R1.fastq.gz \
+    raw_data/S1_R2.fastq.gz --sample S1 --output qc/pairs/S1.json
+"""
+
+import argparse  # Parse command line
+import gzip  # Build test files
+import json  # Write manifests
+import logging  # Traces and loggings
+import sys  # System related methods
+import zlib  # Decompress gzip members
+
+from concurrent.futures import ThreadPoolExecutor  # Read mates together
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, Iterator, List  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+from concatenate_fastq import is_gzip
+
+
+# Size of compressed blocks read at once
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def decompressed_blocks(
+    path: Path, block_size: int = BLOCK_SIZE
+) -> Iterator[bytes]:
+    """
+    Yield the decompressed content of a fastq file by blocks, be it
+    gzipped (with one or several members) or not. Raises EOFError if the
+    last gzip member is truncated.
+    """
+    gzipped = is_gzip(path)
+    with path.open("rb") as stream:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        pending = False
+        while True:
+            data = stream.read(block_size)
+            if not data:
+                break
+            if not gzipped:
+                yield data
+                continue
+            while data:
+                pending = True
+                block = decompressor.decompress(data)
+                if block:
+                    yield block
+                data = b""
+                if decompressor.eof:
+                    # Next gzip member, if any
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                    pending = False
+        if pending:
+            raise EOFError(f"{path} ends with a truncated gzip member")
+
+
+class MateCounter:
+    """
+    Records, bases and CRC32 of a fastq stream, updated block by block
+    """
+
+    def __init__(self) -> None:
+        self.lines = 0
+        self.bases = 0
+        self.crc32 = 0
+        self.rest = b""
+        self.last_lines = []
+
+    def update(self, block: bytes) -> None:
+        """
+        Update the CRC32 and count the complete lines of a block. The
+        incomplete last line is kept for the next block.
+        """
+        self.crc32 = zlib.crc32(block, self.crc32)
+        self.count_lines(block)
+
+    def count_lines(self, block: bytes) -> None:
+        """
+        Count the complete lines of a block, without updating the CRC32
+        """
+        end = block.rfind(b"\n") + 1
+        if end == 0:
+            self.rest += block
+            return
+        lines = (self.rest + block[:end]).split(b"\n")
+        self.rest = block[end:]
+        # Sequences are the second line of each record
+        first_sequence = (1 - self.lines) % 4
+        self.bases += sum(map(len, lines[first_sequence:-1:4]))
+        self.lines += len(lines) - 1
+        self.last_lines = (self.last_lines + lines[-5:-1])[-4:]
+
+    def manifest(self, path: Path) -> Dict[str, Any]:
+        """
+        Return the manifest of the stream, once fully read
+        """
+        if self.rest:
+            # The last line has no final new line
+            self.count_lines(b"\n")
+        if self.lines % 4 != 0:
+            raise ValueError(
+                f"{path} ends with an incomplete record "
+                f"({self.lines} lines)"
+            )
+        if self.lines and len(self.last_lines[1]) != len(self.last_lines[3]):
+            raise ValueError(f"{path} ends with an incomplete record")
+        return {
+            "file": str(path),
+            "records": self.lines // 4,
+            "bases": self.bases,
+            "crc32": f"{self.crc32:08x}",
+        }
+
+
+def count_mate(path: Path, block_size: int = BLOCK_SIZE) -> Dict[str, Any]:
+    """
+    Return the manifest of a single fastq file
+    """
+    counter = MateCounter()
+    for block in decompressed_blocks(path, block_size):
+        counter.update(block)
+    return counter.manifest(path)
+
+
+def pair_manifest(
+    sample: str, mates: List[Path], block_size: int = BLOCK_SIZE
+) -> Dict[str, Any]:
+    """
+    Return the manifest of a sample, once its mates are checked
+
+    Parameters:
+        sample      str             Sample identifier
+        mates       List[Path]      One or two fastq files
+        block_size  int             Size of compressed blocks
+
+    Return:
+                    Dict[str, Any]  Records and bases of the sample, and
+                                    the manifest of each mate
+    """
+    with ThreadPoolExecutor(max_workers=len(mates)) as executor:
+        counts = list(executor.map(
+            lambda mate: count_mate(mate, block_size), mates
+        ))
+
+    records = {count["records"] for count in counts}
+    if len(records) != 1:
+        raise ValueError(
+            f"Mates of {sample} differ in records: "
+            + ", ".join(f"{c['file']} has {c['records']}" for c in counts)
+        )
+
+    return {
+        "sample": sample,
+        "paired": len(mates) == 2,
+        "records": records.pop(),
+        "bases": sum(count["bases"] for count in counts),
+        "mates": {
+            f"R{mate}": count for mate, count in enumerate(counts, 1)
+        },
+    }
+
+
+def test_pair_manifest(tmp_path: Path) -> None:
+    """
+    This function tests record counts over block boundaries, gzip
+    members, and mismatching mates
+
+    Example:
+    pytest -v ./pair_manifest.py -k test_pair_manifest
+    """
+    import pytest  # Unit testing
+
+    records = [
+        b"@r%d\n%s\n+\n%s\n" % (i, b"ACGT" * (i + 1), b"IIII" * (i + 1))
+        for i in range(10)
+    ]
+    content = b"".join(records)
+    r1 = tmp_path / "S1_R1.fastq.gz"
+    r1.write_bytes(
+        gzip.compress(b"".join(records[:4]))
+        + gzip.compress(b"".join(records[4:]))
+    )
+    # The final new line is missing
+    r2 = tmp_path / "S1_R2.fastq"
+    r2.write_bytes(content[:-1])
+
+    manifest = pair_manifest("S1", [r1, r2], block_size=7)
+    assert manifest["records"] == 10
+    assert manifest["bases"] == 2 * 4 * sum(range(1, 11))
+    mates = manifest["mates"]
+    assert mates["R1"]["crc32"] == f"{zlib.crc32(content):08x}"
+    assert mates["R2"]["crc32"] == f"{zlib.crc32(content[:-1]):08x}"
+
+    r2.write_bytes(b"".join(records[:9]))
+    with pytest.raises(ValueError, match="differ in records"):
+        pair_manifest("S1", [r1, r2])
+
+    r1.write_bytes(gzip.compress(content)[:-12])
+    with pytest.raises(EOFError):
+        count_mate(r1)
+
+    r2.write_bytes(content[:-10])
+    with pytest.raises(ValueError, match="incomplete record"):
+        count_mate(r2)
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "mates",
+        help="One or two fastq files (gzipped or not) of a sample",
+        type=Path,
+        nargs="+",
+    )
+
+    main_parser.add_argument(
+        "--sample",
+        help="Sample identifier",
+        type=str,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the JSON manifest",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function checks the mates of a sample and writes its manifest
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    if len(args.mates) > 2:
+        raise ValueError("A sample has one or two fastq files")
+    manifest = pair_manifest(args.sample, args.mates)
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(json.dumps(manifest, indent=2) + "\n")
+    logging.info(
+        f"{args.sample}: {manifest['records']} records, "
+        f"{manifest['bases']} bases"
+    )
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
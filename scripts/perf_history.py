@@ -0,0 +1,452 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script appends the benchmarks of the rules of the pipeline to a
+performance history, kept across runs, and flags throughput regressions.
+
+Each benchmark file (benchmarks/{rule}/{key}.tsv) is joined with the
+sample it belongs to, the size of the raw fastq files of that sample (or
+read stream, or raw file) and its number of raw reads (from fastp JSON
+reports). Throughputs are computed from wall times: MB/s of raw input,
+and reads/s. Benchmarks already in the history (same rule, key and
+modification time) are not appended again: the history is append-only,
+and each job appears once, whatever the number of runs collecting it.
+
+A new benchmark is flagged as a regression when its throughput is below
+the median throughput of the same rule in past runs, minus a tolerance.
+Rules with less than MIN_POINTS past benchmarks are never flagged.
+
+The history is a SQLite database, unless its name ends with .parquet
+(this requires pyarrow).
+
+You can test this script with:
+pytest -v ./perf_history.py
+
+Usage example:
+python3.8 ./perf_history.py --design design.tsv --benchmarks benchmarks \
+    --fastp-json fastp/json --history /path/to/perf_history.sqlite \
+    --output qc/perf_history.tsv
+"""
+
+import argparse  # Parse command line
+import csv  # Parse benchmark files
+import json  # Handle fastp reports
+import logging  # Traces and loggings
+import os  # OS related activities
+import pandas  # Handle history tables
+import re  # Match chunk keys
+import sqlite3  # SQLite history
+import sys  # System related methods
+import time  # Collection time
+
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List, Optional, Tuple  # Type hints
+
+from common_script_ngs_cleaning import (
+    CustomFormatter, design_fastq, read_design
+)
+from resource_model import MIN_POINTS, wildcard_sizes
+
+
+# Numeric columns of Snakemake benchmark files kept in the history
+BENCHMARK_COLUMNS = [
+    "s", "max_rss", "max_vms", "max_uss", "max_pss",
+    "io_in", "io_out", "mean_load", "cpu_time"
+]
+
+# Columns of the history, in order
+HISTORY_COLUMNS = [
+    "run", "rule", "key", "sample", "finished", "input_mb", "reads",
+    *BENCHMARK_COLUMNS, "cores_used", "mb_per_s", "reads_per_s",
+    "regression"
+]
+
+# Name of the SQLite table
+TABLE = "benchmarks"
+
+# Relative drop of throughput below the median of past runs flagged as a
+# regression
+TOLERANCE = 0.25
+
+
+def benchmark_keys(
+    samples: Dict[str, List[List[str]]], workdir: str = "."
+) -> Dict[str, Tuple[str, float, float]]:
+    """
+    Return the sample, the share of its reads and the input size in MB of
+    each benchmark key: sample identifiers, read streams (sample.R1) and
+    raw file names (sample_R1.fastq.gz)
+
+    Parameters:
+        samples     Dict[str, List[List[str]]]
+                            Fastq files of each stream of each sample,
+                            see common_script_ngs_cleaning.design_fastq
+        workdir     str     Directory against which relative paths are
+                            resolved
+    """
+    sizes = wildcard_sizes(samples, workdir)
+    keys = {}
+    for sample, streams in samples.items():
+        keys[sample] = (sample, 1.0, sizes[sample] * 1024)
+        keys[f"{sample}.fastq.gz"] = keys[sample]
+        if len(streams) == 2:
+            for stream in ["R1", "R2"]:
+                stream_key = (sample, 0.5, sizes[f"{sample}.{stream}"] * 1024)
+                keys[f"{sample}.{stream}"] = stream_key
+                keys[f"{sample}_{stream}.fastq.gz"] = stream_key
+    return keys
+
+
+def sample_reads(fastp_json: Path) -> Dict[str, int]:
+    """
+    Return the number of raw reads of each sample with a fastp JSON report
+    ({sample}.fastp.json) in the given directory
+    """
+    reads = {}
+    for report in fastp_json.glob("*.fastp.json"):
+        try:
+            with report.open() as report_json:
+                summary = json.load(report_json)["summary"]
+            reads[report.name[:-len(".fastp.json")]] = int(
+                summary["before_filtering"]["total_reads"]
+            )
+        except (KeyError, ValueError):
+            logging.warning(f"Could not parse {report}")
+    return reads
+
+
+def read_benchmark(path: Path) -> Optional[Dict[str, float]]:
+    """
+    Return the numeric columns of the first line of a Snakemake benchmark
+    file. Missing columns (older Snakemake versions) are None.
+    """
+    with path.open() as tsv:
+        for row in csv.DictReader(tsv, delimiter="\t"):
+            try:
+                return {
+                    column: (
+                        float(row[column])
+                        if row.get(column) not in [None, "", "NA", "-"]
+                        else None
+                    )
+                    for column in BENCHMARK_COLUMNS
+                }
+            except ValueError:
+                break
+    logging.warning(f"Could not parse {path}")
+    return None
+
+
+def collect(
+    benchmarks: Path,
+    keys: Dict[str, Tuple[str, float, float]],
+    reads: Dict[str, int],
+    run: str
+) -> pandas.DataFrame:
+    """
+    Return the benchmarks of the given directory, one row per benchmark
+    file, with their sample, input size, reads and throughputs
+    """
+    chunk_key = re.compile(r"^(.+)\.\d+$")
+    rows = []
+    for path in sorted(benchmarks.glob("*/*.tsv")):
+        bench = read_benchmark(path)
+        if bench is None:
+            continue
+        key = path.name[:-len(".tsv")]
+        sample, share, input_mb = keys.get(key, (None, None, None))
+        chunk = chunk_key.match(key)
+        if sample is None and chunk is not None and chunk[1] in keys:
+            # Chunks of a sample: their sizes are not known
+            sample = chunk[1]
+
+        row = {
+            "run": run,
+            "rule": path.parent.name,
+            "key": key,
+            "sample": sample,
+            "finished": path.stat().st_mtime_ns,
+            "input_mb": input_mb,
+            "reads": (
+                reads[sample] * share
+                if sample in reads and share is not None else None
+            ),
+            **bench,
+        }
+        seconds = bench["s"] or None
+        row["cores_used"] = (
+            bench["cpu_time"] / seconds
+            if seconds and bench["cpu_time"] is not None else None
+        )
+        row["mb_per_s"] = (
+            input_mb / seconds if seconds and input_mb else None
+        )
+        row["reads_per_s"] = (
+            row["reads"] / seconds if seconds and row["reads"] else None
+        )
+        rows.append(row)
+    return pandas.DataFrame(rows, columns=HISTORY_COLUMNS[:-1])
+
+
+def read_history(path: Path) -> pandas.DataFrame:
+    """
+    Load the performance history, be it in SQLite or Parquet. A missing
+    history is empty.
+    """
+    if not path.exists():
+        return pandas.DataFrame(columns=HISTORY_COLUMNS)
+    if path.suffix == ".parquet":
+        return pandas.read_parquet(path)
+    with sqlite3.connect(str(path)) as connection:
+        return pandas.read_sql(f"SELECT * FROM {TABLE}", connection)
+
+
+def append_history(path: Path, rows: pandas.DataFrame) -> None:
+    """
+    Append rows to the performance history, be it in SQLite or Parquet
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.suffix != ".parquet":
+        with sqlite3.connect(str(path)) as connection:
+            rows.to_sql(TABLE, connection, if_exists="append", index=False)
+        return
+
+    if path.exists():
+        rows = pandas.concat([pandas.read_parquet(path), rows])
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    rows.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def flag_regressions(
+    rows: pandas.DataFrame,
+    history: pandas.DataFrame,
+    tolerance: float = TOLERANCE,
+    min_points: int = MIN_POINTS
+) -> pandas.Series:
+    """
+    Return, for each row, whether its throughput (MB/s, or reads/s when
+    input sizes are unknown) is below the median throughput of past
+    benchmarks of the same rule, minus the tolerance
+    """
+    def below_median(column: str) -> pandas.Series:
+        past = history.dropna(subset=[column]).groupby("rule")[column]
+        medians = past.median()[past.size() >= min_points]
+        return rows[column] < rows["rule"].map(medians) * (1 - tolerance)
+
+    return below_median("mb_per_s") | (
+        rows["mb_per_s"].isna() & below_median("reads_per_s")
+    )
+
+
+def update_history(
+    history_path: Path,
+    rows: pandas.DataFrame,
+    tolerance: float = TOLERANCE
+) -> pandas.DataFrame:
+    """
+    Append benchmarks missing from the history, and return them, flagged
+    """
+    history = read_history(history_path)
+    known = set(zip(
+        history["rule"], history["key"], history["finished"].astype(int)
+    ))
+    new = rows[[
+        (rule, key, finished) not in known
+        for rule, key, finished in zip(
+            rows["rule"], rows["key"], rows["finished"]
+        )
+    ]].copy()
+    new["regression"] = flag_regressions(new, history, tolerance)
+    logging.info(
+        f"{len(new)} of {len(rows)} benchmarks appended to {history_path}"
+    )
+    if len(new) > 0:
+        append_history(history_path, new)
+    return new
+
+
+def test_perf_history(tmp_path: Path) -> None:
+    """
+    This function tests the collection of benchmarks, throughputs, the
+    append-only history and regression flags
+
+    Example:
+    pytest -v ./perf_history.py -k test_perf_history
+    """
+    samples = {}
+    for sample in ["S1", "S2", "S3", "S4"]:
+        for stream in ["R1", "R2"]:
+            (tmp_path / f"{sample}_{stream}.fq.gz").write_bytes(
+                b"\0" * 1024 ** 2
+            )
+        samples[sample] = [[f"{sample}_R1.fq.gz"], [f"{sample}_R2.fq.gz"]]
+    keys = benchmark_keys(samples, str(tmp_path))
+    assert keys["S1"] == ("S1", 1.0, 2.0)
+    assert keys["S1_R2.fastq.gz"] == ("S1", 0.5, 1.0)
+
+    fastp_json = tmp_path / "json"
+    fastp_json.mkdir()
+    (fastp_json / "S1.fastp.json").write_text(json.dumps(
+        {"summary": {"before_filtering": {"total_reads": 1000}}}
+    ))
+    assert sample_reads(fastp_json) == {"S1": 1000}
+
+    benchmarks = tmp_path / "benchmarks"
+    (benchmarks / "fastp_trimmer").mkdir(parents=True)
+    (benchmarks / "copy_fastq").mkdir()
+
+    def write_benchmark(path: Path, seconds: float) -> None:
+        path.write_text(
+            "s\th:m:s\tmax_rss\tmax_vms\tio_in\tio_out\tmean_load"
+            f"\tcpu_time\n{seconds}\t0:00:01\t100.5\t200\t1\t2\t150"
+            f"\t{seconds * 1.5}\n"
+        )
+
+    for sample in ["S1", "S2", "S3"]:
+        write_benchmark(benchmarks / "fastp_trimmer" / f"{sample}.tsv", 1)
+    write_benchmark(benchmarks / "copy_fastq" / "S1_R1.fastq.gz.tsv", 0.5)
+
+    history = tmp_path / "history.sqlite"
+    rows = collect(benchmarks, keys, sample_reads(fastp_json), "run1")
+    new = update_history(history, rows).set_index(["rule", "key"])
+    assert len(new) == 4
+    assert new.loc[("fastp_trimmer", "S1"), "mb_per_s"] == 2.0
+    assert new.loc[("fastp_trimmer", "S1"), "reads_per_s"] == 1000
+    assert new.loc[("fastp_trimmer", "S1"), "cores_used"] == 1.5
+    assert new.loc[("copy_fastq", "S1_R1.fastq.gz"), "reads"] == 500
+    assert not new["regression"].any()
+
+    # Benchmarks already collected are not appended again
+    rows = collect(benchmarks, keys, {}, "run2")
+    assert len(update_history(history, rows)) == 0
+
+    write_benchmark(benchmarks / "fastp_trimmer" / "S4.tsv", 4)
+    os.utime(benchmarks / "fastp_trimmer" / "S2.tsv", ns=(1, 1))
+    rows = collect(benchmarks, keys, {}, "run3")
+    new = update_history(history, rows).set_index("key")
+    assert sorted(new.index) == ["S2", "S4"]
+    assert new.loc["S4", "regression"]
+    assert not new.loc["S2", "regression"]
+    assert len(read_history(history)) == 6
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--design",
+        help="Path to the design file",
+        type=str,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--workdir",
+        help="Directory relative paths of the design are relative to "
+             "(default: %(default)s)",
+        type=str,
+        default=".",
+    )
+
+    main_parser.add_argument(
+        "--benchmarks",
+        help="Directory of benchmark files (default: %(default)s)",
+        type=Path,
+        default=Path("benchmarks"),
+    )
+
+    main_parser.add_argument(
+        "--fastp-json",
+        help="Directory of fastp JSON reports (default: %(default)s)",
+        type=Path,
+        default=Path("fastp/json"),
+    )
+
+    main_parser.add_argument(
+        "--history",
+        help="Path to the performance history (.sqlite or .parquet)",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--tolerance",
+        help="Relative drop of throughput flagged as a regression "
+             "(default: %(default)s)",
+        type=float,
+        default=TOLERANCE,
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the TSV table of appended benchmarks",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function appends new benchmarks to the history, and writes them
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    samples = design_fastq(read_design(args.design))
+    run = time.strftime("%Y-%m-%dT%H:%M:%S")
+    rows = collect(
+        args.benchmarks,
+        benchmark_keys(samples, args.workdir),
+        sample_reads(args.fastp_json),
+        run
+    )
+    new = update_history(args.history, rows, args.tolerance)
+
+    for row in new[new["regression"]].itertuples():
+        logging.warning(
+            f"Throughput regression: {row.rule} {row.key}, "
+            f"{row.mb_per_s or 0:.1f} MB/s, {row.reads_per_s or 0:.0f} "
+            "reads/s"
+        )
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    new.to_csv(args.output, sep="\t", index=False)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
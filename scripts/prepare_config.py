@@ -30,7 +30,9 @@ from pathlib import Path  # Paths related methods
 from snakemake.utils import makedirs  # Easily build directories
 from typing import Dict, Any  # Typing hints
 
-from common_script_ngs_cleaning import CustomFormatter, write_yaml
+from common_script_ngs_cleaning import (
+    CustomFormatter, FASTP_PRESETS, write_yaml
+)
 
 
 def parser() -> argparse.ArgumentParser:
@@ -92,6 +94,72 @@ def parser() -> argparse.ArgumentParser:
         default="--verbose"
     )
 
+    main_parser.add_argument(
+        "--copy-cache",
+        help="Path to a persistent local cache of the raw fastq files. "
+             "Cached files are not copied again from the cold storage "
+             "(default: no cache)",
+        type=str,
+        metavar="PATH",
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--copy-cache-quota",
+        help="Maximum size of the copy cache in GB, least recently used "
+             "files are evicted beyond (default: unlimited)",
+        type=float,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--copy-cache-hash",
+        help="Also identify cached files with a hash of their first and "
+             "last megabytes, on top of their path, size and mtime",
+        default=False,
+        action="store_true"
+    )
+
+    main_parser.add_argument(
+        "--staging",
+        help="Stage raw fastq files by batches, with concurrent copies of "
+             "the files located on cold storage, and symlinks to others",
+        default=False,
+        action="store_true"
+    )
+
+    main_parser.add_argument(
+        "--staging-threads",
+        help="Number of concurrent copies per staging batch "
+             "(default: %(default)s)",
+        type=int,
+        default=8
+    )
+
+    main_parser.add_argument(
+        "--staging-batch-size",
+        help="Number of fastq files per staging batch (default: %(default)s)",
+        type=int,
+        default=32
+    )
+
+    main_parser.add_argument(
+        "--staging-retries",
+        help="Number of copy retries per fastq file (default: %(default)s)",
+        type=int,
+        default=3
+    )
+
+    main_parser.add_argument(
+        "--resource-model",
+        help="Path to a yaml resource model fitted from past benchmarks "
+             "with scripts/resource_model.py (default: constant "
+             "reservations)",
+        type=str,
+        metavar="PATH",
+        default=None
+    )
+
     main_parser.add_argument(
         "--run-fqscreen",
         help="Whether to run fastq screen or not",
@@ -99,6 +167,52 @@ def parser() -> argparse.ArgumentParser:
         action="store_true"
     )
 
+    main_parser.add_argument(
+        "--fastq-stats",
+        help="Whether to compute native statistics of raw and trimmed "
+             "reads or not",
+        default=False,
+        action="store_true"
+    )
+
+    main_parser.add_argument(
+        "--fused-subsample",
+        help="Subsample trimmed reads for fastq_screen while fastp writes "
+             "them, instead of reading trimmed files again",
+        default=False,
+        action="store_true"
+    )
+
+    main_parser.add_argument(
+        "--streaming",
+        help="Stream raw reads from their storage into fastp, instead of "
+             "staging them in the working directory first",
+        default=False,
+        action="store_true"
+    )
+
+    main_parser.add_argument(
+        "--remove-fastp-json",
+        help="Remove fastp JSON reports once they are summarized",
+        default=False,
+        action="store_true"
+    )
+
+    main_parser.add_argument(
+        "--pair-check",
+        help="Check that mates hold the same number of records before "
+             "trimming, and keep a manifest of each sample",
+        default=False,
+        action="store_true"
+    )
+
+    main_parser.add_argument(
+        "--no-preflight",
+        help="Do not check input fastq files before running the pipeline",
+        default=False,
+        action="store_true"
+    )
+
     main_parser.add_argument(
         "--fastq-screen-subset",
         help="Number of reads that FastQ Screen will use while looking for "
@@ -123,6 +237,136 @@ def parser() -> argparse.ArgumentParser:
         default="fastq_screen_config.tsv"
     )
 
+    main_parser.add_argument(
+        "--fastq-screen-batch",
+        help="Screen read files by batches of this size, in a single "
+             "fastq_screen job per batch (default: one job per file)",
+        type=int,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--screen-index-staging",
+        help="Copy fastq_screen indexes once per node in this node-local "
+             "directory, e.g. /dev/shm/ngs-cleaning (default: read them "
+             "from their original location)",
+        type=str,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--screen-index-max-idle",
+        help="Node-local copies of fastq_screen indexes are kept for the "
+             "next jobs of the node, and removed once no job used them for "
+             "this number of hours. In /dev/shm, they use RAM no job "
+             "reserves (default: %(default)s)",
+        type=float,
+        default=1
+    )
+
+    main_parser.add_argument(
+        "--screen-index-max-gb",
+        help="Remove unused node-local copies of fastq_screen indexes, "
+             "least recently used first, so that all copies fit in this "
+             "number of GB (default: no limit)",
+        type=float,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--metrics-store",
+        help="Gather quality metrics in a cohort table of this format, "
+             "updated incrementally (default: no cohort table)",
+        type=str,
+        choices=["tsv", "parquet"],
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--perf-history",
+        help="Path to a performance history (.sqlite or .parquet), kept "
+             "across runs, to which benchmarks of all rules are appended "
+             "(default: no history)",
+        type=str,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--perf-tolerance",
+        help="Relative drop of throughput, below past runs, flagged as a "
+             "regression in the performance history (default: %(default)s)",
+        type=float,
+        default=0.25
+    )
+
+    main_parser.add_argument(
+        "--tune-threads",
+        help="Tune the threads of fastp and fastq_screen jobs, to process "
+             "the most samples per core-hour, from the performance history "
+             "(see --perf-history) or from calibration runs on the first "
+             "sample of the design (default: configured threads)",
+        type=str,
+        choices=["history", "calibration"],
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--calibration-reads",
+        help="Reads per mate of thread calibration runs "
+             "(default: %(default)s)",
+        type=int,
+        default=200000
+    )
+
+    main_parser.add_argument(
+        "--trimmed-codec",
+        help="Codec of trimmed reads: gzip, multi-threaded BGZF, or zstd "
+             "for intermediate outputs only (default: gzip)",
+        type=str,
+        choices=["gzip", "bgzf", "zstd"],
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--trimmed-level",
+        help="Compression level of trimmed reads (default: 4 with gzip, "
+             "6 with bgzf, 3 with zstd)",
+        type=int,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--fastp-chunks",
+        help="Trim each sample by this number of chunks, in separate jobs "
+             "(default: one job per sample)",
+        type=int,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--fastp-chunk-size",
+        help="Trim samples larger than this size, in GB, by chunks of this "
+             "size, in separate jobs (default: one job per sample)",
+        type=float,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--fastp-batch-size",
+        help="Trim samples smaller than this size, in MB, by batches, in a "
+             "single job per batch (default: one job per sample)",
+        type=float,
+        default=None
+    )
+
+    main_parser.add_argument(
+        "--fastp-batch-minutes",
+        help="Maximum estimated runtime of a batch of small samples, in "
+             "minutes (default: %(default)s)",
+        type=float,
+        default=60
+    )
+
     # Fastp options
     fastp = main_parser.add_mutually_exclusive_group()
     fastp.add_argument(
@@ -219,21 +463,50 @@ def test_parse_args() -> None:
     """
     options = parse_args(shlex.split(""))
     expected = argparse.Namespace(
+        calibration_reads=200000,
         cold_storage=[' '],
+        copy_cache=None,
+        copy_cache_hash=False,
+        copy_cache_quota=None,
         copy_extra="--verbose",
         debug=False,
         design='design.tsv',
+        fastp_batch_minutes=60,
+        fastp_batch_size=None,
+        fastp_chunk_size=None,
+        fastp_chunks=None,
         fastp_extra='--overrepresentation_analysis',
         fastq_screen_aligner='bowtie2',
+        fastq_screen_batch=None,
+        fastq_stats=False,
         fastq_screen_config='fastq_screen_config.tsv',
         fastq_screen_subset=100000,
+        fused_subsample=False,
         hard_trimmer=False,
         medium_trimmer=False,
+        metrics_store=None,
+        no_preflight=False,
+        pair_check=False,
+        perf_history=None,
+        perf_tolerance=0.25,
         quiet=False,
+        remove_fastp_json=False,
+        resource_model=None,
         run_fqscreen=False,
+        screen_index_max_gb=None,
+        screen_index_max_idle=1,
+        screen_index_staging=None,
         singularity='docker://continuumio/miniconda3:4.4.10',
         soft_trimmer=False,
+        staging=False,
+        staging_batch_size=32,
+        staging_retries=3,
+        staging_threads=8,
+        streaming=False,
         threads=1,
+        trimmed_codec=None,
+        trimmed_level=None,
+        tune_threads=None,
         workdir='.'
     )
     assert options == expected
@@ -254,46 +527,11 @@ def args_to_dict(args: argparse.ArgumentParser) -> Dict[str, Any]:
     """
     fastp_extra = args.fastp_extra
     if args.soft_trimmer is True:
-        fastp_extra = (
-            "--cut_front "
-            "--cut_tail "
-            "--cut_window_size 6 "
-            "--cut_mean_quality 10 "
-            "--unqualified_percent_limit 50 "
-            "--n_base_limit 7 "
-            "--average_qual 0 "
-            "--length_required 15 "
-            "--overrepresentation_analysis"
-        )
+        fastp_extra = FASTP_PRESETS["soft"]
     elif args.medium_trimmer is True:
-        fastp_extra = (
-            "--cut_front "
-            "--cut_tail "
-            "--cut_window_size 5 "
-            "--cut_mean_quality 15 "
-            "--unqualified_percent_limit 40 "
-            "--n_base_limit 7 "
-            "--average_qual 10 "
-            "--length_required 30 "
-            "--low_complexity_filter "
-            "--complexity_threshold 10 "
-            "--overrepresentation_analysis"
-        )
+        fastp_extra = FASTP_PRESETS["medium"]
     elif args.hard_trimmer is True:
-        fastp_extra = (
-            "--trim_poly_g "
-            "--cut_front "
-            "--cut_tail "
-            "--cut_window_size 5 "
-            "--cut_mean_quality 20 "
-            "--unqualified_percent_limit 30 "
-            "--n_base_limit 5 "
-            "--average_qual 15 "
-            "--length_required 30 "
-            "--low_complexity_filter "
-            "--complexity_threshold 30 "
-            "--overrepresentation_analysis"
-        )
+        fastp_extra = FASTP_PRESETS["hard"]
 
     result_dict = {
         "design": os.path.abspath(args.design),
@@ -303,6 +541,12 @@ def args_to_dict(args: argparse.ArgumentParser) -> Dict[str, Any]:
         "singularity_docker_image": args.singularity,
         "cold_storage": args.cold_storage,
         "run_fqscreen": args.run_fqscreen,
+        "fastq_stats": args.fastq_stats,
+        "fused_subsample": args.fused_subsample,
+        "streaming": args.streaming,
+        "keep_fastp_json": not args.remove_fastp_json,
+        "preflight": not args.no_preflight,
+        "pair_check": args.pair_check,
         "params": {
             "copy_extra": args.copy_extra,
             "fastp_extra": fastp_extra,
@@ -311,6 +555,69 @@ def args_to_dict(args: argparse.ArgumentParser) -> Dict[str, Any]:
             "fastq_screen_config": args.fastq_screen_config
         },
     }
+
+    if args.copy_cache is not None:
+        result_dict["copy_cache"] = {
+            "path": os.path.abspath(args.copy_cache),
+            "quota_gb": args.copy_cache_quota,
+            "hash_edges": args.copy_cache_hash,
+            "link": "hardlink"
+        }
+
+    if args.staging is True:
+        result_dict["staging"] = {
+            "threads": args.staging_threads,
+            "batch_size": args.staging_batch_size,
+            "retries": args.staging_retries
+        }
+
+    if args.fastp_chunks is not None or args.fastp_chunk_size is not None:
+        result_dict["fastp_chunks"] = {
+            "chunks": args.fastp_chunks,
+            "chunk_size_gb": args.fastp_chunk_size,
+            "max_chunks": 64
+        }
+
+    if args.fastp_batch_size is not None:
+        result_dict["fastp_batch"] = {
+            "max_size_mb": args.fastp_batch_size,
+            "target_minutes": args.fastp_batch_minutes
+        }
+
+    if args.fastq_screen_batch is not None:
+        result_dict["fastq_screen_batch"] = {
+            "batch_size": args.fastq_screen_batch
+        }
+
+    if args.screen_index_staging is not None:
+        result_dict["screen_index_staging"] = {
+            "path": args.screen_index_staging,
+            "max_idle_hours": args.screen_index_max_idle
+        }
+        if args.screen_index_max_gb is not None:
+            result_dict["screen_index_staging"]["max_gb"] = (
+                args.screen_index_max_gb
+            )
+
+    if args.metrics_store is not None:
+        result_dict["metrics_store"] = {"format": args.metrics_store}
+
+    if args.perf_history is not None:
+        result_dict["perf_history"] = {
+            "path": os.path.abspath(args.perf_history),
+            "tolerance": args.perf_tolerance
+        }
+
+    if args.trimmed_codec is not None or args.trimmed_level is not None:
+        result_dict["trimmed_codec"] = {
+            "codec": args.trimmed_codec or "gzip"
+        }
+        if args.trimmed_level is not None:
+            result_dict["trimmed_codec"]["level"] = args.trimmed_level
+
+    if args.resource_model is not None:
+        result_dict["resource_model"] = os.path.abspath(args.resource_model)
+
     logging.debug(result_dict)
     return result_dict
 
@@ -319,21 +626,50 @@ def args_to_dict(args: argparse.ArgumentParser) -> Dict[str, Any]:
     "options, expected", [
         (
             argparse.Namespace(
+                calibration_reads=200000,
                 cold_storage=[' '],
+                copy_cache=None,
+                copy_cache_hash=False,
+                copy_cache_quota=None,
                 copy_extra="--verbose",
                 debug=False,
                 design='design.tsv',
+                fastp_batch_minutes=60,
+                fastp_batch_size=None,
+                fastp_chunk_size=None,
+                fastp_chunks=None,
                 fastp_extra='--overrepresentation_analysis',
                 fastq_screen_aligner='bowtie2',
+                fastq_screen_batch=None,
+                fastq_stats=False,
                 fastq_screen_config='fastq_screen_config.tsv',
                 fastq_screen_subset=100000,
+                fused_subsample=False,
                 hard_trimmer=False,
                 medium_trimmer=False,
+                metrics_store=None,
+                no_preflight=False,
+                pair_check=False,
+                perf_history=None,
+                perf_tolerance=0.25,
                 quiet=False,
+                remove_fastp_json=False,
+                resource_model=None,
                 singularity='docker://continuumio/miniconda3:4.4.10',
                 soft_trimmer=False,
+                staging=False,
+                staging_batch_size=32,
+                staging_retries=3,
+                staging_threads=8,
+                streaming=False,
                 run_fqscreen=True,
+                screen_index_max_gb=None,
+                screen_index_max_idle=1,
+                screen_index_staging=None,
                 threads=1,
+                trimmed_codec=None,
+                trimmed_level=None,
+                tune_threads=None,
                 workdir='.'
             ),
             {
@@ -344,6 +680,12 @@ def args_to_dict(args: argparse.ArgumentParser) -> Dict[str, Any]:
                 "singularity_docker_image": 'docker://continuumio/miniconda3:4.4.10',
                 "cold_storage": [' '],
                 "run_fqscreen": True,
+                "fastq_stats": False,
+                "fused_subsample": False,
+                "streaming": False,
+                "keep_fastp_json": True,
+                "preflight": True,
+                "pair_check": False,
                 "params": {
                     "copy_extra": "--verbose",
                     "fastp_extra": '--overrepresentation_analysis',
@@ -356,21 +698,50 @@ def args_to_dict(args: argparse.ArgumentParser) -> Dict[str, Any]:
 
         (
             argparse.Namespace(
+                calibration_reads=200000,
                 cold_storage=[' '],
+                copy_cache=None,
+                copy_cache_hash=False,
+                copy_cache_quota=None,
                 copy_extra="--verbose",
                 debug=False,
                 design='design.tsv',
+                fastp_batch_minutes=60,
+                fastp_batch_size=None,
+                fastp_chunk_size=None,
+                fastp_chunks=None,
                 fastp_extra='--overrepresentation_analysis',
                 fastq_screen_aligner='bowtie2',
+                fastq_screen_batch=None,
+                fastq_stats=False,
                 fastq_screen_config='fastq_screen_config.tsv',
                 fastq_screen_subset=100000,
+                fused_subsample=False,
                 hard_trimmer=False,
                 medium_trimmer=True,
+                metrics_store=None,
+                no_preflight=False,
+                pair_check=False,
+                perf_history=None,
+                perf_tolerance=0.25,
                 run_fqscreen=True,
+                screen_index_max_gb=None,
+                screen_index_max_idle=1,
+                screen_index_staging=None,
                 quiet=False,
+                remove_fastp_json=False,
+                resource_model=None,
                 singularity='docker://continuumio/miniconda3:4.4.10',
                 soft_trimmer=False,
+                staging=False,
+                staging_batch_size=32,
+                staging_retries=3,
+                staging_threads=8,
+                streaming=False,
                 threads=1,
+                trimmed_codec=None,
+                trimmed_level=None,
+                tune_threads=None,
                 workdir='.'
             ),
             {
@@ -381,6 +752,12 @@ def args_to_dict(args: argparse.ArgumentParser) -> Dict[str, Any]:
                 "singularity_docker_image": 'docker://continuumio/miniconda3:4.4.10',
                 "cold_storage": [' '],
                 "run_fqscreen": True,
+                "fastq_stats": False,
+                "fused_subsample": False,
+                "streaming": False,
+                "keep_fastp_json": True,
+                "preflight": True,
+                "pair_check": False,
                 "params": {
                     "copy_extra": "--verbose",
                     "fastp_extra": (
@@ -414,6 +791,183 @@ def test_args_to_dict(options: argparse.Namespace, expected: Dict[str, Any]) ->
     assert args_to_dict(options) == expected
 
 
+def test_args_to_dict_copy_cache() -> None:
+    """
+    This function tests the copy cache section of the configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_copy_cache
+    """
+    options = parse_args(shlex.split("--copy-cache cache --copy-cache-quota 5"))
+    assert args_to_dict(options)["copy_cache"] == {
+        "path": os.path.abspath("cache"),
+        "quota_gb": 5,
+        "hash_edges": False,
+        "link": "hardlink"
+    }
+    assert "copy_cache" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_staging() -> None:
+    """
+    This function tests the staging section of the configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_staging
+    """
+    options = parse_args(shlex.split("--staging --staging-threads 16"))
+    assert args_to_dict(options)["staging"] == {
+        "threads": 16,
+        "batch_size": 32,
+        "retries": 3
+    }
+    assert "staging" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_fastp_chunks() -> None:
+    """
+    This function tests the chunked trimming section of the configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_fastp_chunks
+    """
+    options = parse_args(shlex.split("--fastp-chunk-size 20"))
+    assert args_to_dict(options)["fastp_chunks"] == {
+        "chunks": None,
+        "chunk_size_gb": 20,
+        "max_chunks": 64
+    }
+    assert "fastp_chunks" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_fastp_batch() -> None:
+    """
+    This function tests the small samples batches section of the
+    configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_fastp_batch
+    """
+    options = parse_args(shlex.split("--fastp-batch-size 100"))
+    assert args_to_dict(options)["fastp_batch"] == {
+        "max_size_mb": 100,
+        "target_minutes": 60
+    }
+    assert "fastp_batch" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_fastq_screen_batch() -> None:
+    """
+    This function tests the batched screening section of the configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_fastq_screen_batch
+    """
+    options = parse_args(shlex.split("--fastq-screen-batch 40"))
+    assert args_to_dict(options)["fastq_screen_batch"] == {"batch_size": 40}
+    assert "fastq_screen_batch" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_screen_index_staging() -> None:
+    """
+    This function tests the node-local index section of the configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_screen_index_staging
+    """
+    options = parse_args(shlex.split("--screen-index-staging /dev/shm/ngs"))
+    assert args_to_dict(options)["screen_index_staging"] == {
+        "path": "/dev/shm/ngs",
+        "max_idle_hours": 1
+    }
+    options = parse_args(shlex.split(
+        "--screen-index-staging /dev/shm/ngs --screen-index-max-gb 40"
+    ))
+    assert args_to_dict(options)["screen_index_staging"]["max_gb"] == 40
+    assert "screen_index_staging" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_metrics_store() -> None:
+    """
+    This function tests the metrics store section of the configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_metrics_store
+    """
+    options = parse_args(shlex.split("--metrics-store parquet"))
+    assert args_to_dict(options)["metrics_store"] == {"format": "parquet"}
+    assert "metrics_store" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_trimmed_codec() -> None:
+    """
+    This function tests the trimmed reads codec section of the
+    configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_trimmed_codec
+    """
+    options = parse_args(shlex.split("--trimmed-codec bgzf"))
+    assert args_to_dict(options)["trimmed_codec"] == {"codec": "bgzf"}
+    options = parse_args(shlex.split("--trimmed-level 1"))
+    assert args_to_dict(options)["trimmed_codec"] == {
+        "codec": "gzip",
+        "level": 1
+    }
+    assert "trimmed_codec" not in args_to_dict(parse_args([]))
+
+
+def test_args_to_dict_resource_model() -> None:
+    """
+    This function tests the resource model path of the configuration
+
+    Example:
+    >>> pytest -v prepare_config.py -k test_args_to_dict_resource_model
+    """
+    options = parse_args(shlex.split("--resource-model model.yaml"))
+    assert args_to_dict(options)["resource_model"] == (
+        os.path.abspath("model.yaml")
+    )
+    assert "resource_model" not in args_to_dict(parse_args([]))
+
+
+def tuned_threads(args: argparse.ArgumentParser) -> Dict[str, int]:
+    """
+    Return the threads of fastp and fastq_screen jobs, tuned from the
+    performance history or from calibration runs (see autotune_threads.py)
+
+    Parameters:
+        args    ArgumentParser      The parsed command line
+
+    Return:
+                Dict[str, int]      Threads of each tuned rule
+    """
+    from autotune_threads import tune_threads
+
+    if args.tune_threads == "history" and args.perf_history is None:
+        raise ValueError("Tuning threads from history requires --perf-history")
+    if args.tune_threads == "history" and not Path(args.perf_history).exists():
+        logging.warning(
+            f"No history at {args.perf_history}, threads are not tuned"
+        )
+        return {}
+
+    rule_threads = tune_threads(
+        args.design,
+        args.workdir,
+        history=(
+            Path(args.perf_history) if args.tune_threads == "history" else None
+        ),
+        calibration=args.tune_threads == "calibration",
+        reads=args.calibration_reads,
+        fastq_screen_config=(
+            args.fastq_screen_config if args.run_fqscreen else None
+        )
+    )
+    logging.debug(f"Tuned threads: {rule_threads}")
+    return rule_threads
+
+
 # Yaml formatting
 def dict_to_yaml(indict: Dict[str, Any]) -> str:
     """
@@ -470,6 +1024,8 @@ def main(args: argparse.ArgumentParser) -> None:
     # Building pipeline arguments
     logging.debug("Building configuration file:")
     config_params = args_to_dict(args)
+    if args.tune_threads is not None:
+        config_params["rule_threads"] = tuned_threads(args)
     output_path = Path(args.workdir) / "config.yaml"
 
     # Saving as yaml
@@ -5,12 +5,13 @@
 This script aims to prepare the list of files to be processed
 by the ngs-cleaning pipeline
 
-It iterates over a given directory, lists all fastq files. As a pair of
-fastq files usually have names that follows each other in the alphabetical
-order, this script sorts the fastq files names and, by default, creates
-pairs of fastq files that way.
+It iterates over a given directory, lists all fastq files. File names are
+parsed with regular expressions (Illumina, _R1/_R2 and .1/.2 naming schemes
+by default, see --pattern) in order to identify the sample and the mate of
+each file. Files without mate, or matching no pattern, are reported as
+orphans instead of being silently mispaired.
 
-Finally, it writes these pairs, using the longest common substring as
+Finally, it writes these pairs, using the named groups of the patterns as
 identifier. The written file is a TSV file.
 
 You can test this script with:
@@ -22,6 +23,9 @@ python3.8 ./prepare_design.py tests/salmon --single
 
 # Paired-end libary example:
 python3.8 ./prepare_design.py tests/salmon
+
+# Paired-end library sequenced over multiple lanes:
+python3.8 ./prepare_design.py /path/to/bcl2fastq/output --merge-lanes
 """
 
 import argparse  # Parse command line
@@ -29,16 +33,47 @@ import logging  # Traces and loggings
 import os  # OS related activities
 import pandas as pd  # Parse TSV files
 import pytest  # Unit testing
+import re  # Regular expressions
 import shlex  # Lexical analysis
 import sys  # System related methods
 
+from collections import defaultdict  # Dictionnaries with default values
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fnmatch import translate  # Unix shell-style wildcards
 from pathlib import Path  # Paths related methods
 from snakemake.utils import makedirs  # Easily build directories
-from typing import Dict, Generator, List, Any  # Type hints
+from typing import (  # Type hints
+    Any,
+    Callable,
+    Collection,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Match,
+    Optional,
+    Tuple,
+)
 
 from common_script_ngs_cleaning import CustomFormatter
 
 
+# Default glob patterns used to recognize fastq files
+FQ_PATTERNS = ["*.fq", "*.fq.gz", "*.fastq", "*.fastq.gz"]
+
+# Default regular expressions used to identify samples and mates, from the
+# most to the least specific: Illumina (bcl2fastq), _R1/_R2, then .1/.2
+FQ_NAME_PATTERNS = [
+    r"^(?P<sample>.+?)_S\d+_(?P<lane>L\d{3})_R(?P<stream>[12])_\d{3}"
+    r"\.f(?:ast)?q(?:\.gz)?$",
+    r"^(?P<sample>.+?)[._]R(?P<stream>[12])\.f(?:ast)?q(?:\.gz)?$",
+    r"^(?P<sample>.+?)\.(?P<stream>[12])\.f(?:ast)?q(?:\.gz)?$",
+]
+
+# Suffix stripped from the names of single-end files matching no pattern
+FQ_SUFFIX = re.compile(r"\.f(?:ast)?q(?:\.gz)?$")
+
+
 # Processing functions
 # Looking for fastq files
 def search_fq(
@@ -95,56 +130,422 @@ def test_search_fq():
     assert sorted(list(search_fq(path))) == sorted(expected)
 
 
+# Looking for fastq files on large (network) file systems
+def compile_globs(patterns: List[str]) -> Callable[[str], Any]:
+    """
+    Turn a list of glob patterns into a single compiled matcher. An empty
+    list of patterns matches nothing.
+
+    Example:
+    >>> compile_globs(["*.fq", "*.fq.gz"])("A_R1.fq.gz")
+    <re.Match object; span=(0, 10), match='A_R1.fq.gz'>
+    """
+    if not patterns:
+        return lambda name: None
+    regex = "|".join(translate(pattern) for pattern in patterns)
+    return re.compile(regex).match
+
+
+def scan_fq_dir(
+    fq_dir: str,
+    depth: int,
+    include: Callable[[str], Any],
+    exclude: Callable[[str], Any],
+    max_depth: Optional[int] = None,
+) -> Tuple[List[Path], List[Tuple[str, int]]]:
+    """
+    List a single directory with os.scandir, and split its content between
+    fastq files and sub-directories to be crawled
+
+    Parameters:
+        fq_dir      str             Path to the directory to list
+        depth       int             Depth of this directory from crawl root
+        include     Callable        Matcher a file name must satisfy
+        exclude     Callable        Matcher excluding files and directories
+        max_depth   Optional[int]   Maximum depth of crawled directories,
+                                    None means unlimited
+
+    Return:
+                    Tuple[List[Path], List[Tuple[str, int]]]
+                                    Fastq files and (sub-directory, depth)
+
+    Example:
+    >>> scan_fq_dir("tests/reads", 0, compile_globs(FQ_PATTERNS),
+    ...             compile_globs([]))
+    ([PosixPath('tests/reads/A_R1.fq.gz'), ...], [])
+    """
+    fq_files, sub_dirs = [], []
+    with os.scandir(fq_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if exclude(name):
+                continue
+
+            # DirEntry caches d_type: no stat() call on most file systems
+            if entry.is_dir():
+                if max_depth is None or depth < max_depth:
+                    sub_dirs.append((entry.path, depth + 1))
+            elif include(name):
+                fq_files.append(Path(entry.path))
+
+    return fq_files, sub_dirs
+
+
+def crawl_fq(
+    fq_dir: Path,
+    include: List[str] = FQ_PATTERNS,
+    exclude: Optional[List[str]] = None,
+    max_depth: Optional[int] = 0,
+    threads: int = 1,
+) -> Generator[Path, None, None]:
+    """
+    Crawl a directory tree and stream the fastq files as they are found.
+    Sub-directories are listed concurrently on a bounded pool of threads,
+    which hides the latency of network file systems.
+
+    Parameters:
+        fq_dir      Path            Path to the fastq directory to crawl
+        include     List[str]       Glob patterns a file name must match
+        exclude     List[str]       Glob patterns excluding files and
+                                    directories
+        max_depth   Optional[int]   Maximum depth of crawled directories, 0
+                                    means no recursion, None means unlimited
+        threads     int             Maximum number of directories listed
+                                    at the same time
+
+    Return:
+                    Generator[Path, None, None]     A Generator of paths
+
+    Example:
+    >>> list(crawl_fq(Path("tests"), max_depth=None, threads=4))
+    [PosixPath('tests/reads/A_R2.fq.gz'),
+     PosixPath('tests/reads/B_R2.fq.gz'),
+     PosixPath('tests/reads/A_R1.fq.gz'),
+     PosixPath('tests/reads/B_R1.fq.gz')]
+    """
+    include = compile_globs(include)
+    exclude = compile_globs(exclude or [])
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        pending = {
+            pool.submit(
+                scan_fq_dir, str(fq_dir), 0, include, exclude, max_depth
+            )
+        }
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                fq_files, sub_dirs = future.result()
+                pending.update(
+                    pool.submit(
+                        scan_fq_dir,
+                        sub_dir,
+                        depth,
+                        include,
+                        exclude,
+                        max_depth
+                    )
+                    for sub_dir, depth in sub_dirs
+                )
+                yield from fq_files
+
+
+def test_crawl_fq(tmp_path: Path) -> None:
+    """
+    This function tests the ability of the function "crawl_fq" to find the
+    fastq files in the given directory, with depth and pattern filters
+
+    Example:
+    pytest -v prepare_design.py -k test_crawl_fq
+    """
+    path = Path("tests/reads/")
+    assert sorted(crawl_fq(path, threads=2)) == sorted(search_fq(path))
+
+    for sub_dir in ["lane1/run", "lane2", "Undetermined"]:
+        (tmp_path / sub_dir).mkdir(parents=True)
+        (tmp_path / sub_dir / "S_R1.fastq.gz").touch()
+    (tmp_path / "S_R1.fq").touch()
+    (tmp_path / "S_R1.txt").touch()
+
+    assert list(crawl_fq(tmp_path)) == [tmp_path / "S_R1.fq"]
+    assert len(list(crawl_fq(tmp_path, max_depth=1, threads=3))) == 3
+    assert len(list(crawl_fq(tmp_path, max_depth=None, threads=3))) == 4
+    assert sorted(
+        crawl_fq(
+            tmp_path,
+            include=["*.fastq.gz"],
+            exclude=["Undetermined"],
+            max_depth=None,
+            threads=3
+        )
+    ) == [
+        tmp_path / "lane1" / "run" / "S_R1.fastq.gz",
+        tmp_path / "lane2" / "S_R1.fastq.gz"
+    ]
+
+
+# Identifying samples and mates from fastq file names
+def fq_sample_id(match: Match, ignore: Collection[str] = ()) -> str:
+    """
+    Build a sample identifier from the named groups of a matched file name.
+    All groups but "stream" (and ignored ones) are joined with underscores,
+    in the order they appear in the regular expression.
+
+    Example:
+    >>> fq_sample_id(re.match(FQ_NAME_PATTERNS[0], "A_S1_L001_R1_001.fq"))
+    'A_L001'
+    >>> fq_sample_id(
+    ...     re.match(FQ_NAME_PATTERNS[0], "A_S1_L001_R1_001.fq"), ["lane"]
+    ... )
+    'A'
+    """
+    return "_".join(
+        value
+        for group, value in match.groupdict().items()
+        if group != "stream" and group not in ignore and value is not None
+    )
+
+
+def pair_fq(
+    fq_files: Iterable[Path],
+    patterns: List[str] = FQ_NAME_PATTERNS,
+    merge: Collection[str] = (),
+) -> Tuple[Dict[str, Dict[str, List[Path]]], List[Path]]:
+    """
+    Group fastq files by sample and mate, in a single pass over the files
+
+    Parameters:
+        fq_files    Iterable[Path]  Fastq files to pair
+        patterns    List[str]       Regular expressions matching file names.
+                                    They must define a "stream" group, whose
+                                    lowest value is the upstream mate. Other
+                                    named groups build the sample identifier.
+                                    First matching pattern wins.
+        merge       Collection[str] Named groups left out of the sample
+                                    identifier (e.g. "lane"): pairs differing
+                                    only by these groups belong to the same
+                                    sample.
+
+    Return:
+                    Tuple[Dict[str, Dict[str, List[Path]]], List[Path]]
+                                    For each sample, its mates by stream, and
+                                    the list of orphan files: unmatched
+                                    names, missing or duplicated mates.
+
+    Example:
+    >>> pair_fq([Path("A_R1.fq"), Path("A_R2.fq"), Path("B_R1.fq")])
+    ({'A': {'1': [PosixPath('A_R1.fq')], '2': [PosixPath('A_R2.fq')]}},
+     [PosixPath('B_R1.fq')])
+    """
+    regexes = [re.compile(pattern) for pattern in patterns]
+    samples = defaultdict(dict)
+    orphans = []
+    for fq in fq_files:
+        match = next(
+            (m for m in (regex.match(fq.name) for regex in regexes) if m),
+            None
+        )
+        if match is None:
+            logging.warning(f"{fq} does not match any pairing pattern")
+            orphans.append(fq)
+            continue
+
+        merged_values = tuple(match.groupdict().get(g) or "" for g in merge)
+        mates = samples[(fq_sample_id(match, merge), merged_values)]
+        stream = match.group("stream")
+        if stream in mates:
+            logging.warning(f"{fq} and {mates[stream]} share the same mate")
+            orphans.append(fq)
+            continue
+        mates[stream] = fq
+
+    pairs = defaultdict(lambda: defaultdict(list))
+    # Sorting keeps lanes in the same order for both mates of a sample
+    for (sample, merged_values), mates in sorted(samples.items()):
+        if len(mates) == 2:
+            for stream, fq in mates.items():
+                pairs[sample][stream].append(fq)
+        else:
+            logging.warning(f"{sample} has no mate for {list(mates.values())}")
+            orphans.extend(mates.values())
+
+    return {sample: dict(mates) for sample, mates in pairs.items()}, orphans
+
+
+@pytest.mark.parametrize(
+    "fq_names, patterns, expected_pairs, expected_orphans", [
+        (
+            ["A_R1.fq.gz", "A_R2.fq.gz", "B_R1.fastq", "B_R2.fastq"],
+            FQ_NAME_PATTERNS,
+            {
+                "A": ["A_R1.fq.gz", "A_R2.fq.gz"],
+                "B": ["B_R1.fastq", "B_R2.fastq"]
+            },
+            []
+        ),
+        (
+            [
+                "X_S1_L001_R2_001.fastq.gz", "X_S1_L001_I1_001.fastq.gz",
+                "X_S1_L001_R1_001.fastq.gz", "X_S1_L002_R1_001.fastq.gz",
+                "Y.1.fq", "Y.2.fq", "notes.txt.fq"
+            ],
+            FQ_NAME_PATTERNS,
+            {
+                "X_L001": [
+                    "X_S1_L001_R1_001.fastq.gz", "X_S1_L001_R2_001.fastq.gz"
+                ],
+                "Y": ["Y.1.fq", "Y.2.fq"]
+            },
+            [
+                "X_S1_L001_I1_001.fastq.gz", "notes.txt.fq",
+                "X_S1_L002_R1_001.fastq.gz"
+            ]
+        ),
+        (
+            ["run1-A-fwd.fq", "run1-A-rev.fq", "run1-A-R1.fq"],
+            [r"^(?P<run>[^-]+)-(?P<sample>[^-]+)-(?P<stream>fwd|rev)\.fq$"],
+            {"run1_A": ["run1-A-fwd.fq", "run1-A-rev.fq"]},
+            ["run1-A-R1.fq"]
+        ),
+    ]
+)
+def test_pair_fq(
+    fq_names: List[str],
+    patterns: List[str],
+    expected_pairs: Dict[str, List[str]],
+    expected_orphans: List[str]
+) -> None:
+    """
+    This function tests the pairing of fastq files, with unmatched, index
+    reads and missing mates
+
+    Example:
+    pytest -v ./prepare_design.py -k test_pair_fq
+    """
+    pairs, orphans = pair_fq(map(Path, fq_names), patterns)
+    assert {
+        sample: [mates[stream][0].name for stream in sorted(mates)]
+        for sample, mates in pairs.items()
+    } == expected_pairs
+    assert [fq.name for fq in orphans] == expected_orphans
+
+
+def test_pair_fq_merge() -> None:
+    """
+    This function tests the merge of lanes belonging to the same sample
+
+    Example:
+    pytest -v ./prepare_design.py -k test_pair_fq_merge
+    """
+    fq_names = [
+        f"X_S1_L00{lane}_R{stream}_001.fastq.gz"
+        for lane in [2, 1, 4, 3]
+        for stream in [2, 1]
+    ]
+    pairs, orphans = pair_fq(map(Path, fq_names), merge=["lane"])
+    assert orphans == []
+    assert {
+        stream: [fq.name for fq in fq_list]
+        for stream, fq_list in pairs["X"].items()
+    } == {
+        stream: [
+            f"X_S1_L00{lane}_R{stream}_001.fastq.gz" for lane in range(1, 5)
+        ]
+        for stream in ["1", "2"]
+    }
+
+
 # Turning the FQ list into a dictionnary
-def classify_fq(fq_files: List[Path], paired: bool = True) -> Dict[str, Path]:
+def classify_fq(
+    fq_files: Iterable[Path],
+    paired: bool = True,
+    patterns: List[str] = FQ_NAME_PATTERNS,
+    merge: Collection[str] = (),
+) -> Tuple[Dict[str, Dict[str, str]], List[Path]]:
     """
     Return a dictionnary with identified fastq files (paried or not)
 
     Parameters:
-        fq_files    List[Path]      A list of paths to iterate over
+        fq_files    Iterable[Path]  Fastq files to classify
         paired      bool            A boolean, weather the dataset is
                                     pair-ended (True) or single-ended (False)
+        patterns    List[str]       Regular expressions used to identify
+                                    samples and mates (see pair_fq)
+        merge       Collection[str] Named groups left out of the sample
+                                    identifier (see pair_fq)
 
     Return:
-                    Dict[str, Path] A dictionnary: for each Sample ID, the ID
+                    Tuple[Dict[str, Dict[str, str]], List[Path]]
+                                    A dictionnary: for each Sample ID, the ID
                                     is repeated alongside with the upstream
-                                    /downstream fastq files.
+                                    /downstream fastq files (comma separated
+                                    when a sample has multiple lanes) ; and
+                                    the list of orphan fastq files
 
     Example:
     # Paired-end single sample
     >>> classify_fq([Path("file1.R1.fq"), Path("file1.R2.fq")], True)
-    {'file1.R1.fq': {'Downstream_file': PosixPath("/path/to/file1.R1.fq"),
-     'Sample_id': 'file1.R1',
-     'Upstream_file': PosixPath('/path/to/file1.R2.fq')}
+    ({'file1': {'Sample_id': 'file1',
+      'Upstream_file': '/path/to/file1.R1.fq',
+      'Downstream_file': '/path/to/file1.R2.fq'}}, [])
 
     # Single-ended single sample
     >>> classify_fq([Path("file1.fq")], False)
-    {'file1.fq': {'Sample_id': 'file1',
-     'Upstream_file': PosixPath('/path/to/file1.fq')}}
+    ({'file1': {'Sample_id': 'file1',
+      'Upstream_file': '/path/to/file1.fq'}}, [])
     """
     fq_dict = {}
+    orphans = []
     if paired is not True:
         # Case single fastq per sample
         logging.debug("Sorting fastq files as single-ended")
+        regexes = [re.compile(pattern) for pattern in patterns]
+        samples = defaultdict(dict)
         for fq in fq_files:
-            fq_dict[fq.name] = {
-                "Sample_id": fq.stem,
-                "Upstream_file": fq.absolute(),
+            match = next(
+                (m for m in (regex.match(fq.name) for regex in regexes) if m),
+                None
+            )
+            if match is None:
+                sample, merged_values = FQ_SUFFIX.sub("", fq.name), ()
+            else:
+                sample = fq_sample_id(match, merge)
+                merged_values = tuple(
+                    match.groupdict().get(g) or "" for g in merge
+                )
+
+            if merged_values in samples[sample]:
+                logging.warning(f"{fq} and {sample} share the same identifier")
+                orphans.append(fq)
+                continue
+            samples[sample][merged_values] = fq
+
+        for sample, lanes in samples.items():
+            fq_dict[sample] = {
+                "Sample_id": sample,
+                "Upstream_file": ",".join(
+                    str(lanes[lane].absolute()) for lane in sorted(lanes)
+                ),
             }
     else:
         # Case pairs of fastq are used
         logging.debug("Sorting fastq files as pair-ended")
-        for fq1, fq2 in zip(fq_files[0::2], fq_files[1::2]):
-            fq_dict[fq1.name] = {
-                "Sample_id": fq1.stem,
-                "Upstream_file": fq1.absolute(),
-                "Downstream_file": fq2.absolute(),
+        pairs, orphans = pair_fq(fq_files, patterns, merge)
+        for sample, mates in pairs.items():
+            upstream, downstream = (mates[stream] for stream in sorted(mates))
+            fq_dict[sample] = {
+                "Sample_id": sample,
+                "Upstream_file": ",".join(
+                    str(fq.absolute()) for fq in upstream
+                ),
+                "Downstream_file": ",".join(
+                    str(fq.absolute()) for fq in downstream
+                ),
             }
     logging.debug(fq_dict)
-    return fq_dict
+    return fq_dict, orphans
 
 
-def test_classify_fq():
+def test_classify_fq(tmp_path: Path):
     """
     This function takes input from the pytest decorator
     to test the classify_fq function
@@ -153,21 +554,49 @@ def test_classify_fq():
     pytest -v ./prepare_design.py -k test_classify_fq
     """
     prefix = Path(__file__).parent.parent
-    fq_list = sorted(list(search_fq(prefix / "tests" / "reads")))
+    fq_list = search_fq(prefix / "tests" / "reads")
     expected = {
-        "A_R1.fq.gz": {
-            "Sample_id": "A_R1.fq",
-            "Upstream_file": prefix / "tests" / "reads" / "A_R1.fq.gz",
-            "Downstream_file": prefix / "tests" / "reads" / "A_R2.fq.gz",
+        "A": {
+            "Sample_id": "A",
+            "Upstream_file": str(prefix / "tests" / "reads" / "A_R1.fq.gz"),
+            "Downstream_file": str(prefix / "tests" / "reads" / "A_R2.fq.gz"),
         },
-        "B_R1.fq.gz": {
-            "Sample_id": "B_R1.fq",
-            "Upstream_file": prefix / "tests" / "reads" / "B_R1.fq.gz",
-            "Downstream_file": prefix / "tests" / "reads" / "B_R2.fq.gz",
+        "B": {
+            "Sample_id": "B",
+            "Upstream_file": str(prefix / "tests" / "reads" / "B_R1.fq.gz"),
+            "Downstream_file": str(prefix / "tests" / "reads" / "B_R2.fq.gz"),
         },
     }
 
-    assert classify_fq(fq_list) == expected
+    assert classify_fq(fq_list) == (expected, [])
+
+    expected = {
+        "A": {
+            "Sample_id": "A",
+            "Upstream_file": str(prefix / "tests" / "reads" / "A_R1.fq.gz"),
+        }
+    }
+    fq_list = [prefix / "tests" / "reads" / "A_R1.fq.gz"]
+    assert classify_fq(fq_list, paired=False) == (expected, [])
+
+    fq_list = [
+        tmp_path / f"X_S1_L00{lane}_R1_001.fastq.gz" for lane in [2, 1]
+    ]
+    expected = {
+        "X": {
+            "Sample_id": "X",
+            "Upstream_file": ",".join(map(str, reversed(fq_list))),
+        }
+    }
+    assert classify_fq(fq_list, paired=False, merge=["lane"]) == (expected, [])
+
+    fq_list = [tmp_path / "S1.filtered.fq.gz", tmp_path / "S1.fixed.fastq"]
+    assert classify_fq(fq_list, paired=False) == ({
+        "S1.filtered": {
+            "Sample_id": "S1.filtered", "Upstream_file": str(fq_list[0])
+        },
+        "S1.fixed": {"Sample_id": "S1.fixed", "Upstream_file": str(fq_list[1])}
+    }, [])
 
 
 # Parsing command line arguments
@@ -184,8 +613,11 @@ def parse_args(args: Any = sys.argv[1:]) -> argparse.ArgumentParser:
 
     Example:
     >>> parse_args(shlex.split("/path/to/fasta --single"))
-    Namespace(debug=False, output='design.tsv', path='/path/to/fasta',
-    quiet=False, recursive=False, single=True)
+    Namespace(auto_trimmer=False, debug=False, exclude=[], include=['*.fq',
+    '*.fq.gz', '*.fastq', '*.fastq.gz'], max_depth=None, merge_lanes=False,
+    orphans='orphans.txt',
+    output='design.tsv', path='/path/to/fasta', pattern=None, quiet=False,
+    recursive=False, single=True, threads=4)
     """
     # Defining command line options
     main_parser = argparse.ArgumentParser(
@@ -216,6 +648,80 @@ def parse_args(args: Any = sys.argv[1:]) -> argparse.ArgumentParser:
         action="store_true",
     )
 
+    main_parser.add_argument(
+        "--max-depth",
+        help="Maximum depth of searched sub-directories, overrides "
+             "--recursive (default: %(default)s)",
+        type=int,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--include",
+        help="Glob patterns a fastq file name must match "
+             "(default: %(default)s)",
+        nargs="+",
+        type=str,
+        default=FQ_PATTERNS,
+    )
+
+    main_parser.add_argument(
+        "--exclude",
+        help="Glob patterns of file or directory names to ignore "
+             "(default: %(default)s)",
+        nargs="+",
+        type=str,
+        default=[],
+    )
+
+    main_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of directories listed concurrently "
+             "(default: %(default)s)",
+        type=int,
+        default=4,
+    )
+
+    main_parser.add_argument(
+        "-p",
+        "--pattern",
+        help="Regular expression identifying samples and mates from file "
+             "names, with a 'stream' named group. Other named groups build "
+             "the sample identifier. May be repeated, user patterns are "
+             "tried before the default ones",
+        action="append",
+        type=str,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-m",
+        "--merge-lanes",
+        help="Merge the lanes of a sample into a single design entry, "
+             "listing its fastq files with commas. Lanes are identified "
+             "by the 'lane' named group of the patterns",
+        default=False,
+        action="store_true",
+    )
+
+    main_parser.add_argument(
+        "--auto-trimmer",
+        help="Sample the reads of each sample, and select the fastp preset "
+             "(soft, medium or hard) fitting their quality, in a "
+             "Fastp_extra column. See select_trimmer.py",
+        default=False,
+        action="store_true",
+    )
+
+    main_parser.add_argument(
+        "--orphans",
+        help="Path to the list of fastq files which could not be paired "
+             "(default: %(default)s)",
+        type=str,
+        default="orphans.txt",
+    )
+
     main_parser.add_argument(
         "-o",
         "--output",
@@ -255,12 +761,20 @@ def test_parse_args() -> None:
     """
     options = parse_args(shlex.split("/path/to/fastq/dir/"))
     expected = argparse.Namespace(
+        auto_trimmer=False,
         debug=False,
+        exclude=[],
+        include=FQ_PATTERNS,
+        max_depth=None,
+        merge_lanes=False,
+        orphans="orphans.txt",
         output="design.tsv",
         path="/path/to/fastq/dir/",
+        pattern=None,
         quiet=False,
         recursive=False,
         single=False,
+        threads=4,
     )
     assert options == expected
 
@@ -277,15 +791,38 @@ def main(args: argparse.ArgumentParser) -> None:
     >>> main(parse_args(shlex.split("/path/to/fasta/dir/")))
     """
     # Searching for fastq files and sorting them alphabetically
-    fq_files = sorted(list(search_fq(Path(args.path), args.recursive)))
-    logging.debug("Head of alphabeticaly sorted list of fastq files:")
-    logging.debug([str(i) for i in fq_files[0:5]])
+    max_depth = args.max_depth
+    if max_depth is None and args.recursive is not True:
+        max_depth = 0
+
+    fq_files = crawl_fq(
+        Path(args.path),
+        include=args.include,
+        exclude=args.exclude,
+        max_depth=max_depth,
+        threads=args.threads
+    )
 
     # Building a dictionnary of fastq (pairs?) and identifiers
-    fq_dict = classify_fq(fq_files)
+    fq_dict, orphans = classify_fq(
+        fq_files,
+        paired=args.single is not True,
+        patterns=(args.pattern or []) + FQ_NAME_PATTERNS,
+        merge=["lane"] if args.merge_lanes is True else []
+    )
+
+    if orphans:
+        logging.warning(
+            f"{len(orphans)} orphan fastq files listed in {args.orphans}"
+        )
+        with open(args.orphans, "w") as orphans_file:
+            orphans_file.write("\n".join(map(str, sorted(orphans))) + "\n")
 
     # Using Pandas to handle TSV output (yes pretty harsh I know)
-    data = pd.DataFrame(fq_dict).T
+    data = pd.DataFrame(fq_dict).T.sort_index()
+    if args.auto_trimmer is True:
+        from select_trimmer import design_presets
+        data = design_presets(data, threads=args.threads)
     logging.debug("\n{}".format(data.head()))
     logging.debug("Saving results to {}".format(args.output))
     data.to_csv(args.output, sep="\t", index=False)
@@ -0,0 +1,575 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script fits the resources (memory, time) reserved by the rules of the
+ngs-cleaning pipeline, from the size of their input files.
+
+Each resource of each rule is modelled as:
+    min((intercept + slope * input size in GB) * attempt, max)
+
+Threads of multi-threaded rules are modelled as:
+    min(ceil(input size in GB / gb_per_thread), max)
+
+Without a fitted model, the default coefficients reproduce the constant
+reservations of the pipeline. Coefficients are fitted with a least squares
+regression over the benchmark files of past runs
+(benchmarks/{rule}/{wildcard}.tsv), with a safety margin, and saved as a
+yaml file referenced by the "resource_model" key of the configuration.
+gb_per_thread is fitted from the cores used by benchmarked jobs
+(cpu_time / s). Each rule is fitted from its own benchmark directory.
+Chunks (fastp_chunk) and batches of samples have no known input size:
+their benchmarks are not fitted, and they reuse the fastp_trimmer model.
+
+You can test this script with:
+pytest -v ./resource_model.py
+
+Usage example:
+python3.8 ./resource_model.py --design design.tsv --benchmarks benchmarks \
+    --output resource_model.yaml
+"""
+
+import argparse  # Parse command line
+import copy  # Deep copies of default models
+import csv  # Parse benchmark files
+import logging  # Traces and loggings
+import math  # Rounding
+import os  # OS related activities
+import sys  # System related methods
+
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List, Optional, Tuple  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+
+
+# Default coefficients: the constant reservations of the pipeline
+DEFAULT_MODEL = {
+    "copy_fastq": {
+        "mem_mb": {"intercept": 128, "slope": 0, "max": 512},
+        "time_min": {"intercept": 1440, "slope": 0, "max": 2832},
+    },
+    "concatenate_fastq": {
+        "mem_mb": {"intercept": 128, "slope": 0, "max": 512},
+        "time_min": {"intercept": 1440, "slope": 0, "max": 2832},
+    },
+    "pair_manifest": {
+        "time_min": {"intercept": 1440, "slope": 0, "max": 2832},
+    },
+    "split_fastq": {
+        "time_min": {"intercept": 1440, "slope": 0, "max": 2832},
+    },
+    "fastp_trimmer": {
+        "mem_mb": {"intercept": 2048, "slope": 0, "max": 20480},
+        "time_min": {"intercept": 20, "slope": 0, "max": 200},
+        "threads": {"gb_per_thread": None, "max": 10},
+    },
+    "gather_fastp_chunks": {
+        "time_min": {"intercept": 1440, "slope": 0, "max": 2832},
+    },
+    "raw_fastq_stats": {
+        "time_min": {"intercept": 20, "slope": 0, "max": 200},
+    },
+    "trimmed_fastq_stats": {
+        "time_min": {"intercept": 20, "slope": 0, "max": 200},
+    },
+    "subsample_fastq": {
+        "mem_mb": {"intercept": 1024, "slope": 0, "max": 4096},
+        "time_min": {"intercept": 30, "slope": 0, "max": 200},
+    },
+    "fastq_screen": {
+        "mem_mb": {"intercept": 10240, "slope": 0, "max": 15360},
+        "time_min": {"intercept": 30, "slope": 0, "max": None},
+        "threads": {"gb_per_thread": None, "max": 20},
+    },
+}
+
+# Benchmark columns used to fit each resource, and their conversion
+BENCHMARK_COLUMNS = {
+    "mem_mb": ("max_rss", 1.0),
+    "time_min": ("s", 1 / 60),
+}
+
+# Fitted reservations are raised by this factor, to avoid retries
+SAFETY_MARGIN = 1.25
+
+# Minimum number of benchmarks needed to fit a resource
+MIN_POINTS = 3
+
+
+def estimate_resource(
+    model: Dict[str, Any],
+    rule: str,
+    resource: str,
+    size_gb: float,
+    attempt: int = 1
+) -> int:
+    """
+    Return the reservation of a resource, for a given rule, input size and
+    attempt number
+
+    Example:
+    >>> estimate_resource(DEFAULT_MODEL, "fastp_trimmer", "mem_mb", 12, 2)
+    4096
+    """
+    coefficients = model[rule][resource]
+    value = (coefficients["intercept"] + coefficients["slope"] * size_gb)
+    value = math.ceil(value * attempt)
+    if coefficients.get("max") is not None:
+        value = min(value, coefficients["max"])
+    return value
+
+
+def estimate_threads(
+    model: Dict[str, Any], rule: str, size_gb: float, max_threads: int
+) -> int:
+    """
+    Return the number of threads of a rule, for a given input size. Without
+    a gb_per_thread coefficient, the maximum number of threads is used.
+
+    Example:
+    >>> model = {"fastp_trimmer": {"threads": {"gb_per_thread": 2, "max": 10}}}
+    >>> estimate_threads(model, "fastp_trimmer", 5, 8)
+    3
+    """
+    coefficients = model[rule]["threads"]
+    max_threads = min(max_threads, coefficients.get("max") or max_threads)
+    if not coefficients.get("gb_per_thread"):
+        return max(max_threads, 1)
+    threads = math.ceil(size_gb / coefficients["gb_per_thread"])
+    return max(1, min(threads, max_threads))
+
+
+def test_estimate() -> None:
+    """
+    This function tests resources estimations, and that the default model
+    reproduces the constant reservations
+
+    Example:
+    pytest -v ./resource_model.py -k test_estimate
+    """
+    for attempt in [1, 2, 20]:
+        assert estimate_resource(
+            DEFAULT_MODEL, "fastp_trimmer", "mem_mb", 50, attempt
+        ) == min(attempt * 2048, 20480)
+        assert estimate_resource(
+            DEFAULT_MODEL, "fastq_screen", "time_min", 50, attempt
+        ) == 30 * attempt
+
+    assert estimate_threads(DEFAULT_MODEL, "fastp_trimmer", 0.1, 16) == 10
+    assert estimate_threads(DEFAULT_MODEL, "fastq_screen", 0.1, 4) == 4
+
+    model = {
+        "fastp_trimmer": {
+            "mem_mb": {"intercept": 500, "slope": 100.5, "max": None},
+            "threads": {"gb_per_thread": 1.5, "max": 10},
+        }
+    }
+    assert estimate_resource(model, "fastp_trimmer", "mem_mb", 2) == 701
+    assert estimate_threads(model, "fastp_trimmer", 0, 16) == 1
+    assert estimate_threads(model, "fastp_trimmer", 4, 16) == 3
+    assert estimate_threads(model, "fastp_trimmer", 400, 16) == 10
+
+
+def linear_fit(points: List[Tuple[float, float]]) -> Tuple[float, float]:
+    """
+    Return the (intercept, slope) of the least squares line through the
+    given (x, y) points. The slope is never negative: larger inputs never
+    get smaller reservations.
+
+    Example:
+    >>> linear_fit([(0, 1), (1, 3), (2, 5)])
+    (1.0, 2.0)
+    """
+    nb_points = len(points)
+    mean_x = sum(x for x, _ in points) / nb_points
+    mean_y = sum(y for _, y in points) / nb_points
+    variance = sum((x - mean_x) ** 2 for x, _ in points)
+    if variance == 0:
+        return max(y for _, y in points), 0.0
+
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+    if slope < 0:
+        return max(y for _, y in points), 0.0
+    return mean_y - slope * mean_x, slope
+
+
+def fit_gb_per_thread(points: List[Tuple[float, float]]) -> Optional[float]:
+    """
+    Return the input size in GB per thread, from (input size in GB, cores
+    used) points: the inverse of the least squares slope of the cores used
+    over the input size, through the origin. None if cores used do not
+    grow with the input size.
+
+    Example:
+    >>> fit_gb_per_thread([(2, 1), (4, 2), (8, 4)])
+    2.0
+    """
+    sum_xx = sum(x * x for x, _ in points)
+    sum_xy = sum(x * y for x, y in points)
+    if sum_xx == 0 or sum_xy <= 0:
+        return None
+    return sum_xx / sum_xy
+
+
+def read_benchmark(path: Path) -> Optional[Dict[str, float]]:
+    """
+    Return the first (and usually only) line of a Snakemake benchmark file.
+    cpu_time is None when it is missing or not a number.
+    """
+    with path.open() as tsv:
+        for row in csv.DictReader(tsv, delimiter="\t"):
+            try:
+                bench = {
+                    column: float(row[column])
+                    for column, _ in BENCHMARK_COLUMNS.values()
+                }
+            except (KeyError, ValueError):
+                logging.warning(f"Could not parse {path}")
+                return None
+            try:
+                bench["cpu_time"] = float(row["cpu_time"])
+            except (KeyError, TypeError, ValueError):
+                bench["cpu_time"] = None
+            return bench
+    return None
+
+
+def fit_model(
+    benchmarks: Dict[str, List[Tuple[float, Dict[str, float]]]],
+    model: Dict[str, Any] = DEFAULT_MODEL,
+    margin: float = SAFETY_MARGIN
+) -> Dict[str, Any]:
+    """
+    Fit the coefficients of each rule and resource from benchmarks, and
+    return an updated copy of the given model. Rules or resources with
+    less than MIN_POINTS benchmarks keep their coefficients.
+
+    Parameters:
+        benchmarks  Dict[str, List[Tuple[float, Dict[str, float]]]]
+                            For each rule, (input size in GB, benchmark)
+        model       Dict[str, Any]
+                            Initial model
+        margin      float   Factor applied to fitted coefficients
+    """
+    fitted = copy.deepcopy(model)
+    for rule, measures in benchmarks.items():
+        if rule not in fitted or len(measures) < MIN_POINTS:
+            logging.info(f"Not enough benchmarks to fit {rule}")
+            continue
+
+        for resource, (column, factor) in BENCHMARK_COLUMNS.items():
+            if resource not in fitted[rule]:
+                continue
+            intercept, slope = linear_fit(
+                [(size, bench[column] * factor) for size, bench in measures]
+            )
+            fitted[rule][resource]["intercept"] = max(
+                math.ceil(intercept * margin), 1
+            )
+            fitted[rule][resource]["slope"] = round(slope * margin, 3)
+            logging.info(
+                f"{rule} {resource}: {intercept:.1f} + {slope:.1f} * GB"
+            )
+
+        if "threads" not in fitted[rule]:
+            continue
+        cores = [
+            (size, bench["cpu_time"] / bench["s"])
+            for size, bench in measures
+            if bench.get("cpu_time") is not None and bench["s"] > 0
+        ]
+        gb_per_thread = (
+            fit_gb_per_thread(cores) if len(cores) >= MIN_POINTS else None
+        )
+        if gb_per_thread is not None:
+            # More threads, rather than less, for a given size
+            fitted[rule]["threads"]["gb_per_thread"] = round(
+                gb_per_thread / margin, 3
+            )
+            logging.info(f"{rule} threads: one per {gb_per_thread:.2f} GB")
+    return fitted
+
+
+def test_fit_model() -> None:
+    """
+    This function tests model fitting on synthetic benchmarks
+
+    Example:
+    pytest -v ./resource_model.py -k test_fit_model
+    """
+    measures = [
+        (size, {
+            "max_rss": 500 + 100 * size,
+            "s": 60 + 600 * size,
+            "cpu_time": (60 + 600 * size) * size / 2
+        })
+        for size in [1, 2, 4, 8]
+    ]
+    fitted = fit_model({"fastp_trimmer": measures}, margin=1)
+    assert fitted["fastp_trimmer"]["threads"]["gb_per_thread"] == 2
+    assert fit_model({"fastp_trimmer": measures}, margin=1.25)[
+        "fastp_trimmer"
+    ]["threads"]["gb_per_thread"] == 1.6
+    assert fitted["fastp_trimmer"]["mem_mb"]["intercept"] == 500
+    assert fitted["fastp_trimmer"]["mem_mb"]["slope"] == 100
+    assert fitted["fastp_trimmer"]["time_min"]["intercept"] == 1
+    assert fitted["fastp_trimmer"]["time_min"]["slope"] == 10
+    assert fitted["fastp_trimmer"]["mem_mb"]["max"] == 20480
+    assert DEFAULT_MODEL["fastp_trimmer"]["mem_mb"]["slope"] == 0
+
+    fitted = fit_model({"fastq_screen": measures[:2]})
+    assert fitted["fastq_screen"] == DEFAULT_MODEL["fastq_screen"]
+
+    # Without cpu_time, threads keep their coefficients
+    measures = [
+        (size, {**bench, "cpu_time": None}) for size, bench in measures
+    ]
+    fitted = fit_model({"fastq_screen": measures})
+    assert fitted["fastq_screen"]["threads"] == (
+        DEFAULT_MODEL["fastq_screen"]["threads"]
+    )
+
+
+def load_model(path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Return the default model, updated with the coefficients of the given
+    yaml file if any
+    """
+    model = copy.deepcopy(DEFAULT_MODEL)
+    if path is None:
+        return model
+
+    import yaml  # Handle Yaml IO
+
+    with open(path) as model_yaml:
+        for rule, resources in (yaml.safe_load(model_yaml) or {}).items():
+            for resource, coefficients in resources.items():
+                model.setdefault(rule, {}).setdefault(resource, {})
+                model[rule][resource].update(coefficients)
+    return model
+
+
+def wildcard_sizes(
+    samples: Dict[str, List[List[str]]], workdir: str = "."
+) -> Dict[str, float]:
+    """
+    Return the size in GB of the input files of each wildcard value used by
+    the rules: sample identifiers, read streams (sample.R1, sample.R2) and
+    raw file names (sample_R1.fastq.gz, or sample.fastq.gz if single-end)
+
+    Parameters:
+        samples     Dict[str, List[List[str]]]
+                            Fastq files of each stream of each sample,
+                            see common_script_ngs_cleaning.design_fastq
+        workdir     str     Directory against which relative paths are
+                            resolved
+    """
+    sizes = {}
+    for sample, streams in samples.items():
+        stream_sizes = []
+        for files in streams:
+            size = 0
+            for path in files:
+                try:
+                    size += os.stat(os.path.join(workdir, path)).st_size
+                except OSError:
+                    logging.debug(f"Could not stat {path}")
+            stream_sizes.append(size / 1024 ** 3)
+
+        sizes[sample] = sum(stream_sizes)
+        if len(stream_sizes) == 2:
+            sizes[f"{sample}.R1"], sizes[f"{sample}.R2"] = stream_sizes
+            sizes[f"{sample}_R1.fastq.gz"] = stream_sizes[0]
+            sizes[f"{sample}_R2.fastq.gz"] = stream_sizes[1]
+        else:
+            sizes[f"{sample}.fastq.gz"] = sizes[sample]
+    return sizes
+
+
+def test_wildcard_sizes(tmp_path: Path) -> None:
+    """
+    This function tests input sizes computation
+
+    Example:
+    pytest -v ./resource_model.py -k test_wildcard_sizes
+    """
+    for name, size in [("L1_R1", 1024 ** 2), ("L2_R1", 1024 ** 2),
+                       ("L1_R2", 2 * 1024 ** 2)]:
+        (tmp_path / f"{name}.fq.gz").write_bytes(b"\0" * size)
+
+    sizes = wildcard_sizes(
+        {"S": [["L1_R1.fq.gz", "L2_R1.fq.gz"], ["L1_R2.fq.gz", "missing"]]},
+        str(tmp_path)
+    )
+    assert sizes == {
+        "S": 4 / 1024, "S.R1": 2 / 1024, "S.R2": 2 / 1024,
+        "S_R1.fastq.gz": 2 / 1024, "S_R2.fastq.gz": 2 / 1024
+    }
+
+
+def collect_benchmarks(
+    benchmarks_dir: Path, sizes: Dict[str, float]
+) -> Dict[str, List[Tuple[float, Dict[str, float]]]]:
+    """
+    Return the benchmarks of each rule, organized as {rule}/{wildcard}.tsv,
+    with the input size of their wildcard value. Benchmarks of unknown
+    wildcard values (batches, chunks) are ignored.
+    """
+    benchmarks: Dict[str, List[Tuple[float, Dict[str, float]]]] = {}
+    for rule_dir in Path(benchmarks_dir).iterdir():
+        if not rule_dir.is_dir():
+            continue
+        for bench_path in rule_dir.glob("*.tsv"):
+            wildcard = bench_path.name[:-len(".tsv")]
+            bench = read_benchmark(bench_path)
+            if wildcard in sizes and bench is not None:
+                benchmarks.setdefault(rule_dir.name, []).append(
+                    (sizes[wildcard], bench)
+                )
+    return benchmarks
+
+
+def test_collect_benchmarks(tmp_path: Path) -> None:
+    """
+    This function tests that benchmarks named after raw files, as those of
+    copy_fastq, are fitted
+
+    Example:
+    pytest -v ./resource_model.py -k test_collect_benchmarks
+    """
+    samples = {}
+    for sample, size_mb in [("A", 1), ("B", 2), ("C", 4)]:
+        samples[sample] = []
+        for stream in ["R1", "R2"]:
+            name = f"{sample}_{stream}.fq.gz"
+            (tmp_path / name).write_bytes(b"\0" * size_mb * 1024 ** 2)
+            samples[sample].append([name])
+    sizes = wildcard_sizes(samples, str(tmp_path))
+
+    (tmp_path / "benchmarks" / "copy_fastq").mkdir(parents=True)
+    for sample, seconds in [("A", 60), ("B", 120), ("C", 240)]:
+        for stream in ["R1", "R2"]:
+            bench = f"{sample}_{stream}.fastq.gz.tsv"
+            (tmp_path / "benchmarks" / "copy_fastq" / bench).write_text(
+                "s\th:m:s\tmax_rss\n"
+                f"{seconds}\t0:00:{seconds}\t100\n"
+            )
+    (tmp_path / "benchmarks" / "copy_fastq" / "batch_0.tsv").write_text(
+        "s\th:m:s\tmax_rss\n1\t0:00:01\t100\n"
+    )
+
+    benchmarks = collect_benchmarks(tmp_path / "benchmarks", sizes)
+    assert len(benchmarks["copy_fastq"]) == 6
+    fitted = fit_model(benchmarks, margin=1)
+    assert fitted["copy_fastq"]["time_min"]["slope"] == 1024
+    assert fitted["copy_fastq"]["time_min"] != (
+        DEFAULT_MODEL["copy_fastq"]["time_min"]
+    )
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--design",
+        help="Path to the design file of the benchmarked run "
+             "(default: %(default)s)",
+        type=str,
+        default="design.tsv",
+    )
+
+    main_parser.add_argument(
+        "--benchmarks",
+        help="Path to the benchmarks directory of the benchmarked run, "
+             "organized as {rule}/{wildcard}.tsv (default: %(default)s)",
+        type=str,
+        default="benchmarks",
+    )
+
+    main_parser.add_argument(
+        "--workdir",
+        help="Working directory of the benchmarked run, against which "
+             "relative paths of the design are resolved "
+             "(default: %(default)s)",
+        type=str,
+        default=".",
+    )
+
+    main_parser.add_argument(
+        "--model",
+        help="Previous model to update (default: the constant reservations)",
+        type=str,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--margin",
+        help="Safety margin applied to fitted coefficients "
+             "(default: %(default)s)",
+        type=float,
+        default=SAFETY_MARGIN,
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the fitted yaml model (default: %(default)s)",
+        type=str,
+        default="resource_model.yaml",
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function fits and saves the resource model
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    import pandas
+    from common_script_ngs_cleaning import design_fastq, write_yaml
+
+    design = pandas.read_csv(args.design, sep="\t", header=0, dtype=str)
+    sizes = wildcard_sizes(design_fastq(design), args.workdir)
+
+    benchmarks = collect_benchmarks(Path(args.benchmarks), sizes)
+    model = fit_model(benchmarks, load_model(args.model), args.margin)
+    write_yaml(Path(args.output), model)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
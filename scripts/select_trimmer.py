@@ -0,0 +1,417 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script selects, for each sample, the fastp preset (soft, medium or
+hard) fitting the quality of its reads, and writes it in the design file.
+
+A bounded sample of reads is taken from each fastq file: its first reads,
+plus reads found at random offsets for plain text files and for BGZF (or
+any block gzipped) files. On this sample, the mean quality, the fraction
+of reads ending with a poly-G tail, and the fraction of low complexity
+reads are measured. Good samples get the soft preset, without any low
+complexity filter nor poly-G trimming. Bad samples get the hard one.
+
+You can test this script with:
+pytest -v ./select_trimmer.py
+
+Usage example:
+python3.8 ./select_trimmer.py --design design.tsv --output design.tsv
+"""
+
+import argparse  # Parse command line
+import logging  # Traces and loggings
+import numpy  # Vectorized metrics
+import os  # OS related activities
+import random  # Random seeks
+import sys  # System related methods
+import zlib  # Decompress gzip blocks
+
+from concurrent.futures import ThreadPoolExecutor  # Sample files together
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, List, Optional, Tuple  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter, FASTP_PRESETS
+from fastq_codecs import open_input
+from fastq_stats import PHRED_OFFSET, read_records
+
+
+# Number of first reads sampled per fastq file
+HEAD_READS = 100000
+
+# Number of random seeks per fastq file, and of reads sampled per seek
+SEEKS = 16
+SEEK_READS = 2000
+
+# Compressed bytes read after each seek
+SEEK_SIZE = 1024 * 1024
+
+# A read ends with a poly-G tail if it ends with that many G
+POLY_G_LENGTH = 10
+
+# Reads with less than this fraction of bases differing from the next one
+# are low complexity reads, as in fastp
+COMPLEXITY_THRESHOLD = 0.3
+
+# (preset, minimum mean quality, maximum poly-G rate, maximum low
+# complexity rate): the first preset whose thresholds are met is selected
+PRESET_THRESHOLDS = [
+    ("soft", 30, 0.01, 0.01),
+    ("medium", 25, 0.01, 0.05),
+]
+
+# Header of a gzip member with extra fields, as written by bgzip
+GZIP_MEMBER = b"\x1f\x8b\x08\x04"
+
+
+def complete_records(data: bytes) -> Tuple[List[bytes], List[bytes]]:
+    """
+    Return the sequences and qualities of the complete records found in
+    an arbitrary chunk of a fastq file, starting anywhere
+    """
+    lines = data.split(b"\n")[1:-1]
+    for start in range(min(4, len(lines))):
+        # A header, then a separator two lines below, then a header again
+        if (lines[start].startswith(b"@")
+                and start + 2 < len(lines)
+                and lines[start + 2].startswith(b"+")
+                and (start + 4 >= len(lines)
+                     or lines[start + 4].startswith(b"@"))):
+            complete = start + 4 * ((len(lines) - start) // 4)
+            return (
+                lines[start + 1:complete:4], lines[start + 3:complete:4]
+            )
+    return [], []
+
+
+def test_complete_records() -> None:
+    """
+    This function tests records alignment in arbitrary chunks
+
+    Example:
+    pytest -v ./select_trimmer.py -k test_complete_records
+    """
+    data = b"IIII\n@r1\nACGT\n+\nIIII\n@r2\n@CGT\n+\n@@@@\n@r3\nAC"
+    assert complete_records(data) == ([b"ACGT", b"@CGT"], [b"IIII", b"@@@@"])
+    assert complete_records(b"GT\n+\nIIII\n") == ([], [])
+
+
+def seek_gzip_block(
+    handle: Any, offset: int, size: int = SEEK_SIZE
+) -> bytes:
+    """
+    Decompress the gzip members found after the given offset of a block
+    gzipped file. Returns nothing for single member gzip files.
+    """
+    handle.seek(offset)
+    data = handle.read(size)
+    start = data.find(GZIP_MEMBER)
+    if start < 0:
+        return b""
+
+    decompressed = []
+    data = data[start:]
+    while data:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        try:
+            decompressed.append(decompressor.decompress(data))
+        except zlib.error:
+            break
+        data = decompressor.unused_data
+    return b"".join(decompressed)
+
+
+def sample_reads(
+    path: Path,
+    head_reads: int = HEAD_READS,
+    seeks: int = SEEKS,
+    seek_reads: int = SEEK_READS,
+    rng: Optional[random.Random] = None
+) -> Tuple[List[bytes], List[bytes]]:
+    """
+    Return the sequences and qualities of a bounded sample of reads of a
+    fastq file: its first reads, and reads found at random offsets
+
+    Parameters:
+        path        Path    Path to a fastq file, gzipped or not
+        head_reads  int     Number of first reads sampled
+        seeks       int     Number of random seeks
+        seek_reads  int     Maximum number of reads sampled per seek
+        rng         Random  Random number generator
+    """
+    rng = rng or random.Random(0)
+    sequences, qualities = [], []
+    with open_input(path) as handle:
+        for block_seq, block_qual in read_records(handle):
+            sequences += block_seq[:head_reads - len(sequences)]
+            qualities += block_qual[:len(sequences) - len(qualities)]
+            if len(sequences) >= head_reads:
+                break
+
+    size = os.stat(path).st_size
+    with path.open("rb") as handle:
+        gzipped = handle.read(2) == GZIP_MEMBER[:2]
+        for _ in range(seeks if size > SEEK_SIZE else 0):
+            offset = rng.randrange(size - SEEK_SIZE)
+            if gzipped:
+                data = seek_gzip_block(handle, offset)
+            else:
+                handle.seek(offset)
+                data = handle.read(SEEK_SIZE)
+            seek_seq, seek_qual = complete_records(data)
+            sequences += seek_seq[:seek_reads]
+            qualities += seek_qual[:seek_reads]
+
+    logging.debug(f"{len(sequences)} reads sampled from {path}")
+    return sequences, qualities
+
+
+def read_metrics(
+    sequences: List[bytes], qualities: List[bytes]
+) -> Dict[str, float]:
+    """
+    Return the mean quality, poly-G rate and low complexity rate of reads
+
+    Example:
+    >>> read_metrics([b"ACGTGGGGGGGGGG"], [b"IIIIIIIIIIIIII"])
+    {'mean_quality': 40.0, 'poly_g_rate': 1.0, 'low_complexity_rate': 0.0}
+    """
+    if not sequences:
+        return {
+            "mean_quality": 0.0, "poly_g_rate": 0.0, "low_complexity_rate": 0.0
+        }
+
+    scores = numpy.frombuffer(b"".join(qualities), dtype=numpy.uint8)
+    poly_g = b"G" * POLY_G_LENGTH
+    poly_g_reads = sum(sequence.endswith(poly_g) for sequence in sequences)
+
+    # Complexity: fraction of bases differing from the next one, per read
+    lengths = numpy.fromiter(map(len, sequences), dtype=numpy.int64)
+    bases = numpy.frombuffer(b"".join(sequences), dtype=numpy.uint8)
+    changes = numpy.zeros(bases.size, dtype=numpy.int64)
+    changes[:-1] = bases[1:] != bases[:-1]
+    ends = numpy.cumsum(lengths)
+    changes[ends[lengths > 0] - 1] = 0
+    starts = ends - lengths
+    kept = lengths > 1
+    complexity = (
+        numpy.add.reduceat(changes, starts[kept]) / (lengths[kept] - 1)
+        if kept.any() else numpy.zeros(0)
+    )
+
+    return {
+        "mean_quality": float(scores.mean()) - PHRED_OFFSET,
+        "poly_g_rate": poly_g_reads / len(sequences),
+        "low_complexity_rate": (
+            float((complexity < COMPLEXITY_THRESHOLD).mean())
+            if complexity.size else 0.0
+        ),
+    }
+
+
+def select_preset(metrics: Dict[str, float]) -> str:
+    """
+    Return the name of the most permissive preset fitting the metrics
+
+    Example:
+    >>> select_preset({"mean_quality": 36, "poly_g_rate": 0,
+    ...                "low_complexity_rate": 0.02})
+    'medium'
+    """
+    for preset, quality, poly_g, low_complexity in PRESET_THRESHOLDS:
+        if (metrics["mean_quality"] >= quality
+                and metrics["poly_g_rate"] <= poly_g
+                and metrics["low_complexity_rate"] <= low_complexity):
+            return preset
+    return "hard"
+
+
+def test_select_preset(tmp_path: Path) -> None:
+    """
+    This function tests metrics and presets on a sampled fastq file
+
+    Example:
+    pytest -v ./select_trimmer.py -k test_select_preset
+    """
+    good = [(b"ACGTTGCA" * 4, b"I" * 32)] * 99
+    bad = [(b"ACGT" * 2 + b"G" * 24, b"+" * 32)]
+
+    path = tmp_path / "reads.fq"
+    with path.open("wb") as fq:
+        for read, (sequence, quality) in enumerate(good + bad):
+            fq.write(b"@r%d\n%s\n+\n%s\n" % (read, sequence, quality))
+
+    sequences, qualities = sample_reads(path, head_reads=100)
+    assert len(sequences) == 100
+    metrics = read_metrics(sequences, qualities)
+    assert metrics["poly_g_rate"] == 0.01
+    assert metrics["low_complexity_rate"] == 0.01
+    assert round(metrics["mean_quality"], 1) == 39.7
+    assert select_preset(metrics) == "soft"
+
+    metrics = read_metrics(*sample_reads(path, head_reads=10))
+    assert metrics["poly_g_rate"] == 0
+    assert read_metrics([s for s, _ in bad * 3], [q for _, q in bad * 3]) == {
+        "mean_quality": 10.0, "poly_g_rate": 1.0, "low_complexity_rate": 1.0
+    }
+    assert select_preset({
+        "mean_quality": 20, "poly_g_rate": 0, "low_complexity_rate": 0
+    }) == "hard"
+
+
+def sample_preset(
+    fq_files: List[str],
+    head_reads: int = HEAD_READS,
+    seeks: int = SEEKS
+) -> Tuple[str, Dict[str, float]]:
+    """
+    Return the preset selected for a sample, and the metrics of its reads
+    """
+    sequences, qualities = [], []
+    for fq_file in fq_files:
+        file_seq, file_qual = sample_reads(
+            Path(fq_file), max(head_reads // len(fq_files), 1), seeks
+        )
+        sequences += file_seq
+        qualities += file_qual
+    metrics = read_metrics(sequences, qualities)
+    return select_preset(metrics), metrics
+
+
+def design_presets(
+    design: Any,
+    workdir: str = ".",
+    head_reads: int = HEAD_READS,
+    seeks: int = SEEKS,
+    threads: int = 4
+) -> Any:
+    """
+    Return a copy of the design, with the fastp parameters selected for
+    each sample in a Fastp_extra column
+    """
+    from common_script_ngs_cleaning import design_fastq
+
+    samples = design_fastq(design)
+
+    def select(sample: str) -> str:
+        fq_files = [
+            os.path.join(workdir, path)
+            for stream in samples[sample] for path in stream
+        ]
+        preset, metrics = sample_preset(fq_files, head_reads, seeks)
+        logging.info(f"{sample}: {preset} preset, {metrics}")
+        return preset
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        presets = dict(zip(samples, executor.map(select, samples)))
+
+    design = design.copy()
+    design["Fastp_extra"] = [
+        FASTP_PRESETS[presets[sample]] for sample in design["Sample_id"]
+    ]
+    return design
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--design",
+        help="Path to the design file (default: %(default)s)",
+        type=str,
+        default="design.tsv",
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the design file with a Fastp_extra column "
+             "(default: %(default)s)",
+        type=str,
+        default="design.tsv",
+    )
+
+    main_parser.add_argument(
+        "--workdir",
+        help="Directory against which relative paths of the design are "
+             "resolved (default: %(default)s)",
+        type=str,
+        default=".",
+    )
+
+    main_parser.add_argument(
+        "--head-reads",
+        help="Number of first reads sampled per sample "
+             "(default: %(default)s)",
+        type=int,
+        default=HEAD_READS,
+    )
+
+    main_parser.add_argument(
+        "--seeks",
+        help="Number of random seeks per fastq file (default: %(default)s)",
+        type=int,
+        default=SEEKS,
+    )
+
+    main_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of samples processed at the same time "
+             "(default: %(default)s)",
+        type=int,
+        default=4,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function selects presets of all samples of a design
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    import pandas
+
+    design = pandas.read_csv(args.design, sep="\t", header=0, dtype=str)
+    design = design_presets(
+        design, args.workdir, args.head_reads, args.seeks, args.threads
+    )
+    design.to_csv(args.output, sep="\t", index=False)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,230 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script splits the fastq files of a sample into record-aligned chunks,
+so that very large samples can be trimmed by multiple jobs.
+
+Input files are streamed: records are dealt in blocks, round-robin, to the
+gzipped chunks. Nothing is decompressed to disk. Each mate is split with
+the very same blocks, so that the n-th chunk of R1 and the n-th chunk of
+R2 hold the same pairs of reads, in the same order.
+
+You can test this script with:
+pytest -v ./split_fastq.py
+
+Usage example:
+python3.8 ./split_fastq.py --input S1_R1.fq.gz S1_R2.fq.gz \
+    --output chunks/0.R1.fq.gz chunks/0.R2.fq.gz \
+             chunks/1.R1.fq.gz chunks/1.R2.fq.gz
+"""
+
+import argparse  # Parse command line
+import gzip  # Handle gzipped files
+import logging  # Traces and loggings
+import sys  # System related methods
+
+from concurrent.futures import ThreadPoolExecutor  # Split mates together
+from itertools import islice  # Read blocks of lines
+from pathlib import Path  # Paths related methods
+from typing import Any, List  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+from fastq_codecs import open_input
+
+
+# Number of records written at once to a chunk
+BLOCK_RECORDS = 10000
+
+
+def split_fastq(
+    fq_file: Path,
+    chunks: List[Path],
+    block_records: int = BLOCK_RECORDS,
+    compresslevel: int = 1
+) -> int:
+    """
+    Deal the records of a fastq file to gzipped chunks, by blocks of
+    block_records records, round-robin. Returns the number of records.
+
+    Parameters:
+        fq_file         Path        Fastq file to split
+        chunks          List[Path]  Gzipped chunks to write
+        block_records   int         Number of records per block
+        compresslevel   int         Gzip compression level of chunks
+
+    Example:
+    >>> split_fastq(Path("S1_R1.fq.gz"), [Path("0.fq.gz"), Path("1.fq.gz")])
+    2000000
+    """
+    outputs = [
+        gzip.open(chunk, "wb", compresslevel=compresslevel)
+        for chunk in chunks
+    ]
+    records = 0
+    try:
+        with open_input(fq_file) as infile:
+            for block_id in range(sys.maxsize):
+                block = list(islice(infile, 4 * block_records))
+                if not block:
+                    break
+                if len(block) % 4 != 0 or not block[0].startswith(b"@"):
+                    raise ValueError(
+                        f"{fq_file} is truncated or not record-aligned "
+                        f"after {records} records"
+                    )
+                outputs[block_id % len(outputs)].writelines(block)
+                records += len(block) // 4
+    finally:
+        for output in outputs:
+            output.close()
+
+    logging.info(f"{records} records of {fq_file} in {len(chunks)} chunks")
+    return records
+
+
+def test_split_fastq(tmp_path: Path) -> None:
+    """
+    This function tests that chunks are record-aligned, paired and complete
+
+    Example:
+    pytest -v ./split_fastq.py -k test_split_fastq
+    """
+    mates = []
+    for stream in ["R1", "R2"]:
+        mates.append(tmp_path / f"S1_{stream}.fq.gz")
+        with gzip.open(mates[-1], "wb") as fq:
+            for read in range(7):
+                fq.write(f"@r{read}/{stream}\nACGT\n+\nIIII\n".encode())
+
+    chunks = [
+        [tmp_path / f"{chunk}.{stream}.fq.gz" for chunk in range(3)]
+        for stream in ["R1", "R2"]
+    ]
+    for mate, mate_chunks in zip(mates, chunks):
+        assert split_fastq(mate, mate_chunks, block_records=2) == 7
+
+    with gzip.open(chunks[0][0], "rb") as chunk:
+        assert chunk.read().count(b"@r") == 3
+    with gzip.open(chunks[1][2], "rb") as chunk:
+        assert chunk.read().split(b"\n")[0] == b"@r4/R2"
+
+    truncated = tmp_path / "truncated.fq"
+    truncated.write_bytes(b"@r0\nACGT\n+\n")
+    try:
+        split_fastq(truncated, [tmp_path / "0.fq.gz"])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Truncated fastq files should be rejected")
+
+    truncated = tmp_path / "truncated.fq.gz"
+    truncated.write_bytes(mates[1].read_bytes()[:-10])
+    try:
+        split_fastq(truncated, [tmp_path / "0.fq.gz"])
+    except EOFError:
+        pass
+    else:
+        raise AssertionError("Truncated gzip members should be rejected")
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--input",
+        help="Fastq files of the sample: R1, and R2 if any",
+        type=Path,
+        nargs="+",
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--output",
+        help="Chunks to write, grouped by chunk: 0.R1 0.R2 1.R1 1.R2...",
+        type=Path,
+        nargs="+",
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--block-records",
+        help="Number of records dealt at once to a chunk "
+             "(default: %(default)s)",
+        type=int,
+        default=BLOCK_RECORDS,
+    )
+
+    main_parser.add_argument(
+        "-c",
+        "--compresslevel",
+        help="Gzip compression level of chunks (default: %(default)s)",
+        type=int,
+        default=1,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function splits all mates of a sample, at the same time
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    nb_mates = len(args.input)
+    if len(args.output) % nb_mates != 0:
+        raise ValueError("Each chunk needs one output per input file")
+
+    for output in args.output:
+        output.parent.mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=nb_mates) as executor:
+        records = list(executor.map(
+            lambda mate: split_fastq(
+                args.input[mate],
+                args.output[mate::nb_mates],
+                args.block_records,
+                args.compresslevel
+            ),
+            range(nb_mates)
+        ))
+
+    if len(set(records)) > 1:
+        raise ValueError(f"Mates have different numbers of reads: {records}")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,675 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script stages a batch of raw fastq files in the working directory.
+
+Each file is staged with the cheapest safe method (see staging_method):
+files located on cold storage mount points or on network file systems
+are copied, files on the same reflink-capable file system as the working
+directory are cloned, and other files are symlinked.
+
+Copies use multiple concurrent streams. Each copy uses in-kernel
+copy_file_range or sendfile when available, large page-aligned buffers
+otherwise, and is retried with an exponential backoff on failure.
+
+A report of the staging method, size, time and throughput of each file is
+written as a TSV file.
+
+You can test this script with:
+pytest -v ./stage_fastq.py
+
+Usage example:
+python3.8 ./stage_fastq.py --input /cold/A.fq.gz /hot/B.fq.gz \
+    --output raw_data/A.fastq.gz raw_data/B.fastq.gz \
+    --cold-storage /cold --threads 8 --report staging.tsv
+"""
+
+import argparse  # Parse command line
+import errno  # Error codes
+import functools  # Bind the serving mode of the copy cache
+import logging  # Traces and loggings
+import mmap  # Page-aligned buffers
+import os  # OS related activities
+import sys  # System related methods
+import time  # Timers and backoff
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path  # Paths related methods
+from typing import Any, Callable, List, NamedTuple, Tuple  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+from copy_cache import CopyCache, reflink
+
+
+# Size of each in-kernel copy or read call
+BUFFER_SIZE = 16 * 1024 * 1024
+
+# Errors meaning that a copy method is not supported for the given files
+UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+
+
+class StagingReport(NamedTuple):
+    """
+    How a single file has been staged
+    """
+    source: str
+    dest: str
+    method: str
+    size: int
+    seconds: float
+    attempts: int
+
+    @property
+    def throughput(self) -> float:
+        """Throughput in MB/s"""
+        return self.size / 1024 ** 2 / max(self.seconds, 1e-9)
+
+
+def is_cold(path: str, cold_storage: List[str]) -> bool:
+    """
+    Return True if the given path lies within a cold storage mount point.
+    Blank mount points are ignored.
+
+    Example:
+    >>> is_cold("/mnt/cold/A.fq.gz", ["/mnt/cold"])
+    True
+    >>> is_cold("/mnt/colder/A.fq.gz", ["/mnt/cold", " "])
+    False
+    """
+    path = os.path.abspath(path)
+    return any(
+        os.path.commonpath([path, os.path.abspath(mount)])
+        == os.path.abspath(mount)
+        for mount in cold_storage
+        if mount.strip()
+    )
+
+
+def test_is_cold() -> None:
+    """
+    This function tests the cold storage detection
+
+    Example:
+    pytest -v ./stage_fastq.py -k test_is_cold
+    """
+    assert is_cold("/mnt/cold/A.fq.gz", ["/mnt/cold"])
+    assert is_cold("/mnt/cold/run/A.fq.gz", ["/mnt/hot", "/mnt/cold/"])
+    assert not is_cold("/mnt/colder/A.fq.gz", ["/mnt/cold"])
+    assert not is_cold("/mnt/cold/A.fq.gz", [" "])
+
+
+# File systems supporting the FICLONE ioctl
+REFLINK_FS = {"btrfs", "xfs", "ocfs2", "bcachefs"}
+
+# Network and parallel file systems: their files are copied, not symlinked,
+# so that IO intensive jobs do not read them
+NETWORK_FS = {
+    "nfs", "nfs4", "cifs", "smb3", "beegfs", "lustre", "gpfs"
+}
+
+
+def read_mounts(mountinfo: str = "/proc/self/mounts") -> List[Tuple[str, str]]:
+    """
+    Return the (mount point, file system type) of the mounted file systems,
+    from the deepest to the shallowest mount point
+    """
+    mounts = []
+    try:
+        with open(mountinfo) as mounts_file:
+            for line in mounts_file:
+                fields = line.split()
+                if len(fields) >= 3:
+                    # Spaces in mount points are octal escaped
+                    mount = fields[1].replace("\\040", " ")
+                    mounts.append((mount, fields[2]))
+    except FileNotFoundError:
+        logging.debug(f"{mountinfo} not available, assuming a single mount")
+    return sorted(mounts, key=lambda mount: len(mount[0]), reverse=True)
+
+
+def mount_of(path: str, mounts: List[Tuple[str, str]]) -> Tuple[str, str]:
+    """
+    Return the (mount point, file system type) holding the given path,
+    once symlinks are resolved
+
+    Example:
+    >>> mount_of("/mnt/cold/A.fq.gz", [("/mnt/cold", "nfs"), ("/", "ext4")])
+    ('/mnt/cold', 'nfs')
+    """
+    path = os.path.realpath(path)
+    for mount, fstype in mounts:
+        # Plain prefix test: os.path.commonpath is slow on large designs
+        if path == mount or path.startswith(mount.rstrip("/") + "/"):
+            return mount, fstype
+    return "/", "unknown"
+
+
+def staging_method(
+    source: str,
+    workdir: str,
+    cold_storage: List[str],
+    mounts: List[Tuple[str, str]]
+) -> str:
+    """
+    Return the cheapest safe way to make source available in workdir:
+
+    * reflink: both paths lie on the same reflink-capable file system.
+      No data is read nor written, and the staged file stays valid even if
+      the source is modified or removed.
+    * copy: the source lies on cold storage, or on a network file system,
+      which must not be used by IO intensive processes.
+    * symlink: the source already lies on local hot storage.
+
+    Cold storage is recognized from the given paths, and from the mount
+    points of these paths (catching symlinks and bind mounts).
+
+    Example:
+    >>> mounts = [("/mnt/cold", "nfs"), ("/scratch", "xfs"), ("/", "ext4")]
+    >>> staging_method("/mnt/cold/A.fq.gz", "/scratch/run", [" "], mounts)
+    'copy'
+    >>> staging_method("/home/A.fq.gz", "/scratch/run", [" "], mounts)
+    'symlink'
+    >>> staging_method("/mnt/cold/A.fq.gz", "/scratch/run", ["/mnt/cold"],
+    ...                mounts)
+    'copy'
+    >>> staging_method("/scratch/A.fq.gz", "/scratch/run", [" "], mounts)
+    'reflink'
+    """
+    source_mount, source_fstype = mount_of(source, mounts)
+    workdir_mount, _ = mount_of(workdir, mounts)
+    if source_mount == workdir_mount and source_fstype in REFLINK_FS:
+        return "reflink"
+
+    cold_mounts = {
+        mount_of(path, mounts)[0] for path in cold_storage if path.strip()
+    }
+    if source_fstype in NETWORK_FS or is_cold(
+        os.path.realpath(source), cold_storage
+    ) or (source_mount in cold_mounts and source_mount != "/"):
+        return "copy"
+    return "symlink"
+
+
+def test_staging_method(tmp_path: Path) -> None:
+    """
+    This function tests the staging policy
+
+    Example:
+    pytest -v ./stage_fastq.py -k test_staging_method
+    """
+    mounts = [("/mnt/cold", "nfs"), ("/scratch", "xfs"), ("/", "ext4")]
+    assert staging_method("/mnt/cold/A.fq.gz", "/scratch", [" "], mounts) \
+        == "copy"
+    for fstype in ["cifs", "beegfs", "lustre", "gpfs"]:
+        assert staging_method("/mnt/hpc/A.fq.gz", "/scratch", [" "], [
+            ("/mnt/hpc", fstype), ("/", "ext4")
+        ]) == "copy"
+    assert staging_method("/mnt/cold/A.fq.gz", "/scratch", ["/mnt/cold/run"],
+                          mounts) == "copy"
+    assert staging_method("/scratch/A.fq.gz", "/scratch/run", ["/scratch"],
+                          mounts) == "reflink"
+    assert staging_method("/home/A.fq.gz", "/scratch/run", ["/mnt/cold"],
+                          mounts) == "symlink"
+
+    # Symlinks to cold storage are resolved
+    (tmp_path / "cold").mkdir()
+    (tmp_path / "cold" / "A.fq.gz").touch()
+    (tmp_path / "A.fq.gz").symlink_to(tmp_path / "cold" / "A.fq.gz")
+    assert staging_method(str(tmp_path / "A.fq.gz"), "/scratch",
+                          [str(tmp_path / "cold")], mounts) == "copy"
+
+
+def copy_file(source: str, dest: str, buffer_size: int = BUFFER_SIZE) -> int:
+    """
+    Copy source to dest, and return the number of copied bytes. In-kernel
+    copies (copy_file_range, then sendfile) are preferred, a userspace copy
+    through a page-aligned buffer is used as a last resort.
+    """
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+
+        for name in ["copy_file_range", "sendfile"]:
+            kernel_copy = getattr(os, name, None)
+            if kernel_copy is None:
+                continue
+
+            copied = 0
+            try:
+                while copied < size:
+                    if name == "sendfile":
+                        sent = kernel_copy(
+                            dst.fileno(), src.fileno(), copied, buffer_size
+                        )
+                    else:
+                        sent = kernel_copy(
+                            src.fileno(), dst.fileno(), buffer_size
+                        )
+                    if sent == 0:
+                        break
+                    copied += sent
+                return copied
+            except OSError as error:
+                if error.errno not in UNSUPPORTED:
+                    raise
+                logging.debug(f"{name} not supported for {source}")
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+
+        copied = 0
+        with mmap.mmap(-1, buffer_size) as buffer:
+            view = memoryview(buffer)
+            while True:
+                read = src.readinto(view)
+                if not read:
+                    break
+                dst.write(view[:read])
+                copied += read
+            view.release()
+        return copied
+
+
+def test_copy_file(tmp_path: Path, monkeypatch: Any) -> None:
+    """
+    This function tests copies larger than the copy buffer, with and
+    without in-kernel copies
+
+    Example:
+    pytest -v ./stage_fastq.py -k test_copy_file
+    """
+    source = tmp_path / "A.fq.gz"
+    source.write_bytes(os.urandom(10000))
+    assert copy_file(str(source), str(tmp_path / "B.fq.gz"), 4096) == 10000
+    assert (tmp_path / "B.fq.gz").read_bytes() == source.read_bytes()
+
+    monkeypatch.delattr(os, "copy_file_range", raising=False)
+    monkeypatch.delattr(os, "sendfile", raising=False)
+    assert copy_file(str(source), str(tmp_path / "C.fq.gz"), 4096) == 10000
+    assert (tmp_path / "C.fq.gz").read_bytes() == source.read_bytes()
+
+
+def stage_file(
+    source: str,
+    dest: str,
+    method: str,
+    retries: int = 3,
+    backoff: float = 5.0,
+    copier: Callable[[str, str], Any] = copy_file
+) -> StagingReport:
+    """
+    Stage the source file with the given method: symlink, reflink or copy.
+    Reflinks fall back to copies when the file system refuses them. Failed
+    copies are retried up to `retries` times, waiting
+    backoff * 2 ** attempt seconds between attempts.
+    """
+    if os.path.lexists(dest):
+        os.unlink(dest)
+
+    start = time.perf_counter()
+    if method == "symlink":
+        os.symlink(os.path.abspath(source), dest)
+        return StagingReport(
+            source, dest, method, 0, time.perf_counter() - start, 1
+        )
+
+    if method == "reflink":
+        try:
+            reflink(source, dest)
+            return StagingReport(
+                source,
+                dest,
+                method,
+                os.stat(dest).st_size,
+                time.perf_counter() - start,
+                1
+            )
+        except OSError as error:
+            logging.warning(f"Could not reflink {source} ({error}), copying")
+            method = "copy"
+
+    for attempt in range(retries + 1):
+        try:
+            copier(source, dest)
+            break
+        except OSError as error:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            logging.warning(
+                f"Copy of {source} failed ({error}), retrying in {delay}s"
+            )
+            time.sleep(delay)
+
+    return StagingReport(
+        source,
+        dest,
+        method,
+        os.stat(dest).st_size,
+        time.perf_counter() - start,
+        attempt + 1
+    )
+
+
+def test_stage_file(tmp_path: Path) -> None:
+    """
+    This function tests symlinks, copies and retries
+
+    Example:
+    pytest -v ./stage_fastq.py -k test_stage_file
+    """
+    import pytest  # Unit testing, not needed by Snakemake
+
+    (tmp_path / "cold").mkdir()
+    source = tmp_path / "cold" / "A.fq.gz"
+    source.write_bytes(b"@r1\nACGT\n+\nIIII\n")
+
+    report = stage_file(str(source), str(tmp_path / "hot.fq.gz"), "symlink")
+    assert report.method == "symlink"
+    assert os.path.islink(tmp_path / "hot.fq.gz")
+
+    # Reflinks are either supported, or replaced by copies
+    report = stage_file(str(source), str(tmp_path / "ref.fq.gz"), "reflink")
+    assert report.method in {"reflink", "copy"}
+    assert (tmp_path / "ref.fq.gz").read_bytes() == source.read_bytes()
+
+    failures = []
+
+    def flaky_copy(src: str, dst: str) -> int:
+        if len(failures) < 2:
+            failures.append(src)
+            raise OSError(errno.EIO, "Input/output error")
+        return copy_file(src, dst)
+
+    report = stage_file(
+        str(source),
+        str(tmp_path / "cold.fq.gz"),
+        "copy",
+        retries=2,
+        backoff=0,
+        copier=flaky_copy
+    )
+    assert (report.method, report.attempts, report.size) == ("copy", 3, 16)
+    assert not os.path.islink(tmp_path / "cold.fq.gz")
+
+    with pytest.raises(OSError):
+        failures.clear()
+        stage_file(
+            str(source),
+            str(tmp_path / "cold.fq.gz"),
+            "copy",
+            retries=1,
+            backoff=0,
+            copier=flaky_copy
+        )
+
+
+def stage_files(
+    sources: List[str],
+    dests: List[str],
+    methods: List[str],
+    threads: int = 4,
+    retries: int = 3,
+    backoff: float = 5.0,
+    copier: Callable[[str, str], Any] = copy_file
+) -> List[StagingReport]:
+    """
+    Stage all files on a pool of threads. Every file is attempted, and a
+    single error listing all failed files is raised at the end.
+    """
+    reports, failures = [], []
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        futures = {
+            pool.submit(
+                stage_file,
+                source,
+                dest,
+                method,
+                retries,
+                backoff,
+                copier
+            ): source
+            for source, dest, method in zip(sources, dests, methods)
+        }
+        for future in as_completed(futures):
+            try:
+                report = future.result()
+            except OSError as error:
+                logging.error(f"Could not stage {futures[future]}: {error}")
+                failures.append(futures[future])
+                continue
+
+            logging.info(
+                f"{report.source}: {report.method}, {report.size} bytes "
+                f"in {report.seconds:.1f}s ({report.throughput:.1f} MB/s)"
+            )
+            reports.append(report)
+
+    if failures:
+        raise OSError(f"Could not stage: {', '.join(failures)}")
+    return reports
+
+
+def write_report(reports: List[StagingReport], path: str) -> None:
+    """
+    Save staging reports as a TSV file
+    """
+    with open(path, "w") as tsv:
+        tsv.write(
+            "source\tdest\tmethod\tbytes\tseconds\tMB_per_s\tattempts\n"
+        )
+        for report in reports:
+            tsv.write(
+                f"{report.source}\t{report.dest}\t{report.method}\t"
+                f"{report.size}\t{report.seconds:.3f}\t"
+                f"{report.throughput:.1f}\t{report.attempts}\n"
+            )
+
+
+def test_main_copy_cache(tmp_path: Path) -> None:
+    """
+    This function tests that copies are served by the copy cache, with
+    the requested fingerprint and serving mode
+
+    Example:
+    pytest -v ./stage_fastq.py -k test_main_copy_cache
+    """
+    source = tmp_path / "A.fq.gz"
+    source.write_bytes(b"@r1\nACGT\n+\nIIII\n")
+    dest = tmp_path / "raw_data" / "A.fastq.gz"
+    main(parse_args([
+        "--input", str(source), "--output", str(dest), "--methods", "copy",
+        "--cache", str(tmp_path / "cache"), "--cache-hash-edges",
+        "--cache-link", "copy", "--report", str(tmp_path / "report.tsv")
+    ]))
+    assert dest.read_bytes() == source.read_bytes()
+    assert dest.stat().st_nlink == 1
+    entries = CopyCache(str(tmp_path / "cache")).read_index()
+    assert [entry["digest"] is not None for entry in entries.values()] == [
+        True
+    ]
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--input",
+        help="Paths to the original fastq files",
+        type=str,
+        nargs="+",
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--output",
+        help="Paths to the staged fastq files, in the same order",
+        type=str,
+        nargs="+",
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--cold-storage",
+        help="Cold storage mount points, their files are copied unless "
+             "they can be reflinked (default: %(default)s)",
+        type=str,
+        nargs="+",
+        default=[" "],
+    )
+
+    main_parser.add_argument(
+        "--methods",
+        help="Staging method of each file, in the same order as --input: "
+             "symlink, reflink or copy (default: decided from "
+             "--cold-storage and mount points)",
+        type=str,
+        nargs="+",
+        choices=["symlink", "reflink", "copy"],
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of concurrent copies (default: %(default)s)",
+        type=int,
+        default=4,
+    )
+
+    main_parser.add_argument(
+        "--retries",
+        help="Number of retries per file (default: %(default)s)",
+        type=int,
+        default=3,
+    )
+
+    main_parser.add_argument(
+        "--backoff",
+        help="Delay before the first retry, in seconds. It doubles "
+             "at each retry (default: %(default)s)",
+        type=float,
+        default=5.0,
+    )
+
+    main_parser.add_argument(
+        "--cache",
+        help="Path to a copy cache directory (see copy_cache.py), copies "
+             "are served from this cache when possible (default: no cache)",
+        type=str,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--cache-quota",
+        help="Maximum size of the copy cache, in GB (default: unlimited)",
+        type=float,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--cache-hash-edges",
+        help="Also identify cached files with a hash of their first and "
+             "last MB (see copy_cache.py)",
+        default=False,
+        action="store_true",
+    )
+
+    main_parser.add_argument(
+        "--cache-link",
+        help="How cached files are served (default: %(default)s)",
+        type=str,
+        choices=["hardlink", "reflink", "copy"],
+        default="hardlink",
+    )
+
+    main_parser.add_argument(
+        "--report",
+        help="Path to the TSV staging report (default: %(default)s)",
+        type=str,
+        default="staging.tsv",
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function stages the whole batch of files
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    if len(args.input) != len(args.output):
+        raise ValueError("As many --input as --output files are expected")
+
+    for dest in args.output:
+        Path(dest).parent.mkdir(parents=True, exist_ok=True)
+
+    methods = args.methods
+    if methods is None:
+        mounts = read_mounts()
+        workdir = os.path.dirname(os.path.abspath(args.output[0]))
+        methods = [
+            staging_method(source, workdir, args.cold_storage, mounts)
+            for source in args.input
+        ]
+    elif len(methods) != len(args.input):
+        raise ValueError("As many --methods as --input files are expected")
+
+    copier = copy_file
+    if args.cache is not None:
+        quota = args.cache_quota
+        cache = CopyCache(
+            args.cache,
+            None if quota is None else int(quota * 1024 ** 3),
+            hash_edges=args.cache_hash_edges,
+            copier=copy_file
+        )
+        copier = functools.partial(cache.fetch, mode=args.cache_link)
+
+    reports = stage_files(
+        args.input,
+        args.output,
+        methods,
+        args.threads,
+        args.retries,
+        args.backoff,
+        copier
+    )
+    write_report(reports, args.report)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,436 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script runs a command, usually fastq_screen, with the screening
+indexes staged on node-local storage, such as /dev/shm, instead of the
+parallel file system.
+
+The databases of a fastq_screen configuration are copied once per node:
+jobs running on the same node, at the same time or one after each other,
+share the same copies. A lock per index guards its copy, and the process
+ids of the jobs using each index are recorded. Copies are kept when their
+jobs end: a copy is removed only when no living job uses it, and no job
+used it for --max-idle hours. Copies of indexes modified since are never
+used again, and are removed the same way. A fastq_screen configuration
+pointing to local copies is written for the command.
+
+Copies in /dev/shm are held in RAM, which no job reserves. With --max-gb,
+unused copies are removed, least recently used first, so that all copies
+fit in this number of GB. Copies in use are never removed.
+
+You can test this script with:
+pytest -v ./stage_screen_index.py
+
+Usage example:
+python3.8 ./stage_screen_index.py --config fastq_screen_config.tsv \
+    --local /dev/shm/ngs-cleaning --local-config local_screen.conf \
+    -- fastq_screen --conf local_screen.conf batch_0.fastq
+"""
+
+import argparse  # Parse command line
+import fcntl  # File locks
+import hashlib  # Name staged indexes
+import json  # Handle references
+import logging  # Traces and loggings
+import os  # OS related activities
+import shutil  # Copy files
+import subprocess  # Run the command
+import sys  # System related methods
+import time  # Idle times of copies
+
+from contextlib import contextmanager  # Lock context
+from pathlib import Path  # Paths related methods
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from common_script_ngs_cleaning import CustomFormatter
+
+
+# Local copies unused for longer than this, in hours, are removed
+MAX_IDLE_HOURS = 1
+
+
+def read_databases(conf: Path) -> List[Tuple[str, str]]:
+    """
+    Return the name and the index prefix of each database listed in a
+    fastq_screen configuration file
+    """
+    databases = []
+    with conf.open() as config:
+        for line in config:
+            fields = line.split()
+            if fields and fields[0] == "DATABASE":
+                databases.append((fields[1], fields[2]))
+    return databases
+
+
+def index_files(prefix: str) -> List[Path]:
+    """
+    Return the files of an aligner index, given its prefix
+    """
+    prefix_path = Path(prefix)
+    files = sorted(
+        path for path in prefix_path.parent.glob(f"{prefix_path.name}.*")
+        if path.is_file()
+    )
+    if not files:
+        raise FileNotFoundError(f"No index file found with prefix {prefix}")
+    return files
+
+
+def index_key(name: str, prefix: str) -> str:
+    """
+    Return the name of the local copy of an index: the database name and
+    a hash of its files paths, sizes and modification times. Modified
+    indexes are staged again.
+    """
+    hasher = hashlib.sha1()
+    for path in index_files(prefix):
+        stat = path.stat()
+        hasher.update(
+            f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return f"{name}-{hasher.hexdigest()[:12]}"
+
+
+@contextmanager
+def locked(lock_path: Path) -> Iterator[None]:
+    """
+    Hold an exclusive lock on the given file
+    """
+    with lock_path.open("w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def pid_alive(pid: int) -> bool:
+    """
+    Return True if a process with the given id is running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class IndexStage:
+    """
+    Node-local copies of screening indexes, shared by the jobs of a node.
+
+    refs.json maps the name of each local copy to the process ids of the
+    jobs using it. Ids of dead processes are dropped, so that a crashed
+    job does not pin an index forever. The modification time of a copy is
+    the last time a job acquired or released it.
+    """
+
+    def __init__(self, root: Path, pid: Optional[int] = None) -> None:
+        self.root = Path(root)
+        self.pid = os.getpid() if pid is None else pid
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def references(self) -> Iterator[Dict[str, List[int]]]:
+        """
+        Load the references under a lock, and save them back on exit
+        """
+        refs_path = self.root / "refs.json"
+        with locked(self.root / "refs.lock"):
+            try:
+                refs = json.loads(refs_path.read_text())
+            except FileNotFoundError:
+                refs = {}
+            for key in refs:
+                refs[key] = [pid for pid in refs[key] if pid_alive(pid)]
+            yield refs
+            tmp_refs = refs_path.with_suffix(f".{os.getpid()}.tmp")
+            tmp_refs.write_text(json.dumps(refs, indent=1, sort_keys=True))
+            os.replace(tmp_refs, refs_path)
+
+    def acquire(
+        self, name: str, prefix: str, max_gb: Optional[float] = None
+    ) -> str:
+        """
+        Register this job as a user of an index, copy it if no job did it
+        before, and return the prefix of the local copy. Unused copies are
+        removed first if the new copy would not fit in max_gb.
+        """
+        key = index_key(name, prefix)
+        with self.references() as refs:
+            refs.setdefault(key, []).append(self.pid)
+            if max_gb is not None and not (self.root / key).exists():
+                needed_gb = sum(
+                    path.stat().st_size for path in index_files(prefix)
+                ) / 1024 ** 3
+                self.cleanup(refs, None, max_gb, needed_gb)
+
+        local_dir = self.root / key
+        with locked(self.root / f"{key}.lock"):
+            if not local_dir.exists():
+                logging.info(f"Staging {name} index from {prefix}")
+                tmp_dir = self.root / f"{key}.{os.getpid()}.tmp"
+                tmp_dir.mkdir()
+                for path in index_files(prefix):
+                    shutil.copyfile(path, tmp_dir / path.name)
+                os.replace(tmp_dir, local_dir)
+            else:
+                logging.info(f"{name} index already staged in {local_dir}")
+                os.utime(local_dir)
+        return str(local_dir / Path(prefix).name)
+
+    def release(
+        self,
+        name: str,
+        prefix: str,
+        max_idle_hours: float = MAX_IDLE_HOURS,
+        max_gb: Optional[float] = None
+    ) -> None:
+        """
+        Unregister this job as a user of an index, keeping its local copy,
+        and remove the copies no job used for max_idle_hours, or which do
+        not fit in max_gb
+        """
+        key = index_key(name, prefix)
+        with self.references() as refs:
+            refs[key] = [pid for pid in refs.get(key, []) if pid != self.pid]
+            if (self.root / key).exists():
+                os.utime(self.root / key)
+            self.cleanup(refs, max_idle_hours, max_gb)
+
+    def cleanup(
+        self,
+        refs: Dict[str, List[int]],
+        max_idle_hours: Optional[float],
+        max_gb: Optional[float] = None,
+        needed_gb: float = 0
+    ) -> None:
+        """
+        Remove the local copies which no living job uses, and which were
+        not used for max_idle_hours. Then, remove unused copies, least
+        recently used first, until all copies and needed_gb fit in max_gb.
+        Called with the references locked: jobs register themselves before
+        looking for a copy.
+        """
+        copies = sorted(
+            (
+                local_dir for local_dir in self.root.iterdir()
+                if local_dir.is_dir() and not local_dir.name.endswith(".tmp")
+            ),
+            key=lambda local_dir: local_dir.stat().st_mtime
+        )
+        sizes = {
+            local_dir.name: sum(
+                path.stat().st_size for path in local_dir.iterdir()
+            ) / 1024 ** 3
+            for local_dir in copies
+        }
+        total_gb = sum(sizes.values()) + needed_gb
+        idle_since = time.time() - (max_idle_hours or 0) * 3600
+        for local_dir in copies:
+            key = local_dir.name
+            if refs.get(key):
+                continue
+            idle = (
+                max_idle_hours is not None
+                and local_dir.stat().st_mtime <= idle_since
+            )
+            if idle or (max_gb is not None and total_gb > max_gb):
+                logging.info(f"Removing the unused local copy {key}")
+                shutil.rmtree(local_dir, ignore_errors=True)
+                refs.pop(key, None)
+                total_gb -= sizes[key]
+        if max_gb is not None and total_gb > max_gb:
+            logging.warning(
+                f"Local copies in use need {total_gb:.1f} GB, over the "
+                f"{max_gb} GB quota"
+            )
+
+
+def write_local_config(
+    conf: Path, local_prefixes: Dict[str, str], local_conf: Path
+) -> None:
+    """
+    Write a copy of a fastq_screen configuration, with database prefixes
+    pointing to their local copies
+    """
+    lines = []
+    with conf.open() as config:
+        for line in config:
+            fields = line.split()
+            if fields and fields[0] == "DATABASE":
+                fields[2] = local_prefixes[fields[1]]
+                line = "\t".join(fields) + "\n"
+            lines.append(line)
+    local_conf.parent.mkdir(parents=True, exist_ok=True)
+    local_conf.write_text("".join(lines))
+
+
+def test_index_stage(tmp_path: Path) -> None:
+    """
+    This function tests index copies, sharing and reference counting
+
+    Example:
+    pytest -v ./stage_screen_index.py -k test_index_stage
+    """
+    beegfs = tmp_path / "beegfs" / "PhiX"
+    beegfs.mkdir(parents=True)
+    for suffix in ["1.bt2", "rev.1.bt2"]:
+        (beegfs / f"phix.{suffix}").write_text(suffix)
+    prefix = str(beegfs / "phix")
+    conf = tmp_path / "fastq_screen.conf"
+    conf.write_text(f"BOWTIE2\tbowtie2\nDATABASE\tPhiX\t{prefix}\n")
+    assert read_databases(conf) == [("PhiX", prefix)]
+
+    local = tmp_path / "shm"
+    first = IndexStage(local, pid=os.getpid())
+    # The parent process stands for another living job of the node
+    second = IndexStage(local, pid=os.getppid())
+    local_prefix = first.acquire("PhiX", prefix)
+    assert second.acquire("PhiX", prefix) == local_prefix
+    assert Path(f"{local_prefix}.rev.1.bt2").read_text() == "rev.1.bt2"
+
+    local_conf = tmp_path / "local.conf"
+    write_local_config(conf, {"PhiX": local_prefix}, local_conf)
+    assert local_conf.read_text().split("\n")[1] == (
+        f"DATABASE\tPhiX\t{local_prefix}"
+    )
+
+    # Copies are kept for the next jobs of the node
+    first.release("PhiX", prefix)
+    second.release("PhiX", prefix)
+    assert Path(f"{local_prefix}.1.bt2").exists()
+    assert first.acquire("PhiX", prefix) == local_prefix
+
+    # Copies idle for too long are removed, once no job uses them
+    second.acquire("PhiX", prefix)
+    first.release("PhiX", prefix, max_idle_hours=0)
+    assert Path(f"{local_prefix}.1.bt2").exists()
+    second.release("PhiX", prefix, max_idle_hours=0)
+    assert not Path(f"{local_prefix}.1.bt2").exists()
+
+    # Unused copies are removed, least recently used first, to fit a quota
+    other = tmp_path / "beegfs" / "Human"
+    other.mkdir()
+    (other / "human.1.bt2").write_bytes(b"\0" * 1024)
+    human_prefix = first.acquire("Human", str(other / "human"))
+    first.release("Human", str(other / "human"))
+    phix_prefix = first.acquire("PhiX", prefix, max_gb=0.5 / 1024 ** 2)
+    assert not Path(f"{human_prefix}.1.bt2").exists()
+    first.release("PhiX", prefix, max_gb=0)
+    assert not Path(f"{phix_prefix}.1.bt2").exists()
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--config",
+        help="Path to the fastq_screen configuration file",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--local",
+        help="Node-local directory where indexes are staged "
+             "(default: %(default)s)",
+        type=Path,
+        default=Path("/dev/shm/ngs-cleaning"),
+    )
+
+    main_parser.add_argument(
+        "--local-config",
+        help="Path to the fastq_screen configuration file to write, "
+             "pointing to local copies of indexes",
+        type=Path,
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--max-idle",
+        help="Remove local copies of indexes which no job used for this "
+             "number of hours (default: %(default)s)",
+        type=float,
+        default=MAX_IDLE_HOURS,
+    )
+
+    main_parser.add_argument(
+        "--max-gb",
+        help="Remove unused local copies, least recently used first, so "
+             "that all copies fit in this number of GB (default: no limit)",
+        type=float,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "command",
+        help="Command to run with local indexes, after --",
+        type=str,
+        nargs=argparse.REMAINDER,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function stages indexes, runs the command and releases indexes
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command:
+        raise ValueError("No command to run with local indexes")
+
+    stage = IndexStage(args.local)
+    databases = read_databases(args.config)
+    acquired = []
+    try:
+        local_prefixes = {}
+        for name, prefix in databases:
+            local_prefixes[name] = stage.acquire(name, prefix, args.max_gb)
+            acquired.append((name, prefix))
+        write_local_config(args.config, local_prefixes, args.local_config)
+        logging.info(f"Running {' '.join(command)}")
+        subprocess.run(command, check=True)
+    finally:
+        for name, prefix in acquired:
+            stage.release(name, prefix, args.max_idle, args.max_gb)
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
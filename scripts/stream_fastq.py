@@ -0,0 +1,239 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script streams the raw reads of a sample to the standard output, as
+a single uncompressed fastq stream: lanes of each mate are read one after
+each other, and mates are interleaved. This is what fastp expects with
+--stdin --interleaved_in.
+
+In streaming mode, raw reads are read once from their storage, and
+trimmed without being written to the working directory first. fastp is
+not given named pipes as --in1/--in2: it opens its inputs more than once
+(read length evaluation, adapter detection), which a pipe does not allow.
+
+Mates are decompressed by two threads. The script fails if a lane ends
+with an incomplete record, or if mates differ in record counts: in a
+shell pipeline, the trimming job then fails too.
+
+You can test this script with:
+pytest -v ./stream_fastq.py
+
+Usage example:
+python3.8 ./stream_fastq.py --r1 S1_L1_R1.fq.gz S1_L2_R1.fq.gz \
+    --r2 S1_L1_R2.fq.gz S1_L2_R2.fq.gz \
+    | fastp --stdin --interleaved_in --stdout ...
+"""
+
+import argparse  # Parse command line
+import gzip  # Build test files
+import io  # In-memory streams in tests
+import logging  # Traces and loggings
+import sys  # System related methods
+
+from concurrent.futures import ThreadPoolExecutor  # Read mates together
+from pathlib import Path  # Paths related methods
+from typing import Any, BinaryIO, Iterator, List  # Type hints
+
+from common_script_ngs_cleaning import CustomFormatter
+from fastq_codecs import open_input
+
+
+# Size of decompressed blocks read at once
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def record_lines(
+    paths: List[Path], block_size: int = BLOCK_SIZE
+) -> Iterator[List[bytes]]:
+    """
+    Yield the lines of the lanes of a mate, without their new lines, by
+    batches of complete records. A lane may lack its final new line.
+    """
+    lines: List[bytes] = []
+    for path in paths:
+        with open_input(path) as handle:
+            rest = b""
+            while True:
+                block = handle.read(block_size)
+                if block:
+                    lines.extend((rest + block).split(b"\n"))
+                    rest = lines.pop()
+                elif rest:
+                    lines.append(rest)
+                end = len(lines) - len(lines) % 4
+                if end:
+                    yield lines[:end]
+                    lines = lines[end:]
+                if not block:
+                    break
+    if lines:
+        raise ValueError(f"{paths[-1]} ends with an incomplete record")
+
+
+def interleave(
+    mates: List[List[Path]],
+    output: BinaryIO,
+    block_size: int = BLOCK_SIZE
+) -> int:
+    """
+    Write the records of one or two mates in the output, mates being
+    interleaved, and return the number of records per mate
+
+    Parameters:
+        mates           List[List[Path]]    Lanes of each mate
+        output          BinaryIO            Uncompressed fastq stream
+        block_size      int                 Bytes read at once per mate
+
+    Return:
+                        int                 Number of records per mate
+    """
+    batches = [record_lines(lanes, block_size) for lanes in mates]
+    pending: List[List[bytes]] = [[] for _ in mates]
+    records = 0
+    with ThreadPoolExecutor(max_workers=len(mates)) as executor:
+        while True:
+            blocks = list(executor.map(lambda lines: next(lines, []), batches))
+            if not any(blocks):
+                break
+            for lines, block in zip(pending, blocks):
+                lines.extend(block)
+
+            # Lines of complete records, present in all mates
+            end = min(map(len, pending))
+            if len(mates) == 1:
+                out = pending[0]
+            else:
+                out = [b""] * (2 * end)
+                for line in range(4):
+                    out[line::8] = pending[0][line:end:4]
+                    out[4 + line::8] = pending[1][line:end:4]
+            if out:
+                output.write(b"\n".join(out) + b"\n")
+            records += end // 4
+            pending = [lines[end:] for lines in pending]
+
+    if any(pending):
+        raise ValueError(
+            f"Mates differ in records: {records} records were interleaved, "
+            + ", ".join(
+                f"R{mate} has {len(lines) // 4} more"
+                for mate, lines in enumerate(pending, 1)
+            )
+        )
+    return records
+
+
+def test_interleave(tmp_path: Path) -> None:
+    """
+    This function tests the interleaving of lanes and mates, and the
+    detection of mismatching mates
+
+    Example:
+    pytest -v ./stream_fastq.py -k test_interleave
+    """
+    import pytest  # Unit testing
+
+    def records(mate: int, reads: range) -> bytes:
+        return b"".join(
+            b"@r%d/%d\nACGT\n+\nIIII\n" % (read, mate) for read in reads
+        )
+
+    lanes = {
+        "L1_R1.fq.gz": gzip.compress(records(1, range(5))),
+        "L2_R1.fq": records(1, range(5, 12))[:-1],
+        "L1_R2.fq.gz": gzip.compress(records(2, range(12))),
+    }
+    for name, content in lanes.items():
+        (tmp_path / name).write_bytes(content)
+    r1 = [tmp_path / "L1_R1.fq.gz", tmp_path / "L2_R1.fq"]
+    r2 = [tmp_path / "L1_R2.fq.gz"]
+
+    output = io.BytesIO()
+    assert interleave([r1, r2], output, block_size=50) == 12
+    expected = b"".join(
+        records(1, range(read, read + 1)) + records(2, range(read, read + 1))
+        for read in range(12)
+    )
+    assert output.getvalue() == expected
+
+    output = io.BytesIO()
+    assert interleave([r1], output, block_size=7) == 12
+    assert output.getvalue() == records(1, range(12))
+
+    with pytest.raises(ValueError, match="Mates differ in records"):
+        interleave([r1[:1], r2], io.BytesIO())
+
+    (tmp_path / "L2_R1.fq").write_bytes(records(1, range(5, 12))[:-8])
+    with pytest.raises(ValueError, match="incomplete record"):
+        interleave([r1], io.BytesIO())
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "--r1",
+        help="Lanes of the first mate (or single-end reads) of a sample",
+        type=Path,
+        nargs="+",
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--r2",
+        help="Lanes of the second mate of a sample, if any",
+        type=Path,
+        nargs="+",
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function streams the reads of a sample to the standard output
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    mates = [args.r1] if args.r2 is None else [args.r1, args.r2]
+    records = interleave(mates, sys.stdout.buffer)
+    sys.stdout.buffer.flush()
+    logging.info(f"{records} records streamed per mate")
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,481 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script draws a uniform random sample of reads from a fastq file, in
+a single streaming pass, with a fixed memory footprint.
+
+Reads are kept in a reservoir with Algorithm L (Li, 1994): the number of
+reads to skip before the next replacement is drawn at once, so that the
+random number generator is called for a tiny fraction of the reads only.
+
+The sample is written as an uncompressed (or fast gzipped) fastq file,
+small enough to be screened in seconds.
+
+In tee mode, the input stream (usually the standard output of fastp) is
+also written in full, with the codec of trimmed reads (see
+fastq_codecs.py): interleaved pairs are split into one file per mate, and
+pairs are sampled together.
+
+You can test this script with:
+pytest -v ./subsample_fastq.py
+
+Usage example:
+python3.8 ./subsample_fastq.py fastp/trimmed/S1.R1.fastq.gz \
+    --output fqscreen/subsample/S1.R1.fastq --reads 100000
+
+fastp --in1 S1_R1.fq.gz --in2 S1_R2.fq.gz --stdout \
+    | python3.8 ./subsample_fastq.py - \
+        --tee fastp/trimmed/S1.R1.fastq.gz fastp/trimmed/S1.R2.fastq.gz \
+        --output fqscreen/subsample/S1.R1.fastq fqscreen/subsample/S1.R2.fastq
+"""
+
+import argparse  # Parse command line
+import gzip  # Handle gzipped files
+import io  # In-memory outputs in tests
+import logging  # Traces and loggings
+import math  # Skip lengths
+import random  # Random replacements
+import sys  # System related methods
+
+from concurrent.futures import ThreadPoolExecutor  # Compress mates apart
+from itertools import zip_longest  # Detect incomplete records
+from pathlib import Path  # Paths related methods
+from typing import Any, BinaryIO, Iterator, List, Optional, Tuple
+
+from common_script_ngs_cleaning import CustomFormatter
+from concatenate_fastq import BUFFER_SIZE
+from fastq_codecs import CODECS, open_input, open_output
+
+
+# A fastq record: its four lines, new lines included
+Record = Tuple[bytes, bytes, bytes, bytes]
+
+# Number of records written at once in tee mode
+TEE_RECORDS = 10000
+
+
+class Reservoir:
+    """
+    A uniform random sample of at most `size` records, among all the
+    records added to it, following Algorithm L. An empty reservoir only
+    counts records.
+    """
+
+    def __init__(self, size: int, rng: Optional[random.Random] = None):
+        if size < 0:
+            raise ValueError(f"Cannot sample {size} reads: negative number")
+        self.size = size
+        self.rng = rng or random.Random(0)
+        self.records = []
+        self.seen = 0
+        self.weight = self.draw_weight()
+        self.next_index = size + self.draw_skip()
+
+    def draw_weight(self) -> float:
+        """
+        Return exp(log(U) / size), U being uniform over (0, 1]
+        """
+        return math.exp(math.log(1 - self.rng.random()) / max(self.size, 1))
+
+    def draw_skip(self) -> int:
+        """
+        Return the number of records to skip before the next replacement
+        """
+        if self.weight >= 1:
+            return sys.maxsize
+        return math.floor(
+            math.log(1 - self.rng.random()) / math.log(1 - self.weight)
+        )
+
+    def add(self, record: Record) -> None:
+        """
+        Consider a new record for the sample
+        """
+        if self.seen < self.size:
+            self.records.append(record)
+        elif self.size > 0 and self.seen == self.next_index:
+            self.records[self.rng.randrange(self.size)] = record
+            self.weight *= self.draw_weight()
+            self.next_index += self.draw_skip() + 1
+        self.seen += 1
+
+    def write(self, output: BinaryIO) -> None:
+        """
+        Write the sampled records in a binary stream
+        """
+        for record in self.records:
+            output.writelines(record)
+
+
+def iter_records(handle: BinaryIO) -> Iterator[Record]:
+    """
+    Iterate over the records of an opened fastq stream. Raises ValueError
+    if the stream ends within a record.
+    """
+    for record in zip_longest(*[iter(handle)] * 4):
+        if record[-1] is None:
+            raise ValueError("Fastq file is truncated: incomplete last record")
+        if not record[0].startswith(b"@"):
+            raise ValueError(f"Fastq record expected, got {record[0]!r}")
+        yield record
+
+
+def test_reservoir() -> None:
+    """
+    This function tests that reservoirs are bounded and uniform
+
+    Example:
+    pytest -v ./subsample_fastq.py -k test_reservoir
+    """
+    reservoir = Reservoir(10)
+    for index in range(5):
+        reservoir.add((b"@%d\n" % index, b"A\n", b"+\n", b"I\n"))
+    assert len(reservoir.records) == 5
+
+    # Each of 100 records should be kept about 400 times in 4000 draws
+    kept = [0] * 100
+    for seed in range(4000):
+        reservoir = Reservoir(10, random.Random(seed))
+        for index in range(100):
+            reservoir.add(index)
+        assert len(reservoir.records) == 10 == len(set(reservoir.records))
+        for index in reservoir.records:
+            kept[index] += 1
+    assert 320 < min(kept) and max(kept) < 480
+
+
+def subsample_fastq(
+    fq_file: Path,
+    output: BinaryIO,
+    reads: int,
+    rng: Optional[random.Random] = None
+) -> int:
+    """
+    Write a uniform random sample of `reads` reads of a fastq file, and
+    return the total number of reads
+
+    Example:
+    >>> with open("S1.R1.fastq", "wb") as sample:
+    ...     subsample_fastq(Path("S1.R1.fastq.gz"), sample, 100000)
+    2000000
+    """
+    reservoir = Reservoir(reads, rng)
+    with open_input(fq_file) as handle:
+        for record in iter_records(handle):
+            reservoir.add(record)
+    reservoir.write(output)
+    logging.info(f"{len(reservoir.records)} of {reservoir.seen} reads kept")
+    return reservoir.seen
+
+
+def test_subsample_fastq(tmp_path: Path) -> None:
+    """
+    This function tests the subsampling of a gzipped fastq file
+
+    Example:
+    pytest -v ./subsample_fastq.py -k test_subsample_fastq
+    """
+    fq_file = tmp_path / "reads.fq.gz"
+    with gzip.open(fq_file, "wb") as fq:
+        for read in range(1000):
+            fq.write(b"@r%d\nACGT\n+\nIIII\n" % read)
+
+    sample = tmp_path / "sample.fq"
+    with sample.open("wb") as output:
+        assert subsample_fastq(fq_file, output, 100) == 1000
+    lines = sample.read_bytes().split(b"\n")
+    assert len(lines) == 401
+    assert len(set(lines[0:-1:4])) == 100
+
+
+def tee_fastq(
+    handle: BinaryIO,
+    full_outputs: List[BinaryIO],
+    sample_outputs: List[BinaryIO],
+    reads: int,
+    rng: Optional[random.Random] = None
+) -> int:
+    """
+    Write all records of a (possibly interleaved) fastq stream in one
+    output per mate, and a sample of these records in other outputs.
+    Returns the number of records per mate. Raises ValueError if the last
+    records have no mates.
+
+    Each mate is compressed by its own thread: zlib releases the GIL.
+
+    Parameters:
+        handle          BinaryIO        Fastq stream, mates interleaved
+        full_outputs    List[BinaryIO]  All records, one output per mate
+        sample_outputs  List[BinaryIO]  Sampled records, one per mate
+        reads           int             Number of sampled records
+        rng             Random          Random number generator
+    """
+    mates = len(full_outputs)
+    reservoir = Reservoir(reads, rng)
+    records = iter_records(handle)
+    with ThreadPoolExecutor(max_workers=mates) as executor:
+        pending, batches = [], [[] for _ in range(mates)]
+        for group in zip_longest(*[records] * mates):
+            if group[-1] is None:
+                raise ValueError(
+                    f"Interleaved fastq stream ends with unpaired records, "
+                    f"after {reservoir.seen} complete groups of {mates}"
+                )
+            reservoir.add(group)
+            for mate, record in enumerate(group):
+                batches[mate].extend(record)
+            if len(batches[0]) >= 4 * TEE_RECORDS:
+                for future in pending:
+                    future.result()
+                pending = [
+                    executor.submit(output.write, b"".join(batch))
+                    for output, batch in zip(full_outputs, batches)
+                ]
+                batches = [[] for _ in range(mates)]
+        for future in pending:
+            future.result()
+        for output, batch in zip(full_outputs, batches):
+            output.write(b"".join(batch))
+
+    for mate, output in enumerate(sample_outputs):
+        for group in reservoir.records:
+            output.writelines(group[mate])
+    logging.info(f"{len(reservoir.records)} of {reservoir.seen} pairs kept")
+    return reservoir.seen
+
+
+def test_tee_fastq(tmp_path: Path) -> None:
+    """
+    This function tests the tee mode on interleaved pairs
+
+    Example:
+    pytest -v ./subsample_fastq.py -k test_tee_fastq
+    """
+    interleaved = tmp_path / "interleaved.fq"
+    with interleaved.open("wb") as fq:
+        for read in range(25):
+            fq.write(b"@r%d/1\nACGT\n+\nIIII\n" % read)
+            fq.write(b"@r%d/2\nTTGG\n+\nIIII\n" % read)
+
+    full = [tmp_path / f"R{mate}.fq.gz" for mate in [1, 2]]
+    sample = [tmp_path / f"R{mate}.fq" for mate in [1, 2]]
+    with interleaved.open("rb") as handle:
+        full_outputs = [gzip.open(path, "wb") for path in full]
+        sample_outputs = [path.open("wb") for path in sample]
+        assert tee_fastq(handle, full_outputs, sample_outputs, 10) == 25
+        for output in full_outputs + sample_outputs:
+            output.close()
+
+    with gzip.open(full[1], "rb") as mate:
+        lines = mate.read().split(b"\n")
+    assert len(lines) == 101 and set(lines[1:-1:4]) == {b"TTGG"}
+    names = [
+        [line[:-2] for line in path.read_bytes().split(b"\n")[0:-1:4]]
+        for path in sample
+    ]
+    assert len(names[0]) == 10 and names[0] == names[1]
+
+    # Command line, with the codec arguments of the pipeline rules
+    main(parse_args([
+        str(interleaved), "--tee", *map(str, full),
+        "--output", *map(str, sample), "--reads", "5",
+        "--codec", "gzip", "--level", "5"
+    ]))
+    with gzip.open(full[0], "rb") as mate:
+        assert len(mate.read().split(b"\n")) == 101
+    assert len(sample[1].read_bytes().split(b"\n")) == 21
+
+
+def test_subsample_errors(tmp_path: Path) -> None:
+    """
+    This function tests empty samples, truncated inputs and unpaired
+    records in tee mode
+
+    Example:
+    pytest -v ./subsample_fastq.py -k test_subsample_errors
+    """
+    import pytest  # Unit testing
+
+    fq_file = tmp_path / "reads.fq.gz"
+    with gzip.open(fq_file, "wb") as fq:
+        for read in range(1001):
+            fq.write(b"@r%d\nACGT\n+\nIIII\n" % read)
+
+    # No read sampled, all of them counted
+    sample = tmp_path / "sample.fq"
+    with sample.open("wb") as output:
+        assert subsample_fastq(fq_file, output, 0) == 1001
+    assert sample.read_bytes() == b""
+    full = [tmp_path / f"R{mate}.fq.gz" for mate in [1, 2]]
+    main(parse_args([
+        str(fq_file), "--tee", str(full[0]), "--output", str(sample),
+        "--reads", "0"
+    ]))
+    assert full[0].stat().st_size > 0 and sample.read_bytes() == b""
+    with sample.open("wb") as output, \
+            pytest.raises(ValueError, match="negative"):
+        subsample_fastq(fq_file, output, -1)
+
+    # Truncated gzip member, then incomplete last record
+    truncated = tmp_path / "truncated.fq.gz"
+    truncated.write_bytes(fq_file.read_bytes()[:-20])
+    with sample.open("wb") as output, pytest.raises(EOFError):
+        subsample_fastq(truncated, output, 10)
+    truncated = tmp_path / "truncated.fq"
+    truncated.write_bytes(b"@r1\nACGT\n+\nIIII\n@r2\nACGT\n")
+    with sample.open("wb") as output, \
+            pytest.raises(ValueError, match="truncated"):
+        subsample_fastq(truncated, output, 10)
+
+    # Odd number of interleaved records
+    with open_input(fq_file) as handle, \
+            pytest.raises(ValueError, match="after 500 complete groups"):
+        tee_fastq(handle, [io.BytesIO(), io.BytesIO()], [], 10)
+
+
+def parse_args(args: Any = sys.argv[1:]) -> argparse.Namespace:
+    """
+    Build a command line parser object
+
+    Parameters:
+        args    Any                 Command line arguments
+
+    Return:
+                Namespace           Parsed command line object
+    """
+    main_parser = argparse.ArgumentParser(
+        description=sys.modules[__name__].__doc__,
+        formatter_class=CustomFormatter,
+    )
+
+    main_parser.add_argument(
+        "fq_file",
+        help="Fastq file to subsample, gzipped or not, or - to read the "
+             "standard input",
+        type=str,
+    )
+
+    main_parser.add_argument(
+        "-o",
+        "--output",
+        help="Path to the sampled fastq file, one per mate in tee mode. "
+             "Gzipped at a fast level if its name ends with .gz",
+        type=Path,
+        nargs="+",
+        required=True,
+    )
+
+    main_parser.add_argument(
+        "--tee",
+        help="Also write all reads in these fastq files, one per mate. "
+             "Input mates are expected to be interleaved",
+        type=Path,
+        nargs="+",
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "--codec",
+        help="Codec of tee outputs (default: %(default)s)",
+        type=str,
+        choices=list(CODECS.keys()),
+        default="gzip",
+    )
+
+    main_parser.add_argument(
+        "-l",
+        "--level",
+        help="Compression level of tee outputs (default: the default "
+             "level of the codec)",
+        type=int,
+        default=None,
+    )
+
+    main_parser.add_argument(
+        "-t",
+        "--threads",
+        help="Threads used to compress each tee output, with bgzf and "
+             "zstd (default: %(default)s)",
+        type=int,
+        default=1,
+    )
+
+    main_parser.add_argument(
+        "-n",
+        "--reads",
+        help="Number of reads to sample (default: %(default)s)",
+        type=int,
+        default=100000,
+    )
+
+    main_parser.add_argument(
+        "--seed",
+        help="Seed of the random number generator (default: %(default)s)",
+        type=int,
+        default=0,
+    )
+
+    main_parser.add_argument(
+        "-d",
+        "--debug",
+        help="Set logging in debug mode",
+        default=False,
+        action="store_true",
+    )
+
+    return main_parser.parse_args(args)
+
+
+def main(args: argparse.Namespace) -> None:
+    """
+    This function subsamples the given fastq file
+
+    Parameters:
+        args    Namespace      The parsed command line
+    """
+    for path in args.output + (args.tee or []):
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    outputs = [
+        gzip.open(path, "wb", compresslevel=1) if path.suffix == ".gz"
+        else path.open("wb", buffering=BUFFER_SIZE)
+        for path in args.output
+    ]
+    rng = random.Random(args.seed)
+
+    if args.tee is None:
+        with outputs[0] as output:
+            subsample_fastq(Path(args.fq_file), output, args.reads, rng)
+        return
+
+    if len(args.tee) != len(args.output):
+        raise ValueError("Tee mode needs one sample output per tee output")
+    tee_outputs = [
+        open_output(path, args.codec, args.level, args.threads)
+        for path in args.tee
+    ]
+    if args.fq_file == "-":
+        handle = sys.stdin.buffer
+    else:
+        handle = open_input(Path(args.fq_file))
+    try:
+        tee_fastq(handle, tee_outputs, outputs, args.reads, rng)
+    finally:
+        for output in tee_outputs + outputs:
+            output.close()
+
+
+# Running programm if not imported
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.INFO
+    )
+
+    try:
+        main(args)
+    except Exception as e:
+        logging.exception("%s", e)
+        raise
+    sys.exit(0)
@@ -0,0 +1,255 @@
+#!/usr/bin/python3.8
+# -*- coding: utf-8 -*-
+
+"""
+This script tests the functions of common_script_ngs_cleaning.py. They are
+kept aside so that importing the functions does not import pytest or
+pandas.
+
+You can test this script with:
+pytest -v ./test_common_script_ngs_cleaning.py
+"""
+
+import pandas  # Deal with TSV files (design)
+import pytest  # Unit testing
+
+from pathlib import Path  # Easily handle paths
+from typing import Dict, List  # Type hints
+
+from common_script_ngs_cleaning import (
+    design_fastq, fastq_pairs, fq_link, read_design, sample_stream
+)
+
+
+def test_read_design(tmp_path: Path) -> None:
+    """
+    Test the function read_design, and the functions above on the
+    dictionnary of columns it returns
+    """
+    design_path = tmp_path / "design.tsv"
+    design_path.write_text(
+        "Sample_id\tUpstream_file\tDownstream_file\tFastp_extra\n"
+        "S1\tS1.L1.R1.fq.gz\tS1.L1.R2.fq.gz\t--trim_poly_g\n"
+        "S2\tS2.R1.fq.gz\tS2.R2.fq.gz\n"
+        "\n"
+        "S1\tS1.L2.R1.fq.gz\tS1.L2.R2.fq.gz\t\n"
+    )
+    design = read_design(str(design_path))
+    assert design["Sample_id"] == ["S1", "S2", "S1"]
+    assert design["Fastp_extra"] == ["--trim_poly_g", "", ""]
+
+    expected = pandas.read_csv(design_path, sep="\t", dtype=str)
+    assert design_fastq(design) == design_fastq(expected)
+    assert sample_stream(design) == ["S1.R1", "S1.R2", "S2.R1", "S2.R2"]
+    assert fq_link(design)["S1_R2.fastq.gz"] == [
+        "S1.L1.R2.fq.gz", "S1.L2.R2.fq.gz"
+    ]
+
+
+@pytest.mark.parametrize(
+    "test, expected", [
+        (
+            pandas.DataFrame(
+                {
+                    "Sample_id": ["S1", "S2", "S1"],
+                    "Upstream_file": [
+                        "S1.L1.R1.fq.gz", "S2.R1.fq.gz", "S1.L2.R1.fq.gz"
+                    ],
+                    "Downstream_file": [
+                        "S1.L1.R2.fq.gz", "S2.R2.fq.gz", "S1.L2.R2.fq.gz"
+                    ]
+                }
+            ),
+            {
+                "S1": [
+                    ["S1.L1.R1.fq.gz", "S1.L2.R1.fq.gz"],
+                    ["S1.L1.R2.fq.gz", "S1.L2.R2.fq.gz"]
+                ],
+                "S2": [["S2.R1.fq.gz"], ["S2.R2.fq.gz"]]
+            }
+        ),
+
+        (
+            pandas.DataFrame(
+                {
+                    "Sample_id": ["S1"],
+                    "Upstream_file": ["S1.L1.fq.gz, S1.L2.fq.gz"]
+                }
+            ),
+            {"S1": [["S1.L1.fq.gz", "S1.L2.fq.gz"]]}
+        )
+    ]
+)
+def test_design_fastq(
+    test: pandas.DataFrame, expected: Dict[str, List[List[str]]]
+) -> None:
+    """
+    Test the function design_fastq
+    """
+    assert design_fastq(test) == expected
+
+
+@pytest.mark.parametrize(
+    "test, expected", [
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {
+                        "Sample_id": "S1",
+                        "Upstream_file": "S1.R1.fq.gz",
+                        "Downstream_file": "S1.R2.fq.gz"
+                    },
+                    "S2": {
+                        "Sample_id": "S2",
+                        "Upstream_file": "S2.R1.fq.gz",
+                        "Downstream_file": "S2.R2.fq.gz"
+                    }
+                }
+            ).T,
+            {
+                "S1": ["raw_data/S1_R1.fastq.gz", "raw_data/S1_R2.fastq.gz"],
+                "S2": ["raw_data/S2_R1.fastq.gz", "raw_data/S2_R2.fastq.gz"]
+            }
+        ),
+
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {"Sample_id": "S1", "Upstream_file": "S1.R1.fq.gz"},
+                    "S2":{"Sample_id": "S2", "Upstream_file": "S2.R1.fq.gz"}
+                }
+            ).T,
+            {
+                "S1": ["raw_data/S1.fastq.gz"],
+                "S2": ["raw_data/S2.fastq.gz"]
+            }
+        )
+    ]
+)
+def test_fastq_pairs(test: pandas.DataFrame, expected: List[str]) -> None:
+    """
+    Test the function fastq_pairs
+    """
+    assert fastq_pairs(test) == expected
+
+
+@pytest.mark.parametrize(
+    "test, expected", [
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {
+                        "Sample_id": "S1",
+                        "Upstream_file": "S1.R1.fq.gz",
+                        "Downstream_file": "S1.R2.fq.gz"
+                    },
+                    "S2": {
+                        "Sample_id": "S2",
+                        "Upstream_file": "S2.R1.fq.gz",
+                        "Downstream_file": "S2.R2.fq.gz"
+                    }
+                }
+            ).T,
+            ["S1.R1", "S1.R2", "S2.R1", "S2.R2"]
+        ),
+
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {"Sample_id": "S1", "Upstream_file": "S1.R1.fq.gz"},
+                    "S2":{"Sample_id": "S2", "Upstream_file": "S2.R1.fq.gz"}
+                }
+            ).T,
+            ["S1", "S2"]
+        )
+    ]
+)
+def test_sample_stream(test: pandas.DataFrame, expected: List[str]) -> None:
+    """
+    Test the function fastq_pairs
+    """
+    assert sample_stream(test) == expected
+
+
+@pytest.mark.parametrize(
+    "test, expected", [
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {
+                        "Sample_id": "S1",
+                        "Upstream_file": "S1.R1.fq.gz",
+                        "Downstream_file": "S1.R2.fq.gz"
+                    },
+                    "S2": {
+                        "Sample_id": "S2",
+                        "Upstream_file": "S2.R1.fq.gz",
+                        "Downstream_file": "S2.R2.fq.gz"
+                    }
+                }
+            ).T,
+            {"S1_R1.fastq.gz": ["S1.R1.fq.gz"],
+             "S1_R2.fastq.gz": ["S1.R2.fq.gz"],
+             "S2_R1.fastq.gz": ["S2.R1.fq.gz"],
+             "S2_R2.fastq.gz": ["S2.R2.fq.gz"]}
+        ),
+
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {
+                        "Sample_id": "S1",
+                        "Upstream_file": "S1.R1.fq.gz"
+                    },
+                    "S2": {
+                        "Sample_id": "S2",
+                        "Upstream_file": "S2.R1.fq.gz"
+                    }
+                }
+            ).T,
+            {"S1.fastq.gz": ["S1.R1.fq.gz"],
+             "S2.fastq.gz": ["S2.R1.fq.gz"]}
+        ),
+
+
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {
+                        "Sample_id": "S1",
+                        "Upstream_file": "/absolute/path/to/S1.R1.fq.gz"
+                    },
+                    "S2": {
+                        "Sample_id": "S2",
+                        "Upstream_file": "/absolute/path/to/S2.R1.fq.gz"
+                    }
+                }
+            ).T,
+            {"S1.fastq.gz": ["/absolute/path/to/S1.R1.fq.gz"],
+             "S2.fastq.gz": ["/absolute/path/to/S2.R1.fq.gz"]}
+        ),
+
+        (
+            pandas.DataFrame(
+                {
+                    "S1": {
+                        "Sample_id": "S1",
+                        "Upstream_file": "relative/path/to/S1.R1.fq.gz"
+                    },
+                    "S2": {
+                        "Sample_id": "S2",
+                        "Upstream_file": "relative/path/to/S2.R1.fq.gz"
+                    }
+                }
+            ).T,
+            {"S1.fastq.gz": ["relative/path/to/S1.R1.fq.gz"],
+             "S2.fastq.gz": ["relative/path/to/S2.R1.fq.gz"]}
+        ),
+
+    ]
+)
+def test_fq_link(test: pandas.DataFrame, expected: List[str]) -> None:
+    """
+    Test the function fastq_pairs
+    """
+    assert fq_link(test) == expected